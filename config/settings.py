@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -43,6 +44,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Первым - чтобы в замер попали и запросы сессий/авторизации (см. core/perf.py)
+    'core.perf.PerfMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.locale.LocaleMiddleware',
@@ -65,6 +68,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'core.context_processors.live_updates',
             ],
         },
     },
@@ -79,7 +83,8 @@ WSGI_APPLICATION = 'config.wsgi.application'
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        # Другой файл базы - например, для нагрузочного прогона (manage.py benchmark)
+        'NAME': os.environ.get('DATABASE_PATH') or BASE_DIR / 'db.sqlite3',
     }
 }
 
@@ -202,4 +207,115 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 
 # --- НАСТРОЙКИ МЕДИА (ФАЙЛОВ) ---
 MEDIA_URL = '/media/'
-MEDIA_ROOT = BASE_DIR / 'media'
\ No newline at end of file
+MEDIA_ROOT = BASE_DIR / 'media'
+# Кто отдает сами файлы: None - Django (потоком, с Range),
+# 'x-accel-redirect' - nginx, 'x-sendfile' - Apache/lighttpd
+MEDIA_SENDFILE = None
+# Внутренний location nginx для X-Accel-Redirect
+MEDIA_ACCEL_PREFIX = '/protected-media/'
+
+# --- PUSH-СОБЫТИЯ ЧАТА (SSE) ---
+# Брокер событий: по умолчанию pub/sub внутри процесса
+CHAT_EVENTS_BROKER = 'core.events.InProcessBroker'
+# Как часто (сек) проверять сообщения от других процессов (runbot). 0 - выключить
+CHAT_EVENTS_WATCH_INTERVAL = 2
+
+# --- ТЕЛЕФОНЫ ---
+# Код страны для местных номеров без кода (90 937 05 20 -> +998909370520)
+PHONE_DEFAULT_COUNTRY_CODE = '998'
+
+# --- КЭШ ---
+# Локальная память процесса. Для нескольких процессов (бот + веб) подключите
+# общий бэкенд (Redis/Memcached/БД) - тогда счетчик непрочитанных будет точным сразу
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'china-crm',
+    }
+}
+# Счетчик непрочитанных лидов: какой кэш и как часто сверять его с базой (сек)
+UNREAD_COUNT_CACHE = 'default'
+UNREAD_COUNT_RECONCILE_SECONDS = 60
+
+# --- ЧАТ ---
+# Сколько сообщений отдавать за раз (последние при открытии чата и каждая подгрузка истории)
+CHAT_PAGE_SIZE = 50
+# Сколько лидов в одной странице сайдбара
+SIDEBAR_PAGE_SIZE = 50
+# Сколько новых сообщений отдает опрос; если вкладка отстала сильнее - перечитывает все
+CHAT_DELTA_MAX_MESSAGES = 500
+# Максимальный размер превью картинок в ленте чата (см. core/media.py)
+CHAT_THUMBNAIL_SIZE = (320, 320)
+
+# --- ОЧЕРЕДЬ ОТПРАВКИ В TELEGRAM (core/outbox.py) ---
+# Лимиты Bot API: ~30 сообщений в секунду всего и ~1 в секунду в один чат
+OUTBOX_RATE_PER_SECOND = 30
+OUTBOX_PER_CHAT_INTERVAL = 1.0
+# Повторы временных ошибок: 2, 4, 8... секунд, но не дольше OUTBOX_BACKOFF_MAX
+OUTBOX_MAX_ATTEMPTS = 6
+OUTBOX_BACKOFF = 2
+OUTBOX_BACKOFF_MAX = 300
+# Через сколько секунд сообщение, взятое упавшим отправителем, вернется в очередь
+OUTBOX_LEASE = 120
+# Как часто проверять пустую очередь (сек)
+OUTBOX_POLL_INTERVAL = 1
+
+# --- ЗАМЕРЫ ЗАПРОСОВ (core/perf.py) ---
+# Доля замеряемых запросов: 1 - все, 0.1 - каждый десятый, 0 - выключено.
+# По умолчанию каждый двадцатый - строка лога на каждый запрос в проде не нужна;
+# для разбора поднять через окружение (PERF_SAMPLE_RATE=1)
+PERF_SAMPLE_RATE = float(os.environ.get('PERF_SAMPLE_RATE', 0.05))
+# Отдавать замер в заголовке Server-Timing
+PERF_SERVER_TIMING = True
+# Порог (мс), выше которого запрос пишется в core.perf.slow со всеми SQL и местом вызова.
+# None - не собирать SQL вовсе (это дороже обычного замера)
+PERF_SLOW_REQUEST_MS = None
+# Долгие соединения и статика - их время ничего не говорит
+PERF_EXCLUDE_PATHS = ('/api/events/', '/static/')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'plain': {'format': '%(asctime)s %(name)s %(message)s'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'plain'},
+    },
+    'loggers': {
+        # Строка JSON на каждый замеренный запрос
+        'core.perf': {'handlers': ['console'], 'level': os.environ.get('PERF_LOG_LEVEL', 'INFO'), 'propagate': False},
+        # События бота и очереди отправки (core.bot, core.outbox) - тоже строки JSON
+        'core': {'handlers': ['console'], 'level': os.environ.get('BOT_LOG_LEVEL', 'INFO'), 'propagate': False},
+    },
+}
+
+# --- ЗАПИСЬ СООБЩЕНИЙ БОТА (core/ingest.py, MessageWriter) ---
+# Входящие сообщения пишутся пачками: одна транзакция (один fsync SQLite) на
+# BOT_WRITE_BATCH_SIZE сообщений или BOT_WRITE_BATCH_MS мс. 0 - каждое сразу
+BOT_WRITE_BATCH_SIZE = 100
+BOT_WRITE_BATCH_MS = 50
+
+# --- МЕТРИКИ БОТА (core/metrics.py) ---
+# runbot отдает их в формате Prometheus на http://127.0.0.1:<порт>/metrics. 0 - не поднимать
+BOT_METRICS_PORT = 9108
+
+# --- WEBHOOK TELEGRAM (core/webhook.py) ---
+# Секрет, который Telegram присылает в X-Telegram-Bot-Api-Secret-Token
+# (1-256 символов A-Z, a-z, 0-9, _ и -). Пустой - webhook выключен, работает runbot
+TELEGRAM_WEBHOOK_SECRET = os.environ.get('TELEGRAM_WEBHOOK_SECRET', '')
+# Разбирать апдейты фоновым потоком в веб-процессе. False - этим занят manage.py process_updates
+TELEGRAM_WEBHOOK_WORKER = True
+# Потоков скачивания медиа в каждом веб-процессе
+TELEGRAM_WEBHOOK_MEDIA_WORKERS = 2
+# Повторы упавшего хендлера: 2, 4, 8... секунд, не больше TELEGRAM_WEBHOOK_MAX_ATTEMPTS попыток
+TELEGRAM_WEBHOOK_MAX_ATTEMPTS = 5
+TELEGRAM_WEBHOOK_BACKOFF = 2
+# Через сколько секунд апдейт, взятый упавшим процессом, вернется в очередь
+TELEGRAM_WEBHOOK_LEASE = 60
+# Сколько ждать записи сообщений пачки (MessageWriter), прежде чем считать апдейт упавшим. Меньше LEASE
+TELEGRAM_WEBHOOK_FLUSH_TIMEOUT = 30
+# Как часто проверять очередь, если новых апдейтов не было (сек)
+TELEGRAM_WEBHOOK_POLL_INTERVAL = 5
+# Сколько дней хранить обработанные апдейты (дольше Telegram не передоставляет)
+TELEGRAM_WEBHOOK_KEEP_DAYS = 2
@@ -1,18 +1,19 @@
 from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
-from django.conf.urls.static import static
-from core.views import chat_dashboard, index, api_get_unread
+from core.views import chat_dashboard, index, api_get_unread, api_search, chat_events, serve_media, telegram_webhook
 
 urlpatterns = [
     path('', index, name='index'),
     path('admin/chat/', chat_dashboard, name='chat_index'),
     path('admin/chat/<int:lead_id>/', chat_dashboard, name='chat_dashboard'),
     path('api/unread-count/', api_get_unread, name='api_unread_count'),
+    path('api/events/', chat_events, name='api_events'),
+    path('api/search/', api_search, name='api_search'),
+    # Апдейты бота в webhook-режиме (см. core/webhook.py)
+    path('telegram/webhook/', telegram_webhook, name='telegram_webhook'),
     path('admin/', admin.site.urls),
     path('i18n/', include('django.conf.urls.i18n')),
-]
-
-# ЭТО ВАЖНО: Разрешаем раздачу файлов в режиме разработки
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+    # Вложения чата: с Range, кэшем и X-Sendfile/X-Accel-Redirect (см. MEDIA_SENDFILE)
+    path(f"{settings.MEDIA_URL.strip('/')}/<path:path>", serve_media, name='media'),
+]
\ No newline at end of file
@@ -1,8 +1,18 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.contrib.admin.views.main import ORDER_VAR
 from django.contrib.auth.models import Group as DjangoGroup
+from django.core.exceptions import PermissionDenied
+from django.db.models import Case, Count, IntegerField, When
+from django.shortcuts import get_object_or_404, redirect, render
 from django.utils.html import format_html
-from django.urls import reverse
-from .models import Lead, Student, Teacher, Group, Lesson, Attendance, Tariff, Payment, Task, ChatMessage
+from django.urls import path, reverse
+from . import broadcast as broadcasts, search, unread
+from .lead_cache import lead_cache
+from .phones import looks_like_phone, normalize_phone
+from .models import (
+    Lead, Student, Teacher, Group, Lesson, Attendance, Tariff, Payment, Task, ChatMessage,
+    Broadcast, BroadcastStatus,
+)
 
 # --- ВНУТРЕННИЕ ТАБЛИЦЫ (INLINES) ---
 
@@ -20,14 +30,39 @@ class PaymentInline(admin.TabularInline):
     readonly_fields = ('date', 'amount', 'tariff')
     can_delete = False
 
+class PhoneSearchMixin:
+    """Поиск по полному номеру идет по индексу phone_normalized, а не LIKE по сырому телефону."""
+
+    def get_search_results(self, request, queryset, search_term):
+        if looks_like_phone(search_term):
+            return queryset.filter(phone_normalized=normalize_phone(search_term)), False
+        return super().get_search_results(request, queryset, search_term)
+
+class FullTextSearchMixin:
+    """Поиск по полнотекстовому индексу (поля лида и его переписка) вместо LIKE '%...%' по таблице."""
+
+    def get_search_results(self, request, queryset, search_term):
+        if search.terms(search_term) and search.is_available():
+            ids = search.lead_ids(search_term)
+            if not ids:
+                return queryset.none(), False
+            rank = Case(*[When(id=lead_id, then=n) for n, lead_id in enumerate(ids)], output_field=IntegerField())
+            queryset = queryset.filter(id__in=ids).annotate(search_rank=rank)
+            # Сортировку менеджер не выбирал - лучшие совпадения первыми
+            if ORDER_VAR not in request.GET:
+                queryset = queryset.order_by('search_rank', *queryset.query.order_by)
+            return queryset, False
+        return super().get_search_results(request, queryset, search_term)
+
 # --- ОСНОВНЫЕ РАЗДЕЛЫ ---
 
 @admin.register(Lead)
-class LeadAdmin(admin.ModelAdmin):
+class LeadAdmin(PhoneSearchMixin, FullTextSearchMixin, admin.ModelAdmin):
     # Добавили open_chat_link в список
     list_display = ('first_name', 'phone', 'status', 'source', 'open_chat_link')
     list_filter = ('status', 'source')
     search_fields = ('first_name', 'phone', 'telegram_username')
+    search_help_text = "Имя, username, комментарий или слова из переписки"
     list_editable = ('status',)
 
     # Кнопка для перехода в чат
@@ -37,9 +72,17 @@ class LeadAdmin(admin.ModelAdmin):
     
     open_chat_link.short_description = "Переписка"
 
+    def delete_queryset(self, request, queryset):
+        # Массовое удаление не вызывает Lead.delete - сбрасываем кэш бота сами
+        for telegram_id in queryset.values_list('telegram_id', flat=True):
+            lead_cache.invalidate(telegram_id)
+        super().delete_queryset(request, queryset)
+        unread.invalidate()
+
 @admin.register(Student)
-class StudentAdmin(admin.ModelAdmin):
+class StudentAdmin(PhoneSearchMixin, admin.ModelAdmin):
     list_display = ('full_name', 'phone', 'group', 'balance', 'student_status')
+    list_select_related = ('group',)
     list_filter = ('group', 'student_status')
     search_fields = ('full_name', 'phone')
     inlines = [PaymentInline] # Видно оплаты внутри студента
@@ -51,20 +94,86 @@ class TeacherAdmin(admin.ModelAdmin):
 @admin.register(Group)
 class GroupAdmin(admin.ModelAdmin):
     list_display = ('name', 'level', 'teacher', 'days_description', 'count_students')
+    list_select_related = ('teacher',)
+
+    def get_queryset(self, request):
+        # Считаем учеников одним запросом со списком, а не запросом на каждую строку
+        return super().get_queryset(request).annotate(students_total=Count('students', distinct=True))
+
     def count_students(self, obj):
-        return obj.students.count()
+        return obj.students_total
     count_students.short_description = "Учеников"
+    count_students.admin_order_field = 'students_total'
 
 @admin.register(Lesson)
 class LessonAdmin(admin.ModelAdmin):
-    list_display = ('group', 'date', 'topic', 'students_checked')
+    list_display = ('group', 'date', 'topic', 'students_checked', 'mark_link')
     list_filter = ('group', 'date')
     date_hierarchy = 'date'
+    list_select_related = ('group',)
     inlines = [AttendanceInline] # Журнал посещаемости
+    actions = ['mark_all_present']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(checked_total=Count('attendance_records', distinct=True))
 
     def students_checked(self, obj):
-        return obj.attendance_records.count()
+        return obj.checked_total
     students_checked.short_description = "Отмечено чел."
+    students_checked.admin_order_field = 'checked_total'
+
+    # Кнопка для быстрой отметки всей группы
+    def mark_link(self, obj):
+        url = reverse('admin:core_lesson_mark', args=[obj.id])
+        return format_html('<a class="button" href="{}" style="background-color:#17a2b8; color:white; padding:5px 10px; border-radius:5px;">📋 Отметить</a>', url)
+    mark_link.short_description = "Посещаемость"
+
+    def get_urls(self):
+        custom = [
+            path('<int:lesson_id>/mark/', self.admin_site.admin_view(self.mark_attendance_view), name='core_lesson_mark'),
+        ]
+        return custom + super().get_urls()
+
+    def mark_attendance_view(self, request, lesson_id):
+        """Отметка всей группы одной формой и одной транзакцией (Attendance.bulk_mark)."""
+        lesson = get_object_or_404(Lesson.objects.select_related('group'), pk=lesson_id)
+        if not self.has_change_permission(request, lesson):
+            raise PermissionDenied
+
+        students = list(lesson.group.students.order_by('full_name'))
+        marked = dict(lesson.attendance_records.values_list('student_id', 'status'))
+
+        if request.method == 'POST':
+            marks = {}
+            for student in students:
+                status = request.POST.get(f'status_{student.id}')
+                if status and student.id not in marked:
+                    marks[student.id] = status
+            try:
+                created = Attendance.bulk_mark(lesson, marks)
+            except ValueError as e:
+                messages.error(request, str(e))
+            else:
+                messages.success(request, f"Отмечено студентов: {len(created)}")
+                return redirect('admin:core_lesson_changelist')
+
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': f"Посещаемость: {lesson}",
+            'lesson': lesson,
+            'rows': [(student, marked.get(student.id)) for student in students],
+            'status_choices': Attendance.STATUS_CHOICES,
+        }
+        return render(request, 'admin/core/lesson/mark_attendance.html', context)
+
+    @admin.action(description="✅ Отметить всех присутствующими")
+    def mark_all_present(self, request, queryset):
+        total = 0
+        for lesson in queryset:
+            student_ids = lesson.group.students.exclude(student_status='banned').values_list('id', flat=True)
+            total += len(Attendance.bulk_mark(lesson, {sid: 'present' for sid in student_ids}))
+        self.message_user(request, f"Отмечено студентов: {total}")
 
 @admin.register(Tariff)
 class TariffAdmin(admin.ModelAdmin):
@@ -73,6 +182,7 @@ class TariffAdmin(admin.ModelAdmin):
 @admin.register(Payment)
 class PaymentAdmin(admin.ModelAdmin):
     list_display = ('student', 'tariff', 'amount', 'date')
+    list_select_related = ('student', 'tariff')
     list_filter = ('date', 'tariff')
     search_fields = ('student__full_name',)
     autocomplete_fields = ['student']
@@ -80,6 +190,7 @@ class PaymentAdmin(admin.ModelAdmin):
 @admin.register(Task)
 class TaskAdmin(admin.ModelAdmin):
     list_display = ('title', 'assigned_to', 'deadline', 'priority', 'status')
+    list_select_related = ('assigned_to',)
     list_filter = ('status', 'priority', 'assigned_to')
     search_fields = ('title',)
     list_editable = ('status',)
@@ -89,5 +200,65 @@ class TaskAdmin(admin.ModelAdmin):
             return 'red-row'
         return ''
 
+@admin.register(Broadcast)
+class BroadcastAdmin(admin.ModelAdmin):
+    list_display = ('title', 'audience', 'status', 'progress_display', 'created_at')
+    list_filter = ('status', 'audience')
+    readonly_fields = ('status', 'progress_detail', 'started_at', 'finished_at', 'created_by')
+    fieldsets = (
+        (None, {'fields': ('title', 'text', 'attachment')}),
+        ("Кому", {'fields': ('audience', 'lead_status', 'lead_source', 'group', 'student_status')}),
+        ("Отправка", {'fields': ('status', 'progress_detail', 'started_at', 'finished_at', 'created_by')}),
+    )
+    actions = ['start_broadcast', 'pause_broadcast']
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            obj.created_by = request.user
+        super().save_model(request, obj, form, change)
+
+    def get_queryset(self, request):
+        # Счетчики доставки - одним запросом со списком, а не GROUP BY на каждую строку
+        return broadcasts.with_progress(super().get_queryset(request))
+
+    def progress_display(self, obj):
+        if obj.status == BroadcastStatus.DRAFT:
+            return "-"
+        stats = broadcasts.progress(obj)
+        text = f"{stats['sent']}/{stats['total']}"
+        if stats['failed']:
+            text += f", ⚠️ {stats['failed']}"
+        if obj.status != BroadcastStatus.DONE:
+            text += f" · {stats['rate']:.1f}/сек, осталось ~{broadcasts.format_duration(stats['eta'])}"
+        return text
+    progress_display.short_description = "Прогресс"
+
+    def progress_detail(self, obj):
+        # До запуска получатели еще не выбраны - на странице одной рассылки считаем сегмент
+        if obj.status == BroadcastStatus.DRAFT and obj.pk is not None:
+            count = broadcasts.segment(obj).count()
+            return f"{count} получателей, ~{broadcasts.format_duration(broadcasts.estimate_seconds(count))}"
+        return self.progress_display(obj)
+    progress_detail.short_description = "Прогресс"
+
+    @admin.action(description="▶️ Запустить / продолжить")
+    def start_broadcast(self, request, queryset):
+        for obj in queryset:
+            if obj.status == BroadcastStatus.DRAFT:
+                total = broadcasts.start(obj)
+                self.message_user(request, f"«{obj.title}»: {total} получателей в очереди")
+            elif obj.status == BroadcastStatus.PAUSED:
+                broadcasts.resume(obj)
+                self.message_user(request, f"«{obj.title}»: продолжаем")
+
+    @admin.action(description="⏸ Приостановить")
+    def pause_broadcast(self, request, queryset):
+        paused = sum(broadcasts.pause(obj) for obj in queryset)
+        self.message_user(request, f"Приостановлено рассылок: {paused}")
+
+# Главная админки с виджетами аналитики (шаблон в приложении core не может
+# перекрыть admin/index.html от jazzmin - он раньше в INSTALLED_APPS)
+admin.site.index_template = 'admin/dashboard.html'
+
 # Скрываем стандартные группы, чтобы не мешали
 admin.site.unregister(DjangoGroup)
\ No newline at end of file
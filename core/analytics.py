@@ -0,0 +1,251 @@
+"""
+Аналитика для дашборда админки на предрасчитанных дневных сводках.
+
+Вместо агрегатов по Payment/Attendance/Lead на каждый показ страницы
+дашборд читает таблицу DailyStat: одна строка на (метрику, день, ключ).
+Сводки обновляются на месте при сохранении новых оплат, отметок, лидов и
+студентов (bump - UPDATE ... SET count = count + 1), а правки и удаления
+задним числом выправляет команда rebuild_rollups (например, раз в ночь).
+
+Метрики и ключи:
+    revenue_tariff / revenue_group  - оплаты: count - число, total - сумма;
+                                      ключ - id тарифа / группы студента на момент
+                                      оплаты (Payment.group), и при пересчете тоже
+    attendance_group / _teacher     - отметки со списанием урока: count - все,
+                                      total - присутствовал; ключ - id группы / преподавателя
+    funnel_leads / _students / _paid - воронка по источнику лида (ключ) для
+                                      когорты лидов, созданных в этот день
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+REVENUE_TARIFF = 'revenue_tariff'
+REVENUE_GROUP = 'revenue_group'
+ATTENDANCE_GROUP = 'attendance_group'
+ATTENDANCE_TEACHER = 'attendance_teacher'
+FUNNEL_LEADS = 'funnel_leads'
+FUNNEL_STUDENTS = 'funnel_students'
+FUNNEL_PAID = 'funnel_paid'
+
+
+def _day(value):
+    """Дата дня в локальной зоне (как у TruncDate при пересчете)."""
+    if hasattr(value, 'tzinfo'):
+        return timezone.localdate(value)
+    return value
+
+
+def _key(value):
+    return '' if value is None else str(value)
+
+
+def bump(metric, day, key='', count=1, total=0):
+    """Прибавляет к сводке за день. Строки нет - создает."""
+    from .models import DailyStat
+    if not count and not total:
+        return
+    day, key = _day(day), _key(key)
+    rows = DailyStat.objects.filter(metric=metric, day=day, key=key)
+    if rows.update(count=F('count') + count, total=F('total') + total):
+        return
+    try:
+        with transaction.atomic():
+            DailyStat.objects.create(metric=metric, day=day, key=key, count=count, total=total)
+    except IntegrityError:
+        # Строку за этот день только что создал параллельный запрос
+        rows.update(count=F('count') + count, total=F('total') + total)
+
+
+# --- ИНКРЕМЕНТАЛЬНЫЕ ОБНОВЛЕНИЯ (вызываются из моделей) ---
+
+def payment_created(payment):
+    from .models import Lead, Payment, Student
+    day = payment.date
+    lead_id = Student.objects.filter(pk=payment.student_id).values_list('lead_id', flat=True).get()
+    bump(REVENUE_TARIFF, day, payment.tariff_id, 1, payment.amount)
+    bump(REVENUE_GROUP, day, payment.group_id, 1, payment.amount)
+
+    # Первая оплата студента из лида - последняя ступень воронки
+    if lead_id and not Payment.objects.filter(student_id=payment.student_id).exclude(pk=payment.pk).exists():
+        created_at, source = Lead.objects.filter(pk=lead_id).values_list('created_at', 'source').get()
+        bump(FUNNEL_PAID, created_at, source)
+
+
+def attendance_marked(lesson, marks):
+    """marks - {student_id: статус} только что созданных отметок урока."""
+    from .models import Attendance, Group, Lesson
+    charged = [status for status in marks.values() if status in Attendance.CHARGED_STATUSES]
+    if not charged:
+        return
+    present = sum(status == 'present' for status in charged)
+    if Lesson.group.is_cached(lesson):
+        teacher_id = lesson.group.teacher_id
+    else:
+        teacher_id = Group.objects.filter(pk=lesson.group_id).values_list('teacher_id', flat=True).first()
+    bump(ATTENDANCE_GROUP, lesson.date, lesson.group_id, len(charged), present)
+    if teacher_id:
+        bump(ATTENDANCE_TEACHER, lesson.date, teacher_id, len(charged), present)
+
+
+def leads_created(leads, delta=1):
+    """Новые (или, с delta=-1, удаленные) лиды - в первую ступень воронки."""
+    per_key = defaultdict(int)
+    for lead in leads:
+        per_key[(_day(lead.created_at), lead.source)] += delta
+    for (day, source), count in per_key.items():
+        bump(FUNNEL_LEADS, day, source, count)
+
+
+def student_linked(old_lead_id, new_lead_id):
+    """Студента привязали к лиду (или отвязали) - ступень 'стал студентом'."""
+    from .models import Lead
+    changes = [(old_lead_id, -1), (new_lead_id, 1)]
+    for lead_id, delta in changes:
+        if lead_id:
+            lead = Lead.objects.filter(pk=lead_id).values('created_at', 'source').first()
+            if lead:
+                bump(FUNNEL_STUDENTS, lead['created_at'], lead['source'], delta)
+
+
+# --- ПОЛНЫЙ ПЕРЕСЧЕТ ---
+
+def rebuild(since=None):
+    """
+    Пересчитывает сводки с даты since (или все) по исходным таблицам.
+    Возвращает число записанных строк.
+    """
+    from .models import Attendance, DailyStat, Lead, Payment
+
+    payments = Payment.objects.all()
+    attendance = Attendance.objects.filter(status__in=Attendance.CHARGED_STATUSES)
+    leads = Lead.objects.all()
+    if since:
+        payments = payments.filter(date__date__gte=since)
+        attendance = attendance.filter(lesson__date__gte=since)
+        leads = leads.filter(created_at__date__gte=since)
+
+    present = Count('id', filter=Q(status='present'))
+    sources = [
+        (REVENUE_TARIFF, payments.annotate(day=TruncDate('date')).values('day', key=F('tariff_id'))
+            .annotate(n=Count('id'), sum=Sum('amount'))),
+        (REVENUE_GROUP, payments.annotate(day=TruncDate('date')).values('day', key=F('group_id'))
+            .annotate(n=Count('id'), sum=Sum('amount'))),
+        (ATTENDANCE_GROUP, attendance.values(day=F('lesson__date'), key=F('lesson__group_id'))
+            .annotate(n=Count('id'), sum=present)),
+        (ATTENDANCE_TEACHER, attendance.filter(lesson__group__teacher__isnull=False)
+            .values(day=F('lesson__date'), key=F('lesson__group__teacher_id'))
+            .annotate(n=Count('id'), sum=present)),
+        (FUNNEL_LEADS, leads.annotate(day=TruncDate('created_at')).values('day', key=F('source'))
+            .annotate(n=Count('id'))),
+        (FUNNEL_STUDENTS, leads.filter(student__isnull=False).annotate(day=TruncDate('created_at'))
+            .values('day', key=F('source')).annotate(n=Count('id'))),
+        (FUNNEL_PAID, leads.filter(student__payments__isnull=False).annotate(day=TruncDate('created_at'))
+            .values('day', key=F('source')).annotate(n=Count('id', distinct=True))),
+    ]
+
+    with transaction.atomic():
+        stale = DailyStat.objects.all()
+        if since:
+            stale = stale.filter(day__gte=since)
+        stale.delete()
+
+        rows = [
+            DailyStat(metric=metric, day=row['day'], key=_key(row['key']), count=row['n'], total=row.get('sum') or 0)
+            for metric, query in sources
+            for row in query.order_by()
+        ]
+        DailyStat.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+# --- ВИДЖЕТЫ ДАШБОРДА ---
+
+def _totals(metric, since):
+    """{ключ: (count, total)} за период - GROUP BY по индексу (metric, day, key)."""
+    from .models import DailyStat
+    rows = (
+        DailyStat.objects.filter(metric=metric, day__gte=since)
+        .values('key').annotate(n=Sum('count'), sum=Sum('total')).order_by()
+    )
+    return {row['key']: (row['n'], row['sum']) for row in rows}
+
+
+def _names(model, keys, field):
+    ids = [int(key) for key in keys if key.isdigit()]
+    return {str(pk): name for pk, name in model.objects.filter(pk__in=ids).values_list('pk', field)}
+
+
+def _rate(present, total):
+    return round(100 * present / total) if total else 0
+
+
+def dashboard(days=30, months=6):
+    """Данные виджетов: выручка по месяцам, тарифам и группам, посещаемость, воронка по источникам."""
+    from .models import DailyStat, Group, Teacher, Tariff
+
+    today = timezone.localdate()
+    since = today - timedelta(days=days - 1)
+    year, month = divmod(today.year * 12 + today.month - months, 12)
+    month_start = today.replace(year=year, month=month + 1, day=1)
+
+    # Суммируем по дням в SQL (идет по индексу без функций над строками), месяцы - уже в Python
+    by_day = (
+        DailyStat.objects.filter(metric=REVENUE_TARIFF, day__gte=month_start)
+        .values('day').annotate(n=Sum('count'), sum=Sum('total')).order_by('day')
+    )
+    by_month = {}
+    for row in by_day:
+        month = by_month.setdefault(row['day'].replace(day=1), {'month': row['day'].replace(day=1), 'count': 0, 'amount': 0})
+        month['count'] += row['n']
+        month['amount'] += row['sum']
+
+    tariffs = _totals(REVENUE_TARIFF, since)
+    tariff_names = _names(Tariff, tariffs, 'name')
+    groups = _totals(REVENUE_GROUP, since)
+    attendance_groups = _totals(ATTENDANCE_GROUP, since)
+    group_names = _names(Group, set(groups) | set(attendance_groups), 'name')
+    attendance_teachers = _totals(ATTENDANCE_TEACHER, since)
+    teacher_names = _names(Teacher, attendance_teachers, 'full_name')
+
+    funnel_leads = _totals(FUNNEL_LEADS, since)
+    funnel_students = _totals(FUNNEL_STUDENTS, since)
+    funnel_paid = _totals(FUNNEL_PAID, since)
+
+    def sorted_by_amount(totals, names, default):
+        rows = [
+            {'name': names.get(key, default), 'count': n, 'amount': amount}
+            for key, (n, amount) in totals.items()
+        ]
+        return sorted(rows, key=lambda row: row['amount'], reverse=True)
+
+    def attendance(totals, names):
+        rows = [
+            {'name': names.get(key, '—'), 'marks': n, 'rate': _rate(present, n)}
+            for key, (n, present) in totals.items()
+        ]
+        return sorted(rows, key=lambda row: row['rate'])
+
+    funnel = []
+    for source, (leads, _) in sorted(funnel_leads.items(), key=lambda item: -item[1][0]):
+        students = funnel_students.get(source, (0, 0))[0]
+        paid = funnel_paid.get(source, (0, 0))[0]
+        funnel.append({
+            'source': source or 'Без источника',
+            'leads': leads, 'students': students, 'paid': paid,
+            'conversion': _rate(students, leads),
+        })
+
+    return {
+        'days': days,
+        'revenue_by_month': list(by_month.values()),
+        'revenue_by_tariff': sorted_by_amount(tariffs, tariff_names, 'Без тарифа'),
+        'revenue_by_group': sorted_by_amount(groups, group_names, 'Без группы'),
+        'attendance_by_group': attendance(attendance_groups, group_names),
+        'attendance_by_teacher': attendance(attendance_teachers, teacher_names),
+        'funnel': funnel,
+    }
@@ -1,6 +1,21 @@
+import logging
+
 from django.apps import AppConfig
+from django.db import connections
+from django.db.models.signals import post_migrate
+
+logger = logging.getLogger(__name__)
+
+
+def ensure_search_index(using, **kwargs):
+    from . import search
+    if search.ensure_installed(connections[using]):
+        logger.info('Триггеры полнотекстового поиска восстановлены, индекс пересобран')
 
 
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+
+    def ready(self):
+        post_migrate.connect(ensure_search_index, sender=self)
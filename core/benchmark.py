@@ -0,0 +1,492 @@
+"""
+Нагрузочный прогон горячих путей CRM.
+
+seed() наполняет базу синтетикой (по умолчанию 100k лидов, 5M сообщений,
+10k студентов и год уроков, отметок и оплат; --scale уменьшает все
+пропорционально), run() гоняет сценарии через тестовый клиент Django
+и считает перцентили задержки и число SQL-запросов, а compare() сравнивает
+два прогона и находит регрессии.
+
+Гонять на отдельной базе (DATABASE_PATH=bench.sqlite3), а не на рабочей:
+seed пишет миллионы строк, а сценарии заводят пользователя-суперадмина,
+импортируют и принимают от бота синтетику. Поэтому run() отказывается
+работать с базой, которую не наполнял seed(). Команда: manage.py benchmark.
+"""
+import contextlib
+import csv
+import io
+import itertools
+import os
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import analytics, search, unread
+from .models import (
+    Attendance, ChatMessage, Group, Lead, LeadStatus, Lesson, Payment, Student, Tariff, Teacher,
+)
+
+FULL_SCALE = {
+    'leads': 100_000,
+    'messages': 5_000_000,
+    'students': 10_000,
+}
+GROUP_SIZE = 15
+LESSONS_PER_WEEK = 2
+BATCH_SIZE = 5000
+
+STATUS_WEIGHTS = {
+    LeadStatus.NEW: 5, LeadStatus.IN_PROGRESS: 50, LeadStatus.WAITING_PAYMENT: 10,
+    LeadStatus.WON: 15, LeadStatus.LOST: 20,
+}
+SOURCES = ['Telegram', 'Instagram', 'Import', 'Web', 'Referral']
+WORDS = (
+    'здравствуйте сколько стоит курс hsk3 hsk4 вечерняя группа расписание оплата '
+    'пробный урок преподаватель китайский иероглифы тоны домашнее задание скидка '
+    'перенос занятия спасибо до встречи 你好 谢谢 老师'
+).split()
+
+# Первые telegram_id синтетических лидов: боты в сценариях пишут от их имени
+TELEGRAM_ID_BASE = 7_000_000_000
+# Сообщений в одном прогоне сценариев bot.ingest_burst*
+INGEST_BURST = 500
+
+
+class ScenarioSkipped(Exception):
+    """Сценарию нечего измерять на этой базе - в отчет он не попадает."""
+
+
+# --- НАПОЛНЕНИЕ ---
+
+@contextlib.contextmanager
+def _clock(start, step):
+    """auto_now/auto_now_add получают растущее время вместо одного "сейчас" на весь bulk_create."""
+    ticks = (start + step * n for n in itertools.count())
+    with mock.patch.object(timezone, 'now', side_effect=lambda: next(ticks)):
+        yield
+
+
+def _batches(iterable, size=BATCH_SIZE):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def _bulk(model, objects, log, label):
+    total = 0
+    for batch in _batches(objects):
+        with transaction.atomic():
+            model.objects.bulk_create(batch, batch_size=BATCH_SIZE)
+        total += len(batch)
+        if total % (BATCH_SIZE * 20) == 0:
+            log(f"   {label}: {total}")
+    return total
+
+
+def _phone(n):
+    return f"+9989{n:08d}"
+
+
+def is_seeded():
+    """База наполнена seed(): первый синтетический лид на месте."""
+    return Lead.objects.filter(telegram_id=str(TELEGRAM_ID_BASE)).exists()
+
+
+def seed(scale=1.0, seed_value=42, log=print):
+    """Наполняет пустую базу синтетикой. Возвращает число созданных строк по таблицам."""
+    rnd = random.Random(seed_value)
+    now = timezone.now()
+    year_ago = now - timedelta(days=365)
+    counts = {name: max(1, int(full * scale)) for name, full in FULL_SCALE.items()}
+
+    # Индекс поиска на каждую вставку - в разы медленнее; пересоберем в конце
+    search.uninstall(connection)
+
+    log(f"👥 Лиды: {counts['leads']}")
+    statuses = rnd.choices(list(STATUS_WEIGHTS), weights=list(STATUS_WEIGHTS.values()), k=counts['leads'])
+    # На лида два тика часов: created_at и updated_at
+    with _clock(year_ago, timedelta(days=365) / (2 * counts['leads'])):
+        leads = (
+            Lead(
+                first_name=f"Клиент {n}",
+                phone=_phone(n), phone_normalized=_phone(n),
+                telegram_id=str(TELEGRAM_ID_BASE + n),
+                telegram_username=f"client{n}",
+                status=statuses[n],
+                source=rnd.choice(SOURCES),
+            )
+            for n in range(counts['leads'])
+        )
+        _bulk(Lead, leads, log, 'лиды')
+    lead_ids = list(Lead.objects.order_by('id').values_list('id', flat=True))
+
+    log(f"💬 Сообщения: {counts['messages']}")
+    # Переписка неравномерная: у немногих лидов длинные чаты
+    weights = [rnd.paretovariate(1.2) for _ in lead_ids]
+    with _clock(year_ago, timedelta(days=365) / counts['messages']):
+        messages = (
+            ChatMessage(
+                lead_id=lead_id,
+                text=' '.join(rnd.choices(WORDS, k=rnd.randint(2, 12))),
+                msg_type='text' if rnd.random() < 0.9 else rnd.choice(['image', 'voice']),
+                is_from_manager=rnd.random() < 0.4,
+            )
+            for lead_id in rnd.choices(lead_ids, weights=weights, k=counts['messages'])
+        )
+        _bulk(ChatMessage, messages, log, 'сообщения')
+    call_command('backfill_last_messages', stdout=io.StringIO())
+
+    log(f"🎓 Студенты: {counts['students']}, год уроков, отметок и оплат")
+    won = list(Lead.objects.filter(status=LeadStatus.WON).values_list('id', flat=True)[:counts['students']])
+    groups_count = max(1, counts['students'] // GROUP_SIZE)
+    teachers = Teacher.objects.bulk_create([
+        Teacher(full_name=f"Преподаватель {n}", phone=_phone(900_000 + n)) for n in range(max(1, groups_count // 4))
+    ])
+    groups = Group.objects.bulk_create([
+        Group(name=f"Группа {n}", level=f"HSK{n % 6 + 1}", teacher=teachers[n % len(teachers)],
+              days_description='Пн/Чт', start_date=year_ago.date())
+        for n in range(groups_count)
+    ])
+    tariffs = Tariff.objects.bulk_create([
+        Tariff(name='8 уроков', price=400_000, lessons_count=8),
+        Tariff(name='16 уроков', price=750_000, lessons_count=16),
+    ])
+    students = Student.objects.bulk_create([
+        Student(
+            full_name=f"Ученик {n}", phone=_phone(500_000 + n), phone_normalized=_phone(500_000 + n),
+            group=groups[n % groups_count], lead_id=won[n] if n < len(won) else None,
+            balance=rnd.randint(0, 16),
+        )
+        for n in range(counts['students'])
+    ], batch_size=BATCH_SIZE)
+
+    members = {}
+    for student in students:
+        members.setdefault(student.group_id, []).append(student.id)
+
+    lesson_days = [year_ago.date() + timedelta(days=d) for d in range(365) if d % 7 in (0, 3)][:52 * LESSONS_PER_WEEK]
+    lessons = [Lesson(group=group, date=day, topic=f"Урок {n}") for group in groups for n, day in enumerate(lesson_days)]
+    _bulk(Lesson, lessons, log, 'уроки')
+    attendance = (
+        Attendance(lesson_id=lesson.id, student_id=student_id,
+                   status=rnd.choices(['present', 'absent', 'excused'], weights=[85, 10, 5])[0])
+        for lesson in lessons
+        for student_id in members.get(lesson.group_id, [])
+    )
+    _bulk(Attendance, attendance, log, 'отметки')
+
+    payments = (
+        Payment(student_id=student.id, group_id=student.group_id, tariff=tariff, amount=tariff.price,
+                date=year_ago + timedelta(days=30 * month + rnd.randint(0, 5)))
+        for student in students
+        for month in range(12)
+        for tariff in [rnd.choice(tariffs)]
+    )
+    _bulk(Payment, payments, log, 'оплаты')
+
+    log("🔎 Индекс поиска, сводки аналитики, статистика планировщика...")
+    search.install(connection)
+    search.rebuild()
+    analytics.rebuild()
+    unread.reconcile()
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    return {model.__name__: model.objects.count() for model in (
+        Lead, ChatMessage, Student, Group, Lesson, Attendance, Payment,
+    )}
+
+
+# --- ИЗМЕРЕНИЯ ---
+
+def percentile(values, p):
+    """Перцентиль по ближайшему рангу: p95 - значение, которое не превышают 95% замеров."""
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * p // 100))  # ceil
+    return ordered[int(rank) - 1]
+
+
+class QueryCounter:
+    """
+    execute_wrapper для соединения другого потока: CaptureQueriesContext
+    видит только соединение потока, в котором запущен замер.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def wrap(self, target):
+        """target, который выполняет свои запросы под этим счетчиком."""
+        def run(*args, **kwargs):
+            with connection.execute_wrapper(self):
+                return target(*args, **kwargs)
+        return run
+
+
+def measure(action, iterations, warmup=2):
+    """
+    Гоняет action iterations раз. Возвращает перцентили (мс) и число запросов.
+    Если у action есть QueryCounter в action.queries (запросы из других
+    потоков), они прибавляются к запросам основного потока.
+    """
+    for _ in range(warmup):
+        action()
+
+    other_threads = getattr(action, 'queries', None)
+    timings, queries = [], []
+    for _ in range(iterations):
+        before = other_threads.count if other_threads else 0
+        with CaptureQueriesContext(connection) as captured:
+            started = time.perf_counter()
+            action()
+            timings.append((time.perf_counter() - started) * 1000)
+        after = other_threads.count if other_threads else 0
+        queries.append(len(captured.captured_queries) + after - before)
+
+    return {
+        'iterations': iterations,
+        'mean_ms': round(statistics.fmean(timings), 3),
+        'p50_ms': round(percentile(timings, 50), 3),
+        'p90_ms': round(percentile(timings, 90), 3),
+        'p95_ms': round(percentile(timings, 95), 3),
+        'p99_ms': round(percentile(timings, 99), 3),
+        'max_ms': round(max(timings), 3),
+        'queries': int(statistics.median(queries)),
+        'queries_max': max(queries),
+    }
+
+
+class Scenarios:
+    """Сценарии прогона: имя -> функция без аргументов, одна итерация."""
+
+    AJAX = {'HTTP_X_REQUESTED_WITH': 'XMLHttpRequest'}
+
+    def __init__(self, rnd=None, import_rows=1000):
+        self.rnd = rnd or random.Random(1)
+        self.import_rows = import_rows
+        self.client = Client()
+        user, created = User.objects.get_or_create(username='benchmark', defaults={'is_staff': True, 'is_superuser': True})
+        if created:
+            user.set_unusable_password()
+            user.save()
+        self.client.force_login(user)
+
+        self.lead_ids = list(Lead.objects.order_by('-last_msg_time').values_list('id', flat=True)[:1000])
+        # Самый длинный чат: у него точно есть что подгружать в истории
+        self.busy_lead = Lead.objects.annotate(messages_count=Count('messages')).order_by('-messages_count').first()
+        self._imported = itertools.count()
+
+    def all(self):
+        scenarios = {
+            'chat_dashboard.html': self.chat_html,
+            'chat_dashboard.ajax_full': self.chat_ajax,
+            'chat_dashboard.ajax_delta': self.chat_delta,
+            'chat_dashboard.history_page': self.chat_history,
+            'chat_dashboard.sidebar_page': self.sidebar_page,
+            'api_get_unread': self.unread,
+            'api_search': self.search,
+            'import_leads': self.import_leads,
+            'bot.text_update': self.bot_text,
+            # Всплеск входящих: по транзакции на сообщение и пачками MessageWriter
+            'bot.ingest_burst': self.bot_burst(batch_size=0),
+            'bot.ingest_burst_batched': self.bot_burst(batch_size=100),
+        }
+        for model in ('lead', 'student', 'payment', 'lesson', 'group', 'task', 'broadcast'):
+            scenarios[f'admin.{model}.changelist'] = self.changelist(model)
+        scenarios['admin.lead.changelist_search'] = self.changelist('lead', q='hsk3')
+        return scenarios
+
+    def _lead_id(self):
+        return self.rnd.choice(self.lead_ids) if self.lead_ids else 0
+
+    def _get(self, url, data=None, ajax=False, **extra):
+        if ajax:
+            extra.update(self.AJAX)
+        response = self.client.get(url, data, **extra)
+        if response.status_code >= 400:
+            raise RuntimeError(f"{url}: HTTP {response.status_code}")
+        if getattr(response, 'streaming', False):
+            b''.join(response.streaming_content)
+        return response
+
+    def chat_html(self):
+        self._get(reverse('chat_dashboard', args=[self._lead_id()]))
+
+    def chat_ajax(self):
+        self._get(reverse('chat_dashboard', args=[self._lead_id()]), ajax=True)
+
+    def chat_delta(self):
+        url = reverse('chat_dashboard', args=[self.busy_lead.id])
+        if not hasattr(self, '_delta_params'):
+            full = self._get(url, ajax=True).json()
+            self._delta_params = {'since': full['cursor'], 'ts': full['ts']}
+        self._get(url, self._delta_params, ajax=True)
+
+    def chat_history(self):
+        url = reverse('chat_dashboard', args=[self.busy_lead.id])
+        if not hasattr(self, '_older'):
+            self._older = self._get(url, ajax=True).json().get('older')
+        if not self._older:
+            raise ScenarioSkipped(f"в самом длинном чате не больше {settings.CHAT_PAGE_SIZE} сообщений")
+        self._get(url, {'before': self._older}, ajax=True)
+
+    def sidebar_page(self):
+        url = reverse('chat_index')
+        if not hasattr(self, '_after'):
+            self._after = self._get(url, ajax=True).json().get('next')
+        if self._after:
+            self._get(url, {'after': self._after}, ajax=True)
+
+    def unread(self):
+        self._get(reverse('api_unread_count'), ajax=True)
+
+    def search(self):
+        self._get(reverse('api_search'), {'q': self.rnd.choice(WORDS)})
+
+    def changelist(self, model, **params):
+        url = reverse(f'admin:core_{model}_changelist')
+        return lambda: self._get(url, params)
+
+    def import_leads(self):
+        """Импорт CSV из import_rows новых лидов (телефоны не повторяются между итерациями)."""
+        run = next(self._imported)
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', encoding='utf-8', newline='', delete=False) as f:
+            writer = csv.writer(f, delimiter=';')
+            writer.writerows([[], ['No', 'Name', 'Tel', '', 'Level']])
+            for n in range(self.import_rows):
+                writer.writerow([n, f"Импорт {run}-{n}", f"93{run:03d}{n:04d}", '', 'HSK1'])
+        try:
+            call_command('import_leads', f.name, stdout=io.StringIO())
+        finally:
+            os.unlink(f.name)
+
+    def bot_text(self):
+        """Текстовый апдейт от Telegram: в основном от известных лидов, иногда от новых."""
+        from .ingest import MediaPipeline
+        from . import bot as telegram
+        from .testing import FakeSession, FakeTelegramBot, make_message
+
+        if not hasattr(self, '_pipeline'):
+            self._pipeline = MediaPipeline(FakeTelegramBot(), workers=1, session=FakeSession())
+            self._new_users = itertools.count(TELEGRAM_ID_BASE * 2)
+            self._lead_count = Lead.objects.count()
+        if self.rnd.random() < 0.8:
+            user_id = TELEGRAM_ID_BASE + self.rnd.randrange(self._lead_count)
+        else:
+            user_id = next(self._new_users)
+        with mock.patch.object(telegram, 'pipeline', self._pipeline):
+            telegram.handle_text(make_message(user_id=user_id, text=' '.join(self.rnd.choices(WORDS, k=5))))
+
+    def bot_burst(self, batch_size):
+        """INGEST_BURST текстовых апдейтов подряд; замер заканчивается, когда все они в базе."""
+        from .ingest import MediaPipeline
+        from . import bot as telegram
+        from .testing import FakeSession, FakeTelegramBot, make_message
+
+        def action():
+            lead_count = max(Lead.objects.count(), 1)
+            pipeline = MediaPipeline(FakeTelegramBot(), workers=1, session=FakeSession(), batch_size=batch_size)
+            # Пакетные INSERT идут из потока MessageWriter - их тоже считаем
+            if pipeline.writer:
+                pipeline.writer._run = action.queries.wrap(pipeline.writer._run)
+            pipeline.start()
+            with mock.patch.object(telegram, 'pipeline', pipeline):
+                for _ in range(INGEST_BURST):
+                    user_id = TELEGRAM_ID_BASE + self.rnd.randrange(lead_count)
+                    telegram.handle_text(make_message(user_id=user_id, text=' '.join(self.rnd.choices(WORDS, k=5))))
+            pipeline.stop()
+        action.queries = QueryCounter()
+        return action
+
+
+def run(names=None, iterations=50, import_iterations=3, import_rows=1000, log=print):
+    """Прогоняет сценарии (все или names) и возвращает результаты в виде, пригодном для JSON."""
+    if not is_seeded():
+        raise ValueError('База не наполнена benchmark --seed - сценарии пишут в базу, на рабочей их не гоняют')
+    meta = metadata()
+    scenarios = Scenarios(import_rows=import_rows)
+    available = scenarios.all()
+    unknown = set(names or ()) - set(available)
+    if unknown:
+        raise ValueError(f"Неизвестные сценарии: {', '.join(sorted(unknown))}")
+
+    # Пакетные сценарии: долгие, поэтому меньше замеров; считаем строки в секунду
+    bulk = {'import_leads': import_rows, 'bot.ingest_burst': INGEST_BURST, 'bot.ingest_burst_batched': INGEST_BURST}
+    results = {}
+    for name, action in available.items():
+        if names and name not in names:
+            continue
+        count = import_iterations if name in bulk else iterations
+        warmup = 0 if name in bulk else 2
+        try:
+            results[name] = result = measure(action, count, warmup)
+        except ScenarioSkipped as e:
+            log(f"   {name:40} пропущен: {e}")
+            continue
+        if name in bulk:
+            result['rows_per_sec'] = round(bulk[name] / (result['p50_ms'] / 1000))
+        log(f"   {name:40} p50 {result['p50_ms']:8.2f} мс   p95 {result['p95_ms']:8.2f} мс   "
+            f"запросов {result['queries']}")
+
+    return {'meta': meta, 'results': results}
+
+
+def metadata():
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=settings.BASE_DIR, timeout=5,
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = ''
+    return {
+        'timestamp': timezone.now().isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'rows': {model.__name__: model.objects.count() for model in (Lead, ChatMessage, Student, Attendance, Payment)},
+    }
+
+
+# --- СРАВНЕНИЕ ---
+
+def compare(baseline, current, threshold=1.25, noise_ms=1.0):
+    """
+    Регрессии текущего прогона относительно базового: p95 выросла больше чем
+    в threshold раз (и больше чем на noise_ms - шум коротких сценариев не в счет)
+    или сценарий стал делать больше запросов. Возвращает список строк-описаний.
+    """
+    problems = []
+    for name, new in current['results'].items():
+        old = baseline['results'].get(name)
+        if not old:
+            continue
+        if new['p95_ms'] > old['p95_ms'] * threshold and new['p95_ms'] - old['p95_ms'] > noise_ms:
+            problems.append(f"{name}: p95 {old['p95_ms']:.2f} → {new['p95_ms']:.2f} мс")
+        if new['queries'] > old['queries']:
+            problems.append(f"{name}: запросов {old['queries']} → {new['queries']}")
+    return problems
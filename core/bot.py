@@ -0,0 +1,143 @@
+"""
+Хендлеры Telegram-бота.
+
+Одни и те же функции обслуживают оба режима приема: long polling
+(manage.py runbot) и webhook (core/webhook.py). make_bot() собирает
+TeleBot с зарегистрированными хендлерами, а конвейер медиа pipeline
+запускает тот режим, который принимает апдейты в этом процессе.
+"""
+import functools
+import logging
+import time
+
+import telebot
+from decouple import config
+
+from . import metrics
+from .lead_cache import lead_cache
+from .metrics import log_event
+from .models import Lead, LeadStatus
+
+logger = logging.getLogger('core.bot')
+
+# Медиа качается в фоне, текст пишется сразу (см. core/ingest.py).
+# MediaPipeline подставляют runbot или webhook при запуске
+pipeline = None
+
+
+def make_bot(threaded=True, token=None):
+    """
+    Бот с хендлерами. threaded=False - хендлеры выполняются прямо в
+    process_new_updates (так webhook знает, когда апдейт обработан).
+    token по умолчанию - TELEGRAM_BOT_TOKEN из окружения.
+    """
+    bot = telebot.TeleBot(token or config('TELEGRAM_BOT_TOKEN'), threaded=threaded)
+    bot.register_message_handler(handle_text, content_types=['text'])
+    bot.register_message_handler(handle_photo, content_types=['photo'])
+    bot.register_message_handler(handle_voice, content_types=['voice'])
+    return bot
+
+
+# --- МЕТРИКИ ХЕНДЛЕРОВ ---
+def instrumented(content_type):
+    """Считает апдейты, их задержку, время и ошибки хендлера (см. core/metrics.py)."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(message):
+            now = time.time()
+            metrics.UPDATES.inc(content_type=content_type)
+            metrics.LAST_UPDATE.set(now)
+            # date - когда клиент отправил сообщение (unix-время, с точностью до секунды)
+            if getattr(message, 'date', None):
+                metrics.UPDATE_LAG.observe(max(now - message.date, 0), content_type=content_type)
+            try:
+                with metrics.HANDLER_SECONDS.time(content_type=content_type):
+                    return handler(message)
+            except Exception:
+                metrics.HANDLER_ERRORS.inc(content_type=content_type)
+                log_event(
+                    logger, 'handler_error', level='exception',
+                    content_type=content_type, telegram_id=message.from_user.id,
+                )
+                raise
+        return wrapper
+    return decorator
+
+
+# --- ВСПОМОГАТЕЛЬНАЯ ФУНКЦИЯ ПОИСКА ЛИДА ---
+@metrics.DB_WRITE_SECONDS.time(operation='lead')
+def get_or_create_lead(message, mark_unread=None):
+    """
+    Лид автора сообщения. Если конвейер пишет сообщения пачками, статус
+    'Новый' поставит MessageWriter в одной транзакции с самим сообщением.
+    """
+    if mark_unread is None:
+        mark_unread = pipeline is None or pipeline.writer is None
+    user_id = str(message.from_user.id)
+
+    # Частые собеседники: без загрузки лида, только условный UPDATE статуса.
+    # Лида могли удалить в другом процессе (админка) - это всплывет ошибкой
+    # внешнего ключа при записи сообщения, и тогда поможет relink_lead
+    cached = lead_cache.get(user_id)
+    if cached:
+        if mark_unread:
+            Lead.mark_unread(cached.id)
+        return lead_cache.set(user_id, cached._replace(status=LeadStatus.NEW)).as_lead()
+
+    username = message.from_user.username or "Anon"
+    first_name = message.from_user.first_name or "Client"
+    
+    lead, created = Lead.objects.get_or_create(
+        telegram_id=user_id,
+        defaults={
+            'first_name': first_name,
+            'telegram_username': username,
+            'source': 'Telegram',
+            'status': LeadStatus.NEW
+        }
+    )
+    # Если лид был старый, обновляем статус, что он снова написал
+    if not created and lead.status != LeadStatus.NEW:
+        if mark_unread:
+            Lead.mark_unread(lead.id) # Помечаем как непрочитанное
+        lead.status = LeadStatus.NEW
+
+    lead_cache.set(user_id, lead)
+    return lead
+
+
+def relink_lead(message):
+    """Лид из кэша удален в другом процессе: сбрасываем запись и ищем (создаем) его заново."""
+    lead_cache.invalidate(str(message.from_user.id))
+    return get_or_create_lead(message)
+
+
+# --- 1. ОБРАБОТКА ТЕКСТА ---
+@instrumented('text')
+def handle_text(message):
+    lead = get_or_create_lead(message)
+    pipeline.save_message(lead, text=message.text, relink=functools.partial(relink_lead, message))
+    log_event(logger, 'message', content_type='text', lead=lead.id, telegram_message_id=message.message_id)
+
+
+# --- 2. ОБРАБОТКА ФОТО ---
+@instrumented('photo')
+def handle_photo(message):
+    lead = get_or_create_lead(message)
+    msg = pipeline.save_message(
+        lead, text=message.caption or "", msg_type='image', relink=functools.partial(relink_lead, message),
+    )
+
+    # Берем самое большое фото из доступных размеров, качаем в фоне
+    pipeline.submit(msg, message.photo[-1].file_id, f"photo_{message.message_id}.jpg")
+    log_event(logger, 'message', content_type='photo', lead=lead.id, telegram_message_id=message.message_id)
+
+
+# --- 3. ОБРАБОТКА ГОЛОСОВЫХ ---
+@instrumented('voice')
+def handle_voice(message):
+    lead = get_or_create_lead(message)
+    msg = pipeline.save_message(lead, msg_type='voice', relink=functools.partial(relink_lead, message))
+
+    pipeline.submit(msg, message.voice.file_id, f"voice_{message.message_id}.ogg")
+    log_event(logger, 'message', content_type='voice', lead=lead.id, telegram_message_id=message.message_id)
@@ -0,0 +1,190 @@
+"""
+Массовые рассылки через бота.
+
+start() один раз раскладывает сегмент (лиды по статусу/источнику или
+студенты группы) в таблицу BroadcastRecipient - по строке на получателя.
+Дальше BroadcastSender (тот же Outbox, что отправляет ответы менеджеров)
+разбирает эти строки в OutboxWorker: с общим лимитом Telegram, повторами
+и lease. Все состояние в базе, поэтому после падения процесса рассылка
+продолжается с того же места, а уже получившим второй раз не пишет.
+
+Ответы менеджеров идут первыми: за один круг рассылка берет не больше
+секунды лимита, так что 50 000 получателей займут около 28 минут
+(при 30 сообщениях в секунду), но живой диалог ждет не дольше секунды.
+"""
+import heapq
+import logging
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from .media import is_image
+from .metrics import log_event
+from .models import Broadcast, BroadcastRecipient, BroadcastStatus, DeliveryStatus, Lead, Student
+from .outbox import PENDING_STATUSES, Outbox
+
+logger = logging.getLogger('core.outbox')
+
+
+def messageable_leads():
+    """Лиды, которым бот может написать: без заявок с сайта и импорта (у них нет чата)."""
+    return (
+        Lead.objects.exclude(telegram_id='')
+        .exclude(telegram_id__startswith='web_')
+        .exclude(telegram_id__startswith='import_')
+    )
+
+
+def segment(broadcast):
+    """Лиды - получатели рассылки. Студентам пишем через их лид."""
+    leads = messageable_leads()
+    if broadcast.audience == 'students':
+        students = Student.objects.filter(lead__isnull=False)
+        if broadcast.group_id:
+            students = students.filter(group_id=broadcast.group_id)
+        if broadcast.student_status:
+            students = students.filter(student_status=broadcast.student_status)
+        return leads.filter(id__in=students.values('lead_id'))
+
+    if broadcast.lead_status:
+        leads = leads.filter(status=broadcast.lead_status)
+    if broadcast.lead_source:
+        leads = leads.filter(source=broadcast.lead_source)
+    return leads
+
+
+def start(broadcast, batch_size=1000):
+    """
+    Раскладывает сегмент по получателям и запускает рассылку. Повторный
+    вызов досоздает только новых получателей (unique broadcast+lead).
+    """
+    lead_ids = iter(segment(broadcast).order_by('id').values_list('id', flat=True))
+    while chunk := list(islice(lead_ids, batch_size)):
+        with transaction.atomic():
+            BroadcastRecipient.objects.bulk_create(
+                [BroadcastRecipient(broadcast=broadcast, lead_id=lead_id) for lead_id in chunk],
+                ignore_conflicts=True,
+            )
+
+    broadcast.total = broadcast.recipients.count()
+    broadcast.status = BroadcastStatus.RUNNING
+    broadcast.started_at = broadcast.started_at or timezone.now()
+    broadcast.finished_at = None
+    broadcast.save(update_fields=['total', 'status', 'started_at', 'finished_at'])
+    return broadcast.total
+
+
+def pause(broadcast):
+    return Broadcast.objects.filter(pk=broadcast.pk, status=BroadcastStatus.RUNNING).update(status=BroadcastStatus.PAUSED)
+
+
+def resume(broadcast):
+    return Broadcast.objects.filter(pk=broadcast.pk, status=BroadcastStatus.PAUSED).update(status=BroadcastStatus.RUNNING)
+
+
+def estimate_seconds(count):
+    """Сколько займет отправка count сообщений при общем лимите Telegram."""
+    return count / getattr(settings, 'OUTBOX_RATE_PER_SECOND', 30)
+
+
+def with_progress(queryset):
+    """Рассылки со счетчиками sent_count/failed_count - для списка без запроса на строку."""
+    return queryset.annotate(
+        sent_count=Count('recipients', filter=Q(recipients__delivery_status=DeliveryStatus.SENT)),
+        failed_count=Count('recipients', filter=Q(recipients__delivery_status=DeliveryStatus.FAILED)),
+    )
+
+
+def progress(broadcast):
+    """
+    Счетчики по статусам (из with_progress или одним GROUP BY по индексу),
+    фактическая скорость и оценка оставшегося времени.
+    """
+    if hasattr(broadcast, 'sent_count'):
+        sent, failed = broadcast.sent_count, broadcast.failed_count
+    else:
+        counts = dict(
+            broadcast.recipients.order_by().values_list('delivery_status').annotate(n=Count('id'))
+        )
+        sent = counts.get(DeliveryStatus.SENT, 0)
+        failed = counts.get(DeliveryStatus.FAILED, 0)
+    done = sent + failed
+    remaining = max(broadcast.total - done, 0)
+
+    rate = 0
+    if broadcast.started_at and done:
+        elapsed = ((broadcast.finished_at or timezone.now()) - broadcast.started_at).total_seconds()
+        rate = done / max(elapsed, 1)
+
+    return {
+        'total': broadcast.total,
+        'sent': sent,
+        'failed': failed,
+        'remaining': remaining,
+        'rate': rate,
+        'eta': remaining / rate if rate else estimate_seconds(remaining),
+    }
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds} сек"
+    hours, minutes = divmod(seconds // 60, 60)
+    return f"{hours} ч {minutes} мин" if hours else f"{minutes} мин"
+
+
+class BroadcastSender(Outbox):
+    """Outbox над получателями запущенных рассылок."""
+    model = BroadcastRecipient
+
+    def pending(self, limit=None):
+        """
+        Получатели, которым пора писать, по запущенным рассылкам в порядке
+        создания. Ждущие повтора не занимают место в порции.
+        """
+        limit = limit or self.limiter.per_second
+        now = timezone.now()
+        due = Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now)
+        running = Broadcast.objects.filter(status=BroadcastStatus.RUNNING).order_by('id')
+
+        recipients = []
+        for broadcast in running:
+            queries = [
+                broadcast.recipients.select_related('lead').filter(due, delivery_status=status).order_by('id')[:limit]
+                for status in PENDING_STATUSES
+            ]
+            batch = list(heapq.merge(*queries, key=lambda r: r.id))[:limit - len(recipients)]
+            for recipient in batch:
+                recipient.broadcast = broadcast
+            recipients += batch
+            if len(recipients) >= limit:
+                break
+        return recipients
+
+    def run_once(self, limit=None):
+        sent = super().run_once(limit)
+        self.finish_completed()
+        return sent
+
+    def send(self, recipient):
+        broadcast = recipient.broadcast
+        attachment = broadcast.attachment or None
+        name = attachment.name if attachment else ''
+        return self.send_to(self.chat_id(recipient), broadcast.text, attachment, is_image(name))
+
+    def finish_completed(self):
+        """Закрывает рассылки, в которых не осталось неотправленных."""
+        for broadcast in Broadcast.objects.filter(status=BroadcastStatus.RUNNING):
+            if not broadcast.recipients.filter(delivery_status__in=PENDING_STATUSES).exists():
+                Broadcast.objects.filter(pk=broadcast.pk, status=BroadcastStatus.RUNNING).update(
+                    status=BroadcastStatus.DONE, finished_at=timezone.now(),
+                )
+                log_event(logger, 'broadcast_done', id=broadcast.pk, title=broadcast.title)
+
+    def _publish(self, recipient):
+        # Вкладкам чата доставка рассылки неинтересна
+        pass
@@ -0,0 +1,6 @@
+from . import events
+
+
+def live_updates(request):
+    """Шаблоны админки выбирают способ live update: SSE под ASGI, иначе опрос."""
+    return {'chat_events_push': events.push_supported(request)}
@@ -0,0 +1,173 @@
+"""
+Push-уведомления для открытых вкладок менеджеров (SSE).
+
+Модели публикуют события через publish(), а представление chat_events
+раздает их подписчикам. По умолчанию используется InProcessBroker -
+pub/sub внутри одного процесса. Брокер меняется настройкой
+CHAT_EVENTS_BROKER (путь к классу с методами publish/listen).
+
+Поток SSE работает только под ASGI (uvicorn/daphne с config.asgi). Под WSGI
+Django дочитывает асинхронный ответ до конца перед отправкой, и бесконечный
+поток не дошел бы до браузера, заняв воркер навсегда. Поэтому вкладки открывают
+EventSource, только если push_supported(request), иначе опрашивают сервер.
+"""
+import asyncio
+import threading
+import time
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils.module_loading import import_string
+
+
+class _Subscription:
+    def __init__(self, loop, maxsize):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=maxsize)
+
+    def put(self, event):
+        # Вкладка не успевает читать - сбрасываем очередь и просим перечитать все
+        if self.queue.full():
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            event = {'type': 'resync'}
+        self.queue.put_nowait(event)
+
+
+class InProcessBroker:
+    """Простой pub/sub: каждому подписчику своя asyncio-очередь."""
+
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def publish(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            try:
+                sub.loop.call_soon_threadsafe(sub.put, event)
+            except RuntimeError:
+                # Цикл событий уже закрыт - вкладка отключилась
+                self._discard(sub)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    async def listen(self):
+        sub = _Subscription(asyncio.get_running_loop(), self.maxsize)
+        with self._lock:
+            self._subscribers.add(sub)
+        try:
+            while True:
+                yield await sub.queue.get()
+        finally:
+            self._discard(sub)
+
+    def _discard(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+
+class MessageWatcher:
+    """
+    Ловит изменения из других процессов (runbot, админка в другом воркере),
+    которые не могут опубликовать событие в наш брокер: новые сообщения
+    (MAX(id) сообщений) и смену статуса или непрочитанности лидов
+    (MAX(updated_at) лидов, по индексу). Два запроса на процесс раз в interval
+    секунд и только пока есть подписчики - а не запросы на каждую вкладку.
+    """
+
+    def __init__(self, broker, interval):
+        self.broker = broker
+        self.interval = interval
+        self._thread = None
+        self._requested = False
+        self._lock = threading.Lock()
+
+    def ensure_running(self):
+        if not self.interval:
+            return
+        with self._lock:
+            # Вкладка подпишется на брокер чуть позже - поток ее дождется
+            self._requested = True
+            # _thread сброшен - поток уже решил выйти, даже если еще жив
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='chat-events-watcher', daemon=True)
+            self._thread.start()
+
+    def snapshot(self):
+        """(id последнего сообщения, время последнего изменения лида)."""
+        from .models import ChatMessage, Lead
+        last_id = ChatMessage.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+        return last_id, Lead.objects.aggregate(changed=Max('updated_at'))['changed']
+
+    def poll(self, previous):
+        """Публикует то, что поменялось после снимка previous. Возвращает новый снимок."""
+        current = self.snapshot()
+        if current[0] != previous[0]:
+            self.broker.publish({'type': 'message', 'id': current[0]})
+        if current[1] != previous[1]:
+            # Вкладки сами перечитают лидов, измененных после своего ts
+            self.broker.publish({'type': 'lead'})
+        return current
+
+    def _run(self):
+        try:
+            last = self.snapshot()
+            while True:
+                time.sleep(self.interval)
+                if not self._keep_running():
+                    break
+                last = self.poll(last)
+        finally:
+            # У потока свое соединение с БД - закрываем его сами
+            connection.close()
+
+    def _keep_running(self):
+        """
+        Выходить ли потоку. Решение и сброс _thread - под одним замком с
+        ensure_running: вкладка, открытая в момент выхода, запустит новый поток.
+        """
+        with self._lock:
+            if self.broker.subscriber_count() or self._requested:
+                self._requested = False
+                return True
+            self._thread = None
+            return False
+
+
+_broker = None
+_watcher = None
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        path = getattr(settings, 'CHAT_EVENTS_BROKER', 'core.events.InProcessBroker')
+        _broker = import_string(path)()
+    return _broker
+
+
+def get_watcher():
+    global _watcher
+    if _watcher is None:
+        interval = getattr(settings, 'CHAT_EVENTS_WATCH_INTERVAL', 2)
+        _watcher = MessageWatcher(get_broker(), interval)
+    return _watcher
+
+
+def publish(event):
+    """Отправляет событие подписчикам после коммита текущей транзакции."""
+    broker = get_broker()
+    transaction.on_commit(lambda: broker.publish(event))
+
+
+def push_supported(request):
+    """Можно ли держать поток событий: запрос пришел через ASGI-сервер."""
+    return isinstance(request, ASGIRequest)
@@ -0,0 +1,485 @@
+"""
+Конвейер приема сообщений бота.
+
+Текст сообщения сохраняется в потоке polling (или, с batch_size, копится
+в MessageWriter и пишется пачками в одной транзакции), а скачивание медиа
+уходит в ограниченную очередь, которую разбирают несколько рабочих потоков
+с общим пулом HTTP-соединений. Когда очередь заполнена, submit() ждет -
+polling притормаживает, а Telegram придерживает апдейты у себя.
+
+Рабочий поток пишет файл на диск кусками, кладет его в хранилище по хэшу
+содержимого (см. media.py) и там же строит превью для картинок.
+
+В SQLite каждый COMMIT - это fsync, поэтому по одной транзакции на
+сообщение база упирается в несколько сотен сообщений в секунду.
+MessageWriter собирает сообщения из всех хендлеров и пишет их одним
+bulk INSERT (вместе с возвратом лидов в статус 'Новый' и сводкой) раз в batch_size сообщений
+или batch_delay секунд. save_message тогда возвращает PendingMessage -
+wait() дожидается, пока сообщение окажется в базе, а flush() - пока там
+окажется все принятое до вызова. stop() дописывает очередь до конца.
+
+Время записи в базу, скачиваний и ошибки Bot API попадают в метрики
+процесса (core/metrics.py).
+"""
+import logging
+import queue
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import NamedTuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.core.files import File
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import Q
+from telebot.apihelper import ApiTelegramException
+
+from . import events, media, metrics
+from .metrics import log_event
+from .models import ChatMessage, Lead
+
+logger = logging.getLogger('core.bot')
+
+TELEGRAM_FILE_URL = 'https://api.telegram.org/file/bot{token}/{path}'
+
+
+class MediaJob(NamedTuple):
+    message: object  # ChatMessage или PendingMessage, если он еще не записан
+    file_id: str
+    file_name: str
+    content_type: str = 'file'
+
+
+class PendingMessage:
+    """Сообщение в очереди MessageWriter. wait() - подтверждение, что оно в базе."""
+
+    def __init__(self, message=None, relink=None):
+        self.message = message
+        self.relink = relink
+        self.error = None
+        self._done = threading.Event()
+
+    @property
+    def msg_type(self):
+        return self.message.msg_type
+
+    @property
+    def pk(self):
+        """id сообщения, если оно уже записано."""
+        return self.message.pk if self.done() else None
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError('Сообщение еще не записано в базу')
+        if self.error:
+            raise self.error
+        return self.message
+
+    def _resolve(self, error=None):
+        self.error = error
+        self._done.set()
+
+
+class MessageWriter:
+    """
+    Отложенная запись сообщений чата пачками (write-behind) в своем потоке.
+    Пачка уходит в базу, когда набралось batch_size сообщений или первое
+    из них ждет batch_delay секунд, - одной транзакцией с одним fsync.
+    Если пачка не записалась, она переписывается по одному сообщению
+    (если лид сообщения удален, - лиду, которого вернет relink);
+    не записанные попадают в лог и bot_messages_dropped_total.
+    """
+    _STOP = object()
+    _WRITE = object()
+
+    def __init__(self, batch_size=100, batch_delay=0.05, attempts=5):
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.attempts = attempts
+        self.queue = queue.Queue()
+        self._thread = None
+        self._failed = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Дописывает все принятое и гасит поток."""
+        if self._thread:
+            self.queue.put(self._STOP)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def save(self, lead, text='', msg_type='text', relink=None):
+        pending = PendingMessage(ChatMessage(lead=lead, text=text, msg_type=msg_type), relink)
+        self.queue.put(pending)
+        return pending
+
+    def flush(self, timeout=None):
+        """
+        Ждет, пока в базе окажется все, что принято до вызова. Если какая-то
+        пачка с прошлого flush() не записалась - бросает ее ошибку.
+        """
+        barrier = PendingMessage()
+        self.queue.put(barrier)
+        barrier.wait(timeout)
+
+    def write_now(self):
+        """Пишет накопленную пачку, не дожидаясь batch_delay. Не ждет записи."""
+        self.queue.put(self._WRITE)
+
+    def _run(self):
+        batch = []
+        deadline = None
+        try:
+            while True:
+                timeout = max(deadline - time.monotonic(), 0) if batch else None
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = None
+
+                if item is not None and item not in (self._STOP, self._WRITE) and item.message is not None:
+                    batch.append(item)
+                    if len(batch) == 1:
+                        deadline = time.monotonic() + self.batch_delay
+                    if len(batch) < self.batch_size:
+                        continue
+
+                # Пачка набралась, вышло время, flush() или остановка
+                if batch:
+                    try:
+                        self._write(batch)
+                    except Exception as e:
+                        # Поток не должен умирать: за ним очередь всех следующих сообщений
+                        for pending in batch:
+                            if not pending.done():
+                                self._drop(pending, e)
+                    batch = []
+                if item is self._STOP:
+                    return
+                if isinstance(item, PendingMessage) and item.message is None:
+                    item._resolve(self._failed)
+                    self._failed = None
+        finally:
+            connection.close()
+
+    def _write(self, batch):
+        try:
+            self._commit(batch)
+        except OperationalError as e:
+            # База так и не освободилась - по одному будет не лучше
+            for pending in batch:
+                self._drop(pending, e)
+        except Exception as e:
+            if len(batch) == 1:
+                self._retry(batch[0], e)
+                return
+            # Одна плохая строка (например, лид уже удален) не должна утянуть за собой всю пачку
+            log_event(logger, 'message_batch_failed', level='warning', size=len(batch), error=str(e))
+            for pending in batch:
+                self._retry(pending)
+
+    def _retry(self, pending, error=None):
+        """Пишет сообщение отдельно. Если его лид удален в другом процессе - лиду от relink."""
+        try:
+            if error is None:
+                try:
+                    self._commit([pending])
+                    return
+                except Exception as e:
+                    error = e
+            if not isinstance(error, IntegrityError) or pending.relink is None:
+                raise error
+            pending.message.lead = pending.relink()
+            self._commit([pending])
+        except Exception as e:
+            self._drop(pending, e)
+
+    def _commit(self, batch):
+        messages = [pending.message for pending in batch]
+        for attempt in range(self.attempts):
+            try:
+                with metrics.DB_WRITE_SECONDS.time(operation='message_batch'), transaction.atomic():
+                    self._insert(messages)
+                break
+            except Exception as e:
+                for msg in messages:
+                    msg.pk = None
+                # База занята другим процессом - повторяем пачку целиком
+                if not isinstance(e, OperationalError) or attempt == self.attempts - 1:
+                    raise
+                time.sleep(0.05 * 2 ** attempt)
+
+        metrics.WRITE_BATCH_SIZE.observe(len(batch))
+        for pending in batch:
+            pending._resolve()
+            events.publish({'type': 'message', 'lead': pending.message.lead_id, 'id': pending.message.pk})
+
+    def _drop(self, pending, error):
+        """Сообщение не записать: отдаем ошибку ожидающим и следующему flush(), считаем в метрике."""
+        self._failed = error
+        metrics.MESSAGES_DROPPED.inc()
+        log_event(logger, 'message_dropped', level='error', lead=pending.message.lead_id, error=str(error))
+        pending._resolve(error)
+        connection.close_if_unusable_or_obsolete()
+
+    @staticmethod
+    def _insert(messages):
+        """
+        То же, что Lead.mark_unread() и ChatMessage.save() для каждого
+        сообщения, но одним INSERT, одним UPDATE статусов и UPDATE сводки на лид.
+        """
+        ChatMessage.objects.bulk_create(messages)
+        latest = {msg.lead_id: msg for msg in messages}
+        Lead.mark_unread_many(list(latest))
+        for lead_id, msg in latest.items():
+            Lead.objects.filter(
+                Q(last_msg_time__isnull=True) | Q(last_msg_time__lte=msg.created_at), pk=lead_id,
+            ).update(**msg.summary_fields())
+
+
+class IngestStats:
+    """Счетчики конвейера: пропускная способность и глубина очереди."""
+
+    FIELDS = ('received', 'queued', 'downloaded', 'failed', 'bytes', 'blocked')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self._counters = dict.fromkeys(self.FIELDS, 0)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def snapshot(self, queue_depth=0):
+        with self._lock:
+            data = dict(self._counters)
+        elapsed = max(time.monotonic() - self.started_at, 1e-9)
+        data['queue_depth'] = queue_depth
+        data['messages_per_sec'] = round(data['received'] / elapsed, 2)
+        data['downloads_per_sec'] = round(data['downloaded'] / elapsed, 2)
+        return data
+
+
+class MediaPipeline:
+    _STOP = object()
+
+    def __init__(self, bot, workers=4, queue_size=100, session=None, chunk_size=64 * 1024, timeout=30,
+                 batch_size=0, batch_delay=0.05):
+        self.bot = bot
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.session = session or self._make_session(workers)
+        self.stats = IngestStats()
+        self._threads = []
+        self._local = threading.local()
+        # batch_size=0 - каждое сообщение своей транзакцией, сразу
+        self.writer = MessageWriter(batch_size, batch_delay) if batch_size else None
+
+    @staticmethod
+    def _make_session(workers):
+        # Один пул keep-alive соединений на всех рабочих
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    # --- ЖИЗНЕННЫЙ ЦИКЛ ---
+
+    def start(self):
+        if self.writer:
+            self.writer.start()
+        for n in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'media-worker-{n}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Дописывает принятые сообщения, дожидается скачивания всего, что уже в очереди, и гасит потоки."""
+        if self.writer:
+            self.writer.stop(timeout)
+        for _ in self._threads:
+            self.queue.put(self._STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    # --- ПРИЕМ ---
+
+    def save_message(self, lead, text='', msg_type='text', relink=None):
+        """
+        Сохраняет текстовую часть сообщения, не дожидаясь медиа: сразу
+        (возвращает ChatMessage) или в пачке MessageWriter (PendingMessage).
+        relink() вернет лида заново, если этот (из кэша бота) уже удален.
+        """
+        self.stats.incr('received')
+        if self.writer:
+            pending = self.writer.save(lead, text, msg_type, relink)
+            saved = getattr(self._local, 'saved', None)
+            if saved is not None:
+                saved.append(pending)
+            return pending
+        try:
+            with metrics.DB_WRITE_SECONDS.time(operation='message'):
+                return ChatMessage.objects.create(lead=lead, text=text, msg_type=msg_type)
+        except IntegrityError:
+            if relink is None:
+                raise
+            lead = relink()
+        with metrics.DB_WRITE_SECONDS.time(operation='message'):
+            return ChatMessage.objects.create(lead=lead, text=text, msg_type=msg_type)
+
+    @contextmanager
+    def collect(self):
+        """
+        Список PendingMessage, сохраненных этим потоком внутри блока, -
+        чтобы дождаться записи именно их, а не всей очереди.
+        """
+        saved = []
+        self._local.saved = saved
+        try:
+            yield saved
+        finally:
+            self._local.saved = None
+
+    def flush(self, timeout=None):
+        """Ждет, пока принятые сообщения окажутся в базе (без MessageWriter они уже там)."""
+        if self.writer:
+            self.writer.flush(timeout)
+
+    def write_now(self):
+        if self.writer:
+            self.writer.write_now()
+
+    def submit(self, message, file_id, file_name):
+        """
+        Ставит скачивание в очередь. Если очередь полна - ждет (backpressure).
+        Сообщение может быть еще не записано: файл качается параллельно с записью.
+        """
+        job = MediaJob(message, file_id, file_name, message.msg_type)
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            self.stats.incr('blocked')
+            metrics.MEDIA_QUEUE_BLOCKED.inc()
+            self.queue.put(job)
+        self.stats.incr('queued')
+
+    def snapshot(self):
+        return self.stats.snapshot(queue_depth=self.queue.qsize())
+
+    # --- РАБОЧИЕ ПОТОКИ ---
+
+    def _work(self):
+        try:
+            while True:
+                job = self.queue.get()
+                try:
+                    if job is self._STOP:
+                        return
+                    self.process(job)
+                except Exception as e:
+                    self.stats.incr('failed')
+                    metrics.DOWNLOAD_FAILURES.inc(content_type=job.content_type)
+                    log_event(
+                        logger, 'media_download_failed', level='warning',
+                        message_id=job.message.pk, file_name=job.file_name, error=str(e),
+                    )
+                    self._mark_failed(job, e)
+                finally:
+                    self.queue.task_done()
+        finally:
+            # У каждого потока свое соединение с БД
+            connection.close()
+
+    def _mark_failed(self, job, error):
+        """Отмечает у сообщения, что файла не будет, - лента перестанет его ждать."""
+        message_id = job.message.pk
+        if message_id is None:
+            return  # само сообщение не записалось
+        try:
+            ChatMessage.objects.filter(pk=message_id).update(media_error=str(error)[:255] or 'Ошибка загрузки')
+        except Exception as e:
+            log_event(logger, 'media_error_not_saved', level='warning', message_id=message_id, error=str(e))
+            return
+        events.publish({'type': 'media', 'lead': job.message.lead_id, 'id': message_id})
+
+    def process(self, job):
+        # Пишем ответ на диск кусками, а не держим весь файл в памяти
+        with tempfile.TemporaryFile() as tmp:
+            with metrics.DOWNLOAD_SECONDS.time(content_type=job.content_type):
+                size = self._download(job, tmp)
+            metrics.DOWNLOAD_BYTES.observe(size, content_type=job.content_type)
+            msg = self._attach(job, tmp)
+
+        self.stats.incr('downloaded')
+        events.publish({'type': 'media', 'lead': msg.lead_id, 'id': msg.pk})
+        return msg
+
+    def _download(self, job, tmp):
+        try:
+            file_info = self.bot.get_file(job.file_id)
+        except ApiTelegramException as e:
+            metrics.API_ERRORS.inc(method='getFile', code=e.error_code)
+            raise
+        url = TELEGRAM_FILE_URL.format(token=self.bot.token, path=file_info.file_path)
+
+        size = 0
+        with self.session.get(url, stream=True, timeout=self.timeout) as response:
+            if response.status_code >= 400:
+                metrics.API_ERRORS.inc(method='file', code=response.status_code)
+            response.raise_for_status()
+            for chunk in response.iter_content(self.chunk_size):
+                tmp.write(chunk)
+                size += len(chunk)
+                self.stats.incr('bytes', len(chunk))
+        return size
+
+    def _attach(self, job, tmp, attempts=5):
+        # Файл кладем в хранилище один раз, а запись в БД повторяем:
+        # SQLite может быть занят записью из потока polling
+        field = ChatMessage._meta.get_field('attachment')
+        tmp.seek(0)
+        name = field.storage.save(field.generate_filename(None, job.file_name), File(tmp))
+        thumbnail = media.make_thumbnail(name)
+        # Сообщение из пачки MessageWriter могло еще не дойти до базы
+        message = job.message.wait(self.timeout) if isinstance(job.message, PendingMessage) else job.message
+        message_id = message.pk
+
+        for attempt in range(attempts):
+            try:
+                with metrics.DB_WRITE_SECONDS.time(operation='attachment'):
+                    ChatMessage.objects.filter(pk=message_id).update(attachment=name, thumbnail=thumbnail)
+                return ChatMessage.objects.get(pk=message_id)
+            except OperationalError:
+                if attempt == attempts - 1:
+                    raise
+                time.sleep(0.05 * 2 ** attempt)
+
+
+class StatsReporter(threading.Thread):
+    """Периодически пишет в лог сводку конвейера (для тех, у кого нет Prometheus)."""
+
+    def __init__(self, pipeline, interval):
+        super().__init__(name='ingest-stats', daemon=True)
+        self.pipeline = pipeline
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            log_event(logger, 'ingest_stats', **self.pipeline.snapshot())
+
+    def stop(self):
+        self._stop_event.set()
@@ -0,0 +1,72 @@
+"""
+LRU-кэш telegram_id -> (id лида, статус, имя) для хендлеров бота.
+
+Кэш живет внутри процесса. Сохранение или удаление лида в этом же процессе
+сразу сбрасывает запись, а записи, которые могли устареть из-за правок из
+админки (другой процесс), живут не дольше ttl секунд. Удаление лида в другом
+процессе бот замечает лениво: запись сообщения падает на внешнем ключе, и
+relink_lead сбрасывает запись и ищет (или создает) лида заново.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+from . import perf
+
+
+class CachedLead(NamedTuple):
+    id: int
+    status: str
+    first_name: str
+
+    def as_lead(self):
+        """Лид с загруженными только id/first_name/status - save() запишет лишь их."""
+        from .models import Lead
+        return Lead.from_db('default', ['id', 'first_name', 'status'], [self.id, self.first_name, self.status])
+
+
+class LeadCache:
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, telegram_id):
+        with self._lock:
+            item = self._data.get(telegram_id)
+            if item is None or item[1] < time.monotonic():
+                self._data.pop(telegram_id, None)
+                self.misses += 1
+                perf.cache_lookup(False)
+                return None
+            self._data.move_to_end(telegram_id)
+            self.hits += 1
+        perf.cache_lookup(True)
+        return item[0]
+
+    def set(self, telegram_id, lead):
+        entry = CachedLead(lead.id, lead.status, lead.first_name)
+        with self._lock:
+            self._data[telegram_id] = (entry, time.monotonic() + self.ttl)
+            self._data.move_to_end(telegram_id)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return entry
+
+    def invalidate(self, telegram_id):
+        with self._lock:
+            self._data.pop(telegram_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+lead_cache = LeadCache()
@@ -0,0 +1,84 @@
+import re
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Q, Sum
+from django.utils import timezone
+from core.models import (
+    Lead, Student, Lesson, Attendance, Payment, Task, ChatMessage, BroadcastRecipient, DailyStat, TelegramUpdate,
+)
+from core.views import SIDEBAR_ORDER
+
+# Горячие запросы проекта: (название, queryset). Параметры фильтров любые -
+# план от конкретных значений не зависит.
+HOT_QUERIES = [
+    ('api_get_unread: новые лиды', lambda: Lead.objects.filter(status='new').values('pk')),
+    ('chat_dashboard: сайдбар', lambda: Lead.objects.order_by(*SIDEBAR_ORDER)[:50]),
+    ('chat_dashboard: следующая страница сайдбара', lambda: Lead.objects.filter(
+        status='process', last_msg_time__lt=timezone.now()).order_by(*SIDEBAR_ORDER)[:50]),
+    ('chat_dashboard: сайдбар по источнику', lambda: Lead.objects.filter(source='Import').order_by(*SIDEBAR_ORDER)[:50]),
+    ('chat_dashboard: история чата', lambda: ChatMessage.objects.filter(lead_id=1).order_by('-created_at', '-id')[:50]),
+    ('chat_dashboard: новые сообщения', lambda: ChatMessage.objects.filter(id__gt=0).order_by('id')),
+    ('chat_dashboard: измененные лиды', lambda: Lead.objects.filter(updated_at__gt=timezone.now())),
+    ('outbox: очередь отправки', lambda: ChatMessage.objects.select_related('lead').filter(
+        delivery_status='queued').order_by('id')[:500]),
+    ('рассылка: очередь получателей', lambda: BroadcastRecipient.objects.filter(
+        broadcast_id=1, delivery_status='queued').order_by('id')[:30]),
+    ('дашборд: выручка по дням', lambda: DailyStat.objects.filter(
+        metric='revenue_tariff', day__gte=timezone.now().date()).values('day').annotate(n=Sum('total')).order_by('day')),
+    ('webhook: очередь апдейтов', lambda: TelegramUpdate.objects.filter(
+        processed_at__isnull=True).filter(Q(locked_until__isnull=True) | Q(locked_until__lte=timezone.now()))
+        .order_by('update_id')[:100]),
+    ('runbot: лид по telegram_id', lambda: Lead.objects.filter(telegram_id='1')),
+    ('поиск лида по телефону', lambda: Lead.objects.filter(phone_normalized='+998900000000')),
+    ('поиск студента по телефону', lambda: Student.objects.filter(phone_normalized='+998900000000')),
+    ('админка: лиды по статусу', lambda: Lead.objects.filter(status='process').order_by('-created_at')[:100]),
+    ('админка: лиды по дате', lambda: Lead.objects.order_by('-created_at')[:100]),
+    ('Attendance: прогулы студента', lambda: Attendance.objects.filter(student_id=1, status='absent').values('pk')),
+    ('админка: журнал уроков', lambda: Lesson.objects.order_by('-date')[:100]),
+    ('уроки группы', lambda: Lesson.objects.filter(group_id=1).order_by('-date')),
+    ('админка: история оплат', lambda: Payment.objects.order_by('-date')[:100]),
+    ('оплаты студента', lambda: Payment.objects.filter(student_id=1).order_by('-date')),
+    ('админка: задачи', lambda: Task.objects.order_by('status', '-priority')[:100]),
+]
+
+# "SCAN core_lead" без "USING ... INDEX" - полный проход по таблице
+FULL_SCAN = re.compile(r'^SCAN (\w+)$')
+TEMP_SORT = re.compile(r'USE TEMP B-TREE')
+
+
+class Command(BaseCommand):
+    help = 'Проверяет планы (EXPLAIN QUERY PLAN) горячих запросов: падает, если где-то полный скан таблицы'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--strict', action='store_true', help='Считать ошибкой и сортировку во временном B-дереве')
+        parser.add_argument('--verbose-plans', action='store_true', help='Печатать планы целиком')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError(f'Проверка планов написана для SQLite, а база - {connection.vendor}')
+
+        problems = []
+        for name, build in HOT_QUERIES:
+            plan = self.explain(build())
+            bad = [line for line in plan if FULL_SCAN.match(line)]
+            if options['strict']:
+                bad += [line for line in plan if TEMP_SORT.search(line)]
+
+            if bad:
+                problems.append(name)
+                self.stdout.write(self.style.ERROR(f'❌ {name}: {"; ".join(bad)}'))
+            else:
+                self.stdout.write(f'✅ {name}')
+            if options['verbose_plans'] or bad:
+                for line in plan:
+                    self.stdout.write(f'      {line}')
+
+        if problems:
+            raise CommandError(f'Полный скан в {len(problems)} запросах: {", ".join(problems)}')
+        self.stdout.write(self.style.SUCCESS(f'🎉 Все {len(HOT_QUERIES)} запросов идут по индексам'))
+
+    def explain(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            return [row[-1] for row in cursor.fetchall()]
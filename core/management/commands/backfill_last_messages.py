@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db.models import OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Substr
+from core.models import Lead, ChatMessage
+
+
+class Command(BaseCommand):
+    help = 'Заполняет сводку по последнему сообщению у лидов (last_msg_*)'
+
+    def handle(self, *args, **kwargs):
+        self.stdout.write('🔄 Пересчитываем последние сообщения...')
+
+        newest_msg = ChatMessage.objects.filter(lead=OuterRef('pk')).order_by('-created_at', '-id')
+
+        # Один UPDATE на всю таблицу вместо цикла по лидам
+        updated = Lead.objects.update(
+            last_msg_time=Subquery(newest_msg.values('created_at')[:1]),
+            last_msg_text=Coalesce(Substr(Subquery(newest_msg.values('text')[:1]), 1, 255), Value('')),
+            last_msg_type=Coalesce(Subquery(newest_msg.values('msg_type')[:1]), Value('')),
+        )
+
+        self.stdout.write(self.style.SUCCESS(f'🎉 Обновлено лидов: {updated}'))
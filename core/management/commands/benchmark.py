@@ -0,0 +1,59 @@
+import json
+import logging
+import time
+from django.core.management.base import BaseCommand, CommandError
+from core import benchmark
+from core.models import Lead
+
+
+class Command(BaseCommand):
+    help = 'Нагрузочный прогон горячих путей: перцентили задержки и число запросов в JSON (см. core/benchmark.py)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', action='store_true', help='Сначала наполнить пустую базу синтетикой')
+        parser.add_argument('--scale', type=float, default=1.0,
+                            help='Доля от полного набора (100k лидов, 5M сообщений, 10k студентов)')
+        parser.add_argument('--only', nargs='+', metavar='SCENARIO', help='Только эти сценарии')
+        parser.add_argument('--iterations', type=int, default=50, help='Замеров на сценарий')
+        parser.add_argument('--import-rows', type=int, default=1000, help='Строк CSV в одном прогоне import_leads')
+        parser.add_argument('--output', default='benchmark.json', help='Куда записать результаты')
+        parser.add_argument('--compare', metavar='BASELINE', help='JSON прошлого прогона: упасть при регрессии')
+        parser.add_argument('--threshold', type=float, default=1.25, help='Во сколько раз p95 может вырасти')
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            if Lead.objects.exists():
+                raise CommandError('База не пустая - seed гоняют на отдельной базе (DATABASE_PATH=bench.sqlite3)')
+            started = time.monotonic()
+            self.stdout.write(f"🌱 Наполняем базу (масштаб {options['scale']})...")
+            rows = benchmark.seed(options['scale'], log=self.stdout.write)
+            self.stdout.write(self.style.SUCCESS(
+                f"🎉 Готово за {time.monotonic() - started:.0f} сек: "
+                + ', '.join(f'{name} {count}' for name, count in rows.items())
+            ))
+
+        # Строка лога на каждый запрос и сообщение бота только мешает читать вывод
+        logging.getLogger('core.perf').setLevel(logging.WARNING)
+        logging.getLogger('core').setLevel(logging.WARNING)
+        self.stdout.write(f"⏱ Прогон сценариев ({options['iterations']} замеров)...")
+        try:
+            report = benchmark.run(
+                options['only'], iterations=options['iterations'], import_rows=options['import_rows'],
+                log=self.stdout.write,
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        with open(options['output'], 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        self.stdout.write(self.style.SUCCESS(f"📄 Результаты: {options['output']}"))
+
+        if options['compare']:
+            with open(options['compare'], encoding='utf-8') as f:
+                baseline = json.load(f)
+            problems = benchmark.compare(baseline, report, threshold=options['threshold'])
+            for problem in problems:
+                self.stdout.write(self.style.ERROR(f'❌ {problem}'))
+            if problems:
+                raise CommandError(f'Регрессий: {len(problems)} (сравнение с {options["compare"]})')
+            self.stdout.write(self.style.SUCCESS(f'✅ Регрессий нет (сравнение с {options["compare"]})'))
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+from core import broadcast as engine
+from core.models import Broadcast
+
+
+class Command(BaseCommand):
+    help = 'Запуск, пауза и прогресс рассылок (отправляет OutboxWorker в runbot или send_outbox)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('broadcast_id', nargs='?', type=int, help='ID рассылки (без него - все незавершенные)')
+        action = parser.add_mutually_exclusive_group()
+        action.add_argument('--start', action='store_true', help='Разложить сегмент по получателям и запустить')
+        action.add_argument('--pause', action='store_true', help='Приостановить')
+        action.add_argument('--resume', action='store_true', help='Продолжить после паузы')
+
+    def handle(self, *args, **options):
+        if options['broadcast_id'] is None:
+            if options['start'] or options['pause'] or options['resume']:
+                raise CommandError('Укажите ID рассылки')
+            for broadcast in Broadcast.objects.exclude(status='done'):
+                self.report(broadcast)
+            return
+
+        try:
+            broadcast = Broadcast.objects.get(pk=options['broadcast_id'])
+        except Broadcast.DoesNotExist:
+            raise CommandError(f"Рассылки {options['broadcast_id']} нет")
+
+        if options['start']:
+            total = engine.start(broadcast)
+            self.stdout.write(self.style.SUCCESS(
+                f'🚀 Запущена: {total} получателей, ~{engine.format_duration(engine.estimate_seconds(total))}'
+            ))
+        elif options['pause']:
+            engine.pause(broadcast)
+        elif options['resume']:
+            engine.resume(broadcast)
+        broadcast.refresh_from_db()
+        self.report(broadcast)
+
+    def report(self, broadcast):
+        stats = engine.progress(broadcast)
+        self.stdout.write(
+            f"📣 #{broadcast.pk} {broadcast.title} [{broadcast.get_status_display()}]: "
+            f"отправлено {stats['sent']}/{stats['total']}, не доставлено {stats['failed']}, "
+            f"{stats['rate']:.1f} сообщ./сек, осталось ~{engine.format_duration(stats['eta'])}"
+        )
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from core.media import chat_storage, is_hashed, is_image, make_thumbnail
+from core.models import ChatMessage
+
+
+class Command(BaseCommand):
+    help = 'Переносит старые вложения чата в хранилище по хэшу (без повторов) и строит превью картинок'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Только посчитать, ничего не менять')
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        stats = {'moved': 0, 'missing': 0, 'removed': 0, 'thumbnails': 0}
+        old_names = set()
+
+        messages = ChatMessage.objects.exclude(attachment='').exclude(attachment__isnull=True)
+        for msg in messages.only('id', 'attachment', 'thumbnail').iterator(chunk_size=500):
+            name = msg.attachment.name
+
+            if not is_hashed(name):
+                if not chat_storage.exists(name):
+                    stats['missing'] += 1
+                    continue
+                stats['moved'] += 1
+                if dry_run:
+                    continue
+                with chat_storage.open(name) as original:
+                    new_name = chat_storage.save(name, original)
+                ChatMessage.objects.filter(pk=msg.pk).update(attachment=new_name)
+                old_names.add(name)
+                name = new_name
+
+            if not msg.thumbnail and is_image(name) and not dry_run:
+                thumbnail = make_thumbnail(name)
+                if thumbnail:
+                    ChatMessage.objects.filter(pk=msg.pk).update(thumbnail=thumbnail)
+                    stats['thumbnails'] += 1
+
+        # Старые копии удаляем, только когда на них больше никто не ссылается
+        for name in old_names:
+            if not ChatMessage.objects.filter(attachment=name).exists():
+                chat_storage.delete(name)
+                stats['removed'] += 1
+
+        self.stdout.write(self.style.SUCCESS(f'\n🎉 ГОТОВО{" (пробный прогон)" if dry_run else ""}!'))
+        self.stdout.write(f"Перенесено в хранилище по хэшу: {stats['moved']}")
+        self.stdout.write(f"Удалено старых копий: {stats['removed']}")
+        self.stdout.write(f"Построено превью: {stats['thumbnails']}")
+        self.stdout.write(f"Файлов нет на диске: {stats['missing']}")
@@ -1,95 +1,140 @@
 import csv
 import uuid
 import os
+import time
+from itertools import islice
 from django.core.management.base import BaseCommand
+from django.db import transaction
 from core.models import Lead, LeadStatus
+from core.phones import normalize_phone
+from core import analytics, unread
 
 class Command(BaseCommand):
     help = 'Финальный импорт лидов (NSRE)'
 
-    def handle(self, *args, **kwargs):
-        file_path = 'leads.csv'
+    def add_arguments(self, parser):
+        parser.add_argument('file_path', nargs='?', default='leads.csv', help='CSV-файл с лидами')
+        parser.add_argument('--delimiter', default=';', help='Разделитель колонок')
+        parser.add_argument('--encoding', default='utf-8-sig', help='Кодировка файла')
+        # Судя по разведке (check_csv), данные начинаются с 3-й строки:
+        # строка 0 пустая, строка 1 - заголовки
+        parser.add_argument('--skip-rows', type=int, default=2, help='Сколько строк пропустить в начале')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Строк в одной транзакции')
+        parser.add_argument('--dry-run', action='store_true', help='Только посчитать, ничего не записывать')
+
+    def handle(self, *args, **options):
+        file_path = options['file_path']
 
         if not os.path.exists(file_path):
             self.stdout.write(self.style.ERROR(f'❌ Файл {file_path} не найден!'))
             return
 
-        self.stdout.write(f'🚀 Начинаем импорт...')
+        dry_run = options['dry_run']
+        self.stdout.write(f'🚀 Начинаем импорт{" (пробный прогон)" if dry_run else ""}...')
+
+        stats = {'rows': 0, 'new': 0, 'skip': 0, 'duplicate': 0, 'invalid': 0}
+        seen = set()  # телефоны, уже встреченные в этом файле
+        started = time.monotonic()
+
+        with open(file_path, 'r', encoding=options['encoding'], newline='') as file:
+            reader = csv.reader(file, delimiter=options['delimiter'])
 
-        with open(file_path, 'r', encoding='utf-8-sig') as file:
-            # Используем разделитель "точка с запятой", как показала разведка
-            reader = csv.reader(file, delimiter=';')
-            
             # --- ПРОПУСК ЗАГОЛОВКОВ ---
-            # Судя по твоему отчету, данные начинаются с 3-й строки (индекс 2)
-            # Пропускаем строку 0 (пустую) и строку 1 (заголовки)
-            try:
-                next(reader) 
-                next(reader)
-            except StopIteration:
-                self.stdout.write("Файл пустой!")
-                return
-
-            count_new = 0
-            count_skip = 0
-
-            for i, row in enumerate(reader):
-                # Пропускаем пустые строки
-                if not row or len(row) < 3: 
-                    continue
-                
-                try:
-                    # --- ИЗВЛЕЧЕНИЕ ДАННЫХ ---
-                    # [1] = Name
-                    # [2] = Tel number
-                    # [4] = Level (может быть пустым, поэтому используем try/except для индекса)
-                    
-                    name = row[1].strip()
-                    phone_raw = row[2].strip()
-                    
-                    # Безопасно достаем уровень (если колонки нет, будет пустая строка)
-                    level = row[4].strip() if len(row) > 4 else ""
-
-                    # --- ОЧИСТКА ---
-                    # Убираем пробелы из телефона (90 937 -> 90937)
-                    phone = phone_raw.replace(" ", "").replace("-", "")
-                    
-                    # Если имени или телефона нет - пропускаем
-                    if len(phone) < 5:
-                        continue
-                    if not name:
-                        name = "Без имени"
-
-                    # Генерируем ID
-                    fake_id = f"import_{uuid.uuid4().hex[:8]}"
-                    
-                    # Комментарий с уровнем
-                    comment = "Импорт из Excel."
-                    if level:
-                        comment += f"\n📚 Уровень: {level}"
-
-                    # --- ЗАПИСЬ В БАЗУ ---
-                    lead, created = Lead.objects.get_or_create(
-                        phone=phone,
-                        defaults={
-                            'first_name': name,
-                            'telegram_id': fake_id,
-                            'source': 'Import',
-                            'status': LeadStatus.NEW,
-                            'manager_comment': comment
-                        }
-                    )
-
-                    if created:
-                        count_new += 1
-                        self.stdout.write(f"✅ {name} ({level})")
-                    else:
-                        count_skip += 1
-
-                except Exception as e:
-                    self.stdout.write(self.style.WARNING(f"⚠️ Ошибка в строке {i}: {e}"))
-                    continue
+            for _ in range(options['skip_rows']):
+                if next(reader, None) is None:
+                    self.stdout.write("Файл пустой!")
+                    return
+
+            # Читаем файл кусками, не загружая его целиком
+            while True:
+                chunk = list(islice(reader, options['batch_size']))
+                if not chunk:
+                    break
 
+                leads = self.parse_chunk(chunk, stats)
+                self.save_chunk(leads, seen, stats, dry_run)
+
+                elapsed = time.monotonic() - started
+                self.stdout.write(
+                    f"⏳ Обработано строк: {stats['rows']} "
+                    f"({stats['rows'] / max(elapsed, 1e-9):.0f} строк/сек)"
+                )
+
+        elapsed = time.monotonic() - started
         self.stdout.write(self.style.SUCCESS(f'\n🎉 ГОТОВО!'))
-        self.stdout.write(f'Добавлено новых: {count_new}')
-        self.stdout.write(f'Пропущено (уже были): {count_skip}')
\ No newline at end of file
+        self.stdout.write(f"{'Будет добавлено' if dry_run else 'Добавлено новых'}: {stats['new']}")
+        self.stdout.write(f"Пропущено (уже были): {stats['skip']}")
+        self.stdout.write(f"Повторы внутри файла: {stats['duplicate']}")
+        self.stdout.write(f"Пустые/битые строки: {stats['invalid']}")
+        self.stdout.write(f"Время: {elapsed:.1f} сек ({stats['rows'] / max(elapsed, 1e-9):.0f} строк/сек)")
+
+    def parse_chunk(self, chunk, stats):
+        """Превращает строки CSV в несохраненные Lead."""
+        leads = []
+        for row in chunk:
+            stats['rows'] += 1
+
+            # Пропускаем пустые строки
+            if not row or len(row) < 3:
+                stats['invalid'] += 1
+                continue
+
+            # --- ИЗВЛЕЧЕНИЕ ДАННЫХ ---
+            # [1] = Name
+            # [2] = Tel number
+            # [4] = Level (может быть пустым)
+            name = row[1].strip()
+            phone_raw = row[2].strip()
+            level = row[4].strip() if len(row) > 4 else ""
+
+            # --- ОЧИСТКА ---
+            # Убираем пробелы из телефона (90 937 -> 90937)
+            phone = phone_raw.replace(" ", "").replace("-", "")
+
+            # Если телефона нет - пропускаем
+            phone_normalized = normalize_phone(phone)
+            if not phone_normalized:
+                stats['invalid'] += 1
+                continue
+            if not name:
+                name = "Без имени"
+
+            # Комментарий с уровнем
+            comment = "Импорт из Excel."
+            if level:
+                comment += f"\n📚 Уровень: {level}"
+
+            leads.append(Lead(
+                first_name=name,
+                phone=phone,
+                phone_normalized=phone_normalized,
+                telegram_id=f"import_{uuid.uuid4().hex[:16]}",
+                source='Import',
+                status=LeadStatus.NEW,
+                manager_comment=comment,
+            ))
+        return leads
+
+    def save_chunk(self, leads, seen, stats, dry_run):
+        """Один SELECT по индексу phone_normalized и один bulk_create на весь кусок."""
+        phones = {lead.phone_normalized for lead in leads}
+        existing = set(
+            Lead.objects.filter(phone_normalized__in=phones).values_list('phone_normalized', flat=True)
+        )
+
+        to_create = []
+        for lead in leads:
+            if lead.phone_normalized in seen:
+                stats['duplicate'] += 1
+            elif lead.phone_normalized in existing:
+                stats['skip'] += 1
+            else:
+                seen.add(lead.phone_normalized)
+                to_create.append(lead)
+
+        stats['new'] += len(to_create)
+        if to_create and not dry_run:
+            with transaction.atomic():
+                Lead.objects.bulk_create(to_create)
+                unread.adjust(len(to_create))
+                analytics.leads_created(to_create)
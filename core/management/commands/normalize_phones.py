@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from core.models import Lead, Student
+from core.phones import backfill_normalized
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает нормализованные телефоны (phone_normalized) у лидов и студентов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        for model in (Lead, Student):
+            updated = backfill_normalized(model, batch_size=options['batch_size'])
+            self.stdout.write(f'📞 {model._meta.verbose_name_plural}: обновлено {updated}')
+        self.stdout.write(self.style.SUCCESS('🎉 ГОТОВО!'))
@@ -0,0 +1,37 @@
+import logging
+from django.core.management.base import BaseCommand
+from core import bot as telegram
+from core.webhook import Dispatcher, DispatcherWorker, make_pipeline
+
+logger = logging.getLogger('core.bot')
+
+
+class Command(BaseCommand):
+    help = 'Разбирает апдейты, принятые webhook-ом (если TELEGRAM_WEBHOOK_WORKER = False)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Один проход по очереди и выход')
+        parser.add_argument('--workers', type=int, default=4, help='Потоков для скачивания медиа')
+
+    def handle(self, *args, **options):
+        dispatcher = Dispatcher()
+        pipeline = telegram.pipeline = make_pipeline(dispatcher.bot, workers=options['workers'])
+        try:
+            if options['once']:
+                done = dispatcher.run_once()
+                self.stdout.write(self.style.SUCCESS(f'✅ Обработано апдейтов: {done}'))
+                return
+
+            worker = DispatcherWorker(dispatcher)
+            worker.start()
+            self.stdout.write('📥 Разбор апдейтов запущен (Ctrl+C - остановить)...')
+            try:
+                while worker.is_alive():
+                    worker.join(1)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                worker.stop()
+        finally:
+            self.stdout.write('⏳ Дописываем сообщения и докачиваем медиа из очереди...')
+            pipeline.stop()
@@ -0,0 +1,24 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+from core import analytics
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает дневные сводки аналитики (выручка, посещаемость, воронка) по исходным таблицам'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help='Пересчитать только с этой даты (ГГГГ-ММ-ДД), иначе - все')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            since = parse_date(options['since'])
+            if not since:
+                raise CommandError(f"Не понял дату: {options['since']}")
+
+        started = time.monotonic()
+        rows = analytics.rebuild(since)
+        self.stdout.write(self.style.SUCCESS(
+            f'🎉 Сводки пересчитаны: {rows} строк за {time.monotonic() - started:.1f} сек'
+        ))
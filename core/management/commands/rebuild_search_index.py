@@ -0,0 +1,25 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from core import search
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает полнотекстовый индекс сообщений и лидов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recreate', action='store_true', help='Удалить индекс с триггерами и создать заново')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+
+        if options['recreate']:
+            search.uninstall(connection)
+            if not search.install(connection):
+                raise CommandError(f'База {connection.vendor} не поддерживает полнотекстовый индекс')
+        elif search.is_available():
+            search.rebuild()
+        else:
+            raise CommandError('Индекса нет - запустите с --recreate или примените миграции')
+
+        self.stdout.write(self.style.SUCCESS(f'🎉 Индекс поиска пересобран за {time.monotonic() - started:.1f} сек'))
@@ -1,80 +1,76 @@
-import telebot
-import os
-import requests
+import logging
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.core.files.base import ContentFile
-from decouple import config
-from core.models import Lead, LeadStatus, ChatMessage
+from core import bot as telegram, metrics
+from core.ingest import MediaPipeline, StatsReporter
+from core.broadcast import BroadcastSender
+from core.outbox import Outbox, OutboxWorker
+from core.metrics import MetricsServer, log_event
 
-bot = telebot.TeleBot(config('TELEGRAM_BOT_TOKEN'))
+logger = logging.getLogger('core.bot')
 
 class Command(BaseCommand):
-    help = 'Запуск Telegram бота'
+    help = 'Запуск Telegram бота (long polling; webhook-режим - см. core/webhook.py)'
 
-    def handle(self, *args, **kwargs):
-        print("🎧 Бот слушает (Текст, Фото, Голосовые)...")
-        bot.infinity_polling()
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Потоков для скачивания медиа')
+        parser.add_argument('--queue-size', type=int, default=100, help='Размер очереди скачивания')
+        parser.add_argument(
+            '--batch-size', type=int, default=getattr(settings, 'BOT_WRITE_BATCH_SIZE', 100),
+            help='Писать сообщения в базу пачками до N штук, 0 - каждое сразу',
+        )
+        parser.add_argument(
+            '--batch-ms', type=int, default=getattr(settings, 'BOT_WRITE_BATCH_MS', 50),
+            help='Сколько мс первое сообщение пачки может ждать записи',
+        )
+        parser.add_argument('--stats-interval', type=int, default=60, help='Как часто писать сводку конвейера в лог (сек), 0 - не писать')
+        parser.add_argument(
+            '--metrics-port', type=int, default=getattr(settings, 'BOT_METRICS_PORT', 9108),
+            help='Порт /metrics для Prometheus на 127.0.0.1, 0 - не поднимать',
+        )
+        parser.add_argument('--no-outbox', action='store_true', help='Не отправлять очередь ответов и рассылки (их разбирает send_outbox)')
 
-# --- ВСПОМОГАТЕЛЬНАЯ ФУНКЦИЯ ПОИСКА ЛИДА ---
-def get_or_create_lead(message):
-    user_id = str(message.from_user.id)
-    username = message.from_user.username or "Anon"
-    first_name = message.from_user.first_name or "Client"
-    
-    lead, created = Lead.objects.get_or_create(
-        telegram_id=user_id,
-        defaults={
-            'first_name': first_name,
-            'telegram_username': username,
-            'source': 'Telegram',
-            'status': LeadStatus.NEW
-        }
-    )
-    # Если лид был старый, обновляем статус, что он снова написал
-    if not created and lead.status != 'new':
-        lead.status = 'new' # Помечаем как непрочитанное
-        lead.save()
-        
-    return lead
+    def handle(self, *args, **options):
+        bot = telegram.make_bot()
+        # Хендлеры (core/bot.py) берут конвейер из модуля
+        pipeline = telegram.pipeline = MediaPipeline(
+            bot, workers=options['workers'], queue_size=options['queue_size'],
+            batch_size=options['batch_size'], batch_delay=options['batch_ms'] / 1000,
+        )
+        pipeline.start()
+        metrics.MEDIA_QUEUE_DEPTH.func = pipeline.queue.qsize
+        metrics.MEDIA_WORKERS.set(options['workers'])
 
-# --- 1. ОБРАБОТКА ТЕКСТА ---
-@bot.message_handler(content_types=['text'])
-def handle_text(message):
-    lead = get_or_create_lead(message)
-    ChatMessage.objects.create(lead=lead, text=message.text, msg_type='text')
-    print(f"📩 Текст от {lead.first_name}")
+        reporter = None
+        if options['stats_interval']:
+            reporter = StatsReporter(pipeline, options['stats_interval'])
+            reporter.start()
 
-# --- 2. ОБРАБОТКА ФОТО ---
-@bot.message_handler(content_types=['photo'])
-def handle_photo(message):
-    lead = get_or_create_lead(message)
-    
-    # Берем самое большое фото из доступных размеров
-    file_info = bot.get_file(message.photo[-1].file_id)
-    file_url = f'https://api.telegram.org/file/bot{bot.token}/{file_info.file_path}'
-    
-    # Скачиваем
-    response = requests.get(file_url)
-    
-    if response.status_code == 200:
-        msg = ChatMessage(lead=lead, text=message.caption or "", msg_type='image')
-        # Сохраняем файл в Django
-        file_name = f"photo_{message.message_id}.jpg"
-        msg.attachment.save(file_name, ContentFile(response.content), save=True)
-        print(f"📷 Фото от {lead.first_name}")
+        server = None
+        if options['metrics_port']:
+            server = MetricsServer(port=options['metrics_port']).start()
 
-# --- 3. ОБРАБОТКА ГОЛОСОВЫХ ---
-@bot.message_handler(content_types=['voice'])
-def handle_voice(message):
-    lead = get_or_create_lead(message)
-    
-    file_info = bot.get_file(message.voice.file_id)
-    file_url = f'https://api.telegram.org/file/bot{bot.token}/{file_info.file_path}'
-    
-    response = requests.get(file_url)
-    
-    if response.status_code == 200:
-        msg = ChatMessage(lead=lead, msg_type='voice')
-        file_name = f"voice_{message.message_id}.ogg"
-        msg.attachment.save(file_name, ContentFile(response.content), save=True)
-        print(f"🎤 Голосовое от {lead.first_name}")
\ No newline at end of file
+        # Ответы менеджеров из дашборда и рассылки уходят в Telegram отсюда
+        # (см. core/outbox.py и core/broadcast.py) с одним общим лимитом
+        outbox = None
+        if not options['no_outbox']:
+            replies = Outbox(bot)
+            outbox = OutboxWorker(replies, broadcasts=BroadcastSender(bot, limiter=replies.limiter))
+            outbox.start()
+
+        log_event(
+            logger, 'bot_started', workers=options['workers'],
+            metrics=f"http://127.0.0.1:{server.port}/metrics" if server else None,
+        )
+        try:
+            bot.infinity_polling()
+        finally:
+            if reporter:
+                reporter.stop()
+            if outbox:
+                outbox.stop()
+            # Дописываем накопленную пачку сообщений и докачиваем медиа
+            log_event(logger, 'bot_stopping', queue_depth=pipeline.queue.qsize())
+            pipeline.stop()
+            if server:
+                server.stop()
@@ -0,0 +1,38 @@
+import telebot
+from decouple import config
+from django.core.management.base import BaseCommand
+from core.broadcast import BroadcastSender
+from core.outbox import Outbox, OutboxWorker
+
+
+class Command(BaseCommand):
+    help = 'Отправляет в Telegram очередь ответов менеджеров и рассылки (если runbot запущен с --no-outbox)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Один проход по очереди и выход')
+
+    def handle(self, *args, **options):
+        bot = telebot.TeleBot(config('TELEGRAM_BOT_TOKEN'))
+        outbox = Outbox(bot)
+        broadcasts = BroadcastSender(bot, limiter=outbox.limiter)
+
+        if options['once']:
+            sent = outbox.run_once() + broadcasts.run_once()
+            self.stdout.write(self.style.SUCCESS(f'✅ Отправлено: {sent}'))
+            return
+
+        worker = OutboxWorker(outbox, broadcasts=broadcasts)
+        worker.start()
+        self.stdout.write('📤 Очередь отправки запущена (Ctrl+C - остановить)...')
+        try:
+            while worker.is_alive():
+                worker.join(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            worker.stop()
+            for name, sender in (('Ответы', outbox), ('Рассылки', broadcasts)):
+                self.stdout.write(
+                    f"{name}: отправлено {sender.stats['sent']}, повторов {sender.stats['retried']}, "
+                    f"не доставлено {sender.stats['failed']}"
+                )
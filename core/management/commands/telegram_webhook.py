@@ -0,0 +1,34 @@
+from decouple import config
+import telebot
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Регистрирует webhook бота в Telegram (или снимает его, чтобы вернуться к runbot)'
+
+    def add_arguments(self, parser):
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument('--set', metavar='URL', help='Полный https-адрес, например https://crm.example.com/telegram/webhook/')
+        group.add_argument('--delete', action='store_true', help='Снять webhook (long polling снова заработает)')
+
+    def handle(self, *args, **options):
+        bot = telebot.TeleBot(config('TELEGRAM_BOT_TOKEN'))
+
+        if options['set']:
+            if not settings.TELEGRAM_WEBHOOK_SECRET:
+                raise CommandError('Задайте TELEGRAM_WEBHOOK_SECRET - без него представление не примет апдейты')
+            bot.set_webhook(
+                url=options['set'], secret_token=settings.TELEGRAM_WEBHOOK_SECRET,
+                allowed_updates=['message'],
+            )
+            self.stdout.write(self.style.SUCCESS(f"✅ Webhook: {options['set']}"))
+        elif options['delete']:
+            bot.remove_webhook()
+            self.stdout.write(self.style.SUCCESS('✅ Webhook снят'))
+
+        info = bot.get_webhook_info()
+        self.stdout.write(
+            f"URL: {info.url or '—'}, ждут доставки: {info.pending_update_count}, "
+            f"последняя ошибка: {info.last_error_message or '—'}"
+        )
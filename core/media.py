@@ -0,0 +1,140 @@
+"""
+Хранилище вложений чата с дедупликацией по содержимому.
+
+Имя файла - sha256 его содержимого: chat_files/ab/cd/abcd....jpg. Один и тот
+же стикер или фото, присланные сто раз, лежат на диске один раз, а все
+сообщения ссылаются на один и тот же файл.
+
+Для картинок рядом строятся превью (chat_thumbs/ab/cd/<hash>.jpg): лента чата
+грузит их, а оригинал открывается по клику. Превью нужен Pillow - без него
+лента просто показывает оригиналы.
+"""
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import tempfile
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, default_storage
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow не установлен - живем без превью
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_DIR = 'chat_thumbs'
+HASHED_NAME = re.compile(r'/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}(\.\w+)?$')
+
+
+def content_hash(content, chunk_size=64 * 1024):
+    digest = hashlib.sha256()
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    for chunk in content.chunks(chunk_size):
+        digest.update(chunk)
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    return digest.hexdigest()
+
+
+def hashed_name(name, digest):
+    """chat_files/photo_57.JPG + хэш -> chat_files/ab/cd/<хэш>.jpg"""
+    directory = os.path.dirname(name)
+    ext = os.path.splitext(name)[1].lower()
+    return os.path.join(directory, digest[:2], digest[2:4], f'{digest}{ext}')
+
+
+def is_hashed(name):
+    return bool(HASHED_NAME.search(name or ''))
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """FileSystemStorage, который кладет файл под именем из хэша содержимого и не пишет повторы."""
+
+    def get_available_name(self, name, max_length=None):
+        # Имя все равно будет заменено на хэш в _save, а занятое имя - не ошибка, а повтор
+        return name
+
+    def _save(self, name, content):
+        name = hashed_name(name, content_hash(content))
+        if self.exists(name):
+            return name
+
+        # Пишем во временный файл рядом и переименовываем: если тот же файл
+        # одновременно пишет другой поток, os.replace просто положит одинаковое
+        # содержимое поверх, а недописанный файл под хэш-именем не появится никогда
+        full_path = self.path(name)
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                for chunk in content.chunks():
+                    tmp.write(chunk)
+            if self.file_permissions_mode is not None:
+                os.chmod(tmp_path, self.file_permissions_mode)
+            os.replace(tmp_path, full_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return name
+
+
+chat_storage = ContentAddressedStorage()
+
+
+def is_image(name):
+    kind = mimetypes.guess_type(name or '')[0]
+    return bool(kind and kind.startswith('image/'))
+
+
+def thumbnail_name(name):
+    """Превью раскладывается так же, как оригиналы: имя - хэш, значит файл не меняется."""
+    digest = os.path.splitext(os.path.basename(name))[0]
+    return hashed_name(f'{THUMBNAIL_DIR}/{digest}.jpg', digest)
+
+
+def planned_thumbnail(name):
+    """
+    Имя будущего превью без построения (или '', если превью не будет) -
+    файл построит serve_media при первом показе.
+    """
+    if Image is None or not is_image(name):
+        return ''
+    return thumbnail_name(name)
+
+
+def make_thumbnail(name, storage=None):
+    """
+    Строит превью для картинки из хранилища чата. Возвращает имя превью
+    или '' (нет Pillow, файл не картинка или битый).
+    """
+    if Image is None or not is_image(name):
+        return ''
+    storage = storage or chat_storage
+    thumb = thumbnail_name(name)
+    if default_storage.exists(thumb):
+        return thumb
+
+    size = getattr(settings, 'CHAT_THUMBNAIL_SIZE', (320, 320))
+    try:
+        with storage.open(name) as original, Image.open(original) as image:
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail(size)
+            buffer = BytesIO()
+            image.convert('RGB').save(buffer, 'JPEG', quality=80, optimize=True)
+    except (OSError, Image.DecompressionBombError) as e:
+        logger.warning("Не удалось сделать превью %s: %s", name, e)
+        return ''
+
+    saved = default_storage.save(thumb, ContentFile(buffer.getvalue()))
+    if saved != thumb:
+        default_storage.delete(saved)
+    return thumb
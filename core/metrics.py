@@ -0,0 +1,286 @@
+"""
+Метрики процесса бота в формате Prometheus.
+
+Минимальные счетчики, гистограммы и gauge с метками (без внешних
+зависимостей) и HTTP-сервер, который отдает их на /metrics для
+Prometheus/VictoriaMetrics. runbot поднимает его на 127.0.0.1:BOT_METRICS_PORT.
+
+Метрики бота объявлены внизу модуля: их обновляют хендлеры бота (core/bot.py),
+конвейер медиа (core/ingest.py) и очередь отправки (core/outbox.py).
+"""
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Секунды: от 5 мс до минуты
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Задержка апдейта: от полсекунды до часа
+LAG_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 300, 900, 3600)
+# Байты: от 1 КБ до 50 МБ (предел Bot API на скачивание - 20 МБ)
+SIZE_BUCKETS = (1024, 10 * 1024, 100 * 1024, 512 * 1024, 1024 ** 2, 5 * 1024 ** 2, 20 * 1024 ** 2, 50 * 1024 ** 2)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f'{self.name}: ожидались метки {self.label_names}, получены {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield self.name, _labels(self.label_names, key), value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        lines += [f'{name}{labels} {_number(value)}' for name, labels, value in self.samples()]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    """Текущее значение. Если передан func - он вызывается при каждом чтении /metrics."""
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), func=None):
+        super().__init__(name, help, labels)
+        self.func = func
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self.func:
+            yield self.name, '', self.func()
+            return
+        yield from super().samples()
+
+
+class _HistogramValue:
+    __slots__ = ('buckets', 'sum', 'count')
+
+    def __init__(self, size):
+        self.buckets = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                item = self._values[key] = _HistogramValue(len(self.buckets) + 1)
+            item.buckets[index] += 1
+            item.sum += value
+            item.count += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Замеряет блок кода (и при исключении тоже)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get(self, **labels):
+        """(count, sum) для набора меток."""
+        with self._lock:
+            item = self._values.get(self._key(labels))
+            return (item.count, item.sum) if item else (0, 0.0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(
+                (key, list(item.buckets), item.sum, item.count) for key, item in self._values.items()
+            )
+        bounds = self.buckets + (float('inf'),)
+        for key, buckets, total, count in items:
+            cumulative = 0
+            for bound, n in zip(bounds, buckets):
+                cumulative += n
+                yield f'{self.name}_bucket', _labels(self.label_names, key, [('le', _number(bound))]), cumulative
+            yield f'{self.name}_sum', _labels(self.label_names, key), total
+            yield f'{self.name}_count', _labels(self.label_names, key), count
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Метрика {metric.name} уже зарегистрирована')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), func=None):
+        return self.register(Gauge(name, help, labels, func))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus (version 0.0.4)."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+
+# --- HTTP ---
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Prometheus ходит каждые 15 секунд - не засоряем лог
+        pass
+
+
+class MetricsServer:
+    """GET /metrics в отдельном потоке. port=0 - свободный порт (см. .port)."""
+
+    def __init__(self, host='127.0.0.1', port=9108, registry=REGISTRY):
+        handler = type('MetricsHandler', (_MetricsHandler,), {'registry': registry})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='metrics', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+# --- СТРУКТУРНЫЕ ЛОГИ ---
+
+def log_event(logger, event, level='info', **fields):
+    """Строка JSON {'event': ..., поля...}; те же поля - в record.bot для обработчиков логов."""
+    record = dict(event=event, **fields)
+    getattr(logger, level)(json.dumps(record, ensure_ascii=False, default=str), extra={'bot': record})
+
+
+# --- МЕТРИКИ БОТА ---
+
+UPDATES = REGISTRY.counter(
+    'bot_updates_total', 'Принятые апдейты по типу содержимого', ['content_type'],
+)
+HANDLER_ERRORS = REGISTRY.counter(
+    'bot_handler_errors_total', 'Апдейты, на которых хендлер упал', ['content_type'],
+)
+HANDLER_SECONDS = REGISTRY.histogram(
+    'bot_handler_seconds', 'Время обработки апдейта хендлером', ['content_type'],
+)
+UPDATE_LAG = REGISTRY.histogram(
+    'bot_update_lag_seconds', 'Сколько апдейт шел от отправки клиентом до хендлера', ['content_type'],
+    buckets=LAG_BUCKETS,
+)
+LAST_UPDATE = REGISTRY.gauge(
+    'bot_last_update_timestamp_seconds', 'Unix-время последнего апдейта (залипание polling)',
+)
+DB_WRITE_SECONDS = REGISTRY.histogram(
+    'bot_db_write_seconds', 'Время записи в базу', ['operation'],
+)
+MEDIA_QUEUE_DEPTH = REGISTRY.gauge(
+    'bot_media_queue_depth', 'Скачиваний в очереди (runbot подключает очередь конвейера)',
+)
+MEDIA_WORKERS = REGISTRY.gauge(
+    'bot_media_workers', 'Потоков скачивания медиа',
+)
+MEDIA_QUEUE_BLOCKED = REGISTRY.counter(
+    'bot_media_queue_blocked_total', 'Сколько раз polling ждал места в очереди скачивания',
+)
+WRITE_BATCH_SIZE = REGISTRY.histogram(
+    'bot_db_write_batch_size', 'Сообщений в одной транзакции MessageWriter', buckets=(1, 5, 10, 25, 50, 100, 250, 500),
+)
+MESSAGES_DROPPED = REGISTRY.counter(
+    'bot_messages_dropped_total', 'Сообщения, которые MessageWriter не смог записать в базу',
+)
+DOWNLOAD_SECONDS = REGISTRY.histogram(
+    'bot_media_download_seconds', 'Скачивание медиа из Telegram (getFile + файл)', ['content_type'],
+)
+DOWNLOAD_BYTES = REGISTRY.histogram(
+    'bot_media_download_bytes', 'Размер скачанных файлов', ['content_type'], buckets=SIZE_BUCKETS,
+)
+DOWNLOAD_FAILURES = REGISTRY.counter(
+    'bot_media_download_failures_total', 'Не скачанные медиа', ['content_type'],
+)
+API_ERRORS = REGISTRY.counter(
+    'bot_telegram_api_errors_total', 'Ошибки Bot API по методу и коду', ['method', 'code'],
+)
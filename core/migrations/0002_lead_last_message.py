@@ -0,0 +1,32 @@
+# Generated by Django 5.2.8 on 2026-10-17 14:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lead',
+            name='last_msg_text',
+            field=models.CharField(blank=True, editable=False, max_length=255, verbose_name='Текст последнего сообщения'),
+        ),
+        migrations.AddField(
+            model_name='lead',
+            name='last_msg_time',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Последнее сообщение'),
+        ),
+        migrations.AddField(
+            model_name='lead',
+            name='last_msg_type',
+            field=models.CharField(blank=True, editable=False, max_length=10, verbose_name='Тип последнего сообщения'),
+        ),
+        migrations.AddIndex(
+            model_name='lead',
+            index=models.Index(fields=['-status', '-last_msg_time', '-created_at'], name='lead_sidebar_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.8 on 2026-10-17 14:52
+
+from django.db import migrations, models
+
+from core.phones import backfill_normalized
+
+
+def fill_phone_normalized(apps, schema_editor):
+    for model_name in ('Lead', 'Student'):
+        backfill_normalized(apps.get_model('core', model_name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_lead_phone_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lead',
+            name='phone_normalized',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=20, verbose_name='Телефон (E.164)'),
+        ),
+        migrations.AddField(
+            model_name='student',
+            name='phone_normalized',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=20, verbose_name='Телефон (E.164)'),
+        ),
+        migrations.RunPython(fill_phone_normalized, migrations.RunPython.noop),
+    ]
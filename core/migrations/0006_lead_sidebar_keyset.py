@@ -0,0 +1,25 @@
+# Generated by Django 5.2.8 on 2026-10-17 15:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='lead',
+            name='lead_sidebar_idx',
+        ),
+        migrations.AddIndex(
+            model_name='lead',
+            index=models.Index(fields=['-status', '-last_msg_time', '-created_at', '-id'], name='lead_sidebar_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='lead',
+            index=models.Index(fields=['source', '-status', '-last_msg_time', '-created_at', '-id'], name='lead_source_sidebar_idx'),
+        ),
+    ]
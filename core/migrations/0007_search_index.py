@@ -0,0 +1,108 @@
+import logging
+
+from django.db import migrations
+
+logger = logging.getLogger(__name__)
+
+# Схема поиска на момент этой миграции. Намеренно не берется из core.search:
+# правки модуля не должны менять то, что делает уже примененная миграция.
+# Дальнейшие изменения схемы поиска - новыми миграциями.
+
+SQLITE_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS core_chatmessage_fts USING fts5(text, content='core_chatmessage', "
+    "content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    """CREATE TRIGGER IF NOT EXISTS core_chatmessage_fts_ai AFTER INSERT ON core_chatmessage BEGIN
+        INSERT INTO core_chatmessage_fts(rowid, text) VALUES (new.id, new.text);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS core_chatmessage_fts_ad AFTER DELETE ON core_chatmessage BEGIN
+        INSERT INTO core_chatmessage_fts(core_chatmessage_fts, rowid, text) VALUES ('delete', old.id, old.text);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS core_chatmessage_fts_au AFTER UPDATE OF text ON core_chatmessage BEGIN
+        INSERT INTO core_chatmessage_fts(core_chatmessage_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        INSERT INTO core_chatmessage_fts(rowid, text) VALUES (new.id, new.text);
+    END""",
+    "INSERT INTO core_chatmessage_fts(core_chatmessage_fts) VALUES ('rebuild')",
+
+    "CREATE VIRTUAL TABLE IF NOT EXISTS core_lead_fts USING fts5(first_name, last_name, telegram_username, "
+    "phone_normalized, source, manager_comment, content='core_lead', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2')",
+    """CREATE TRIGGER IF NOT EXISTS core_lead_fts_ai AFTER INSERT ON core_lead BEGIN
+        INSERT INTO core_lead_fts(rowid, first_name, last_name, telegram_username, phone_normalized, source, manager_comment)
+        VALUES (new.id, new.first_name, new.last_name, new.telegram_username, new.phone_normalized, new.source, new.manager_comment);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS core_lead_fts_ad AFTER DELETE ON core_lead BEGIN
+        INSERT INTO core_lead_fts(core_lead_fts, rowid, first_name, last_name, telegram_username, phone_normalized, source, manager_comment)
+        VALUES ('delete', old.id, old.first_name, old.last_name, old.telegram_username, old.phone_normalized, old.source, old.manager_comment);
+    END""",
+    # Только при смене индексируемых полей: сводка last_msg_* меняется на каждое сообщение
+    """CREATE TRIGGER IF NOT EXISTS core_lead_fts_au
+    AFTER UPDATE OF first_name, last_name, telegram_username, phone_normalized, source, manager_comment ON core_lead BEGIN
+        INSERT INTO core_lead_fts(core_lead_fts, rowid, first_name, last_name, telegram_username, phone_normalized, source, manager_comment)
+        VALUES ('delete', old.id, old.first_name, old.last_name, old.telegram_username, old.phone_normalized, old.source, old.manager_comment);
+        INSERT INTO core_lead_fts(rowid, first_name, last_name, telegram_username, phone_normalized, source, manager_comment)
+        VALUES (new.id, new.first_name, new.last_name, new.telegram_username, new.phone_normalized, new.source, new.manager_comment);
+    END""",
+    "INSERT INTO core_lead_fts(core_lead_fts) VALUES ('rebuild')",
+]
+
+SQLITE_DROP = [
+    'DROP TRIGGER IF EXISTS core_chatmessage_fts_ai',
+    'DROP TRIGGER IF EXISTS core_chatmessage_fts_ad',
+    'DROP TRIGGER IF EXISTS core_chatmessage_fts_au',
+    'DROP TABLE IF EXISTS core_chatmessage_fts',
+    'DROP TRIGGER IF EXISTS core_lead_fts_ai',
+    'DROP TRIGGER IF EXISTS core_lead_fts_ad',
+    'DROP TRIGGER IF EXISTS core_lead_fts_au',
+    'DROP TABLE IF EXISTS core_lead_fts',
+]
+
+PG_SCHEMA = [
+    "CREATE INDEX IF NOT EXISTS chatmessage_text_search_idx ON core_chatmessage "
+    "USING gin (to_tsvector('simple', coalesce(text, '')))",
+    "CREATE INDEX IF NOT EXISTS lead_search_idx ON core_lead USING gin (to_tsvector('simple', "
+    "coalesce(first_name, '') || ' ' || coalesce(last_name, '') || ' ' || coalesce(telegram_username, '') || ' ' || "
+    "coalesce(phone_normalized, '') || ' ' || coalesce(source, '') || ' ' || coalesce(manager_comment, '')))",
+]
+
+PG_DROP = [
+    'DROP INDEX IF EXISTS chatmessage_text_search_idx',
+    'DROP INDEX IF EXISTS lead_search_idx',
+]
+
+
+def _has_fts5(cursor):
+    cursor.execute('PRAGMA compile_options')
+    return any(row[0] == 'ENABLE_FTS5' for row in cursor.fetchall())
+
+
+def install_search_index(apps, schema_editor):
+    conn = schema_editor.connection
+    with conn.cursor() as cursor:
+        if conn.vendor == 'sqlite' and _has_fts5(cursor):
+            statements = SQLITE_SCHEMA
+        elif conn.vendor == 'postgresql':
+            statements = PG_SCHEMA
+        else:
+            logger.warning('Полнотекстовый индекс не создан (нет FTS5) - поиск будет работать через LIKE')
+            return
+        for sql in statements:
+            cursor.execute(sql)
+
+
+def uninstall_search_index(apps, schema_editor):
+    conn = schema_editor.connection
+    statements = {'sqlite': SQLITE_DROP, 'postgresql': PG_DROP}.get(conn.vendor, [])
+    with conn.cursor() as cursor:
+        for sql in statements:
+            cursor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_lead_sidebar_keyset'),
+    ]
+
+    operations = [
+        migrations.RunPython(install_search_index, uninstall_search_index),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.8 on 2026-10-17 15:16
+
+import core.media
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='thumbnail',
+            field=models.FileField(blank=True, editable=False, null=True, upload_to='chat_thumbs/', verbose_name='Превью'),
+        ),
+        # Смена storage в базе ничего не меняет, а SQLite пересоздал бы всю таблицу
+        # сообщений (и потерял бы триггеры поиска) - меняем только состояние
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='chatmessage',
+                    name='attachment',
+                    field=models.FileField(blank=True, null=True, storage=core.media.ContentAddressedStorage(), upload_to='chat_files/', verbose_name='Вложение'),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.8 on 2026-10-17 15:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_chat_media_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='delivery_attempts',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, verbose_name='Попыток отправки'),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='delivery_error',
+            field=models.CharField(blank=True, editable=False, max_length=255, verbose_name='Ошибка доставки'),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='delivery_status',
+            field=models.CharField(blank=True, choices=[('queued', '🕓 В очереди'), ('sending', '📤 Отправляется'), ('sent', '✅ Доставлено'), ('failed', '⚠️ Не доставлено')], editable=False, max_length=10, verbose_name='Доставка'),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='file_name',
+            field=models.CharField(blank=True, editable=False, max_length=255, verbose_name='Имя файла'),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Следующая попытка'),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['delivery_status', 'id'], name='chatmessage_outbox_idx'),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.2.8 on 2026-10-17 15:28
+
+import core.media
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_chat_outbox'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Broadcast',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=200, verbose_name='Название')),
+                ('text', models.TextField(verbose_name='Текст сообщения')),
+                ('attachment', models.FileField(blank=True, null=True, storage=core.media.ContentAddressedStorage(), upload_to='broadcast_files/', verbose_name='Вложение')),
+                ('audience', models.CharField(choices=[('leads', 'Лиды'), ('students', 'Студенты')], default='leads', max_length=10, verbose_name='Кому')),
+                ('lead_status', models.CharField(blank=True, choices=[('new', '🔥 Новый'), ('process', '⏳ В обработке'), ('payment', '💰 Ждем оплату'), ('won', '✅ Записан в группу'), ('lost', '❌ Отказ')], max_length=20, verbose_name='Статус лида')),
+                ('lead_source', models.CharField(blank=True, max_length=100, verbose_name='Источник лида')),
+                ('student_status', models.CharField(blank=True, choices=[('active', '🟢 Активен'), ('paused', '🟡 Заморозка'), ('banned', '🔴 Исключен (Много прогулов)')], max_length=20, verbose_name='Статус студента')),
+                ('status', models.CharField(choices=[('draft', '📝 Черновик'), ('running', '📤 Идет отправка'), ('paused', '⏸ Пауза'), ('done', '✅ Завершена')], default='draft', editable=False, max_length=10, verbose_name='Статус')),
+                ('total', models.PositiveIntegerField(default=0, editable=False, verbose_name='Получателей')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создана')),
+                ('started_at', models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Запущена')),
+                ('finished_at', models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Завершена')),
+                ('created_by', models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='Автор')),
+                ('group', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.group', verbose_name='Группа студентов')),
+            ],
+            options={
+                'verbose_name': 'Рассылка',
+                'verbose_name_plural': 'Рассылки',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='BroadcastRecipient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('delivery_status', models.CharField(choices=[('queued', '🕓 В очереди'), ('sending', '📤 Отправляется'), ('sent', '✅ Доставлено'), ('failed', '⚠️ Не доставлено')], default='queued', max_length=10, verbose_name='Доставка')),
+                ('delivery_attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Попыток отправки')),
+                ('next_attempt_at', models.DateTimeField(blank=True, null=True, verbose_name='Следующая попытка')),
+                ('delivery_error', models.CharField(blank=True, max_length=255, verbose_name='Ошибка доставки')),
+                ('broadcast', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recipients', to='core.broadcast')),
+                ('lead', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='broadcast_deliveries', to='core.lead')),
+            ],
+            options={
+                'verbose_name': 'Получатель рассылки',
+                'verbose_name_plural': 'Получатели рассылки',
+                'indexes': [models.Index(fields=['broadcast', 'delivery_status', 'id'], name='broadcast_recipient_queue_idx')],
+                'constraints': [models.UniqueConstraint(fields=('broadcast', 'lead'), name='broadcast_recipient_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.8 on 2026-10-17 15:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_broadcasts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('metric', models.CharField(max_length=30, verbose_name='Метрика')),
+                ('day', models.DateField(verbose_name='День')),
+                ('key', models.CharField(blank=True, max_length=100, verbose_name='Ключ')),
+                ('count', models.IntegerField(default=0, verbose_name='Количество')),
+                ('total', models.DecimalField(decimal_places=0, default=0, max_digits=14, verbose_name='Сумма')),
+            ],
+            options={
+                'verbose_name': 'Дневная сводка',
+                'verbose_name_plural': 'Дневные сводки',
+                'constraints': [models.UniqueConstraint(fields=('metric', 'day', 'key'), name='dailystat_unique')],
+            },
+        ),
+    ]
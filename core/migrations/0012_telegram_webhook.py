@@ -0,0 +1,30 @@
+# Generated by Django 5.2.8 on 2026-10-17 15:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_daily_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TelegramUpdate',
+            fields=[
+                ('update_id', models.BigIntegerField(primary_key=True, serialize=False, verbose_name='ID апдейта')),
+                ('payload', models.JSONField(verbose_name='Апдейт')),
+                ('received_at', models.DateTimeField(auto_now_add=True, verbose_name='Получен')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Попыток')),
+                ('locked_until', models.DateTimeField(blank=True, null=True, verbose_name='Обрабатывается до')),
+                ('processed_at', models.DateTimeField(blank=True, null=True, verbose_name='Обработан')),
+                ('error', models.CharField(blank=True, max_length=255, verbose_name='Ошибка')),
+            ],
+            options={
+                'verbose_name': 'Апдейт Telegram',
+                'verbose_name_plural': 'Апдейты Telegram',
+                'indexes': [models.Index(fields=['processed_at', 'update_id'], name='telegramupdate_queue_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-17 16:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_telegram_webhook'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='media_error',
+            field=models.CharField(blank=True, editable=False, max_length=255, verbose_name='Ошибка загрузки файла'),
+        ),
+    ]
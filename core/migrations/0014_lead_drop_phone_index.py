@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-17 17:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_chatmessage_media_error'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='lead',
+            name='phone',
+            field=models.CharField(blank=True, max_length=20, verbose_name='Телефон'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.8 on 2026-10-17 17:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def fill_payment_group(apps, schema_editor):
+    # Историю переводов между группами не хранили - старым оплатам достается текущая группа
+    Payment = apps.get_model('core', 'Payment')
+    Student = apps.get_model('core', 'Student')
+    Payment.objects.update(group_id=Subquery(Student.objects.filter(pk=OuterRef('student_id')).values('group_id')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_lead_drop_phone_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='group',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='core.group', verbose_name='Группа на момент оплаты'),
+        ),
+        migrations.RunPython(fill_payment_group, migrations.RunPython.noop),
+    ]
@@ -1,6 +1,18 @@
-from django.db import models
+from django.db import DatabaseError, models, transaction
+from django.db.models import Case, Count, F, OuterRef, Subquery, Value, When
+from django.db.models.lookups import GreaterThanOrEqual
 from django.utils.timezone import now
 from django.contrib.auth.models import User
+from . import analytics, events, unread
+from .lead_cache import lead_cache
+from .media import chat_storage
+from .phones import normalize_phone
+
+def _refresh_if_cached(obj, relation, fields):
+    """Подтягивает из базы поля связанного объекта, если он уже загружен в память."""
+    descriptor = getattr(type(obj), relation)
+    if descriptor.is_cached(obj):
+        getattr(obj, relation).refresh_from_db(fields=fields)
 
 # --- СПРАВОЧНИКИ ---
 
@@ -19,6 +31,13 @@ class LeadStatus(models.TextChoices):
     WON = 'won', '✅ Записан в группу'
     LOST = 'lost', '❌ Отказ'
 
+class DeliveryStatus(models.TextChoices):
+    """Доставка ответа менеджера в Telegram (у входящих сообщений пусто)."""
+    QUEUED = 'queued', '🕓 В очереди'
+    SENDING = 'sending', '📤 Отправляется'
+    SENT = 'sent', '✅ Доставлено'
+    FAILED = 'failed', '⚠️ Не доставлено'
+
 # --- ОСНОВНЫЕ ТАБЛИЦЫ ---
 
 class Lead(models.Model):
@@ -28,6 +47,8 @@ class Lead(models.Model):
     first_name = models.CharField("Имя / Никнейм", max_length=100)
     last_name = models.CharField("Фамилия", max_length=100, blank=True)
     phone = models.CharField("Телефон", max_length=20, blank=True)
+    # Поиск по телефону идет по нормализованному номеру (см. core/phones.py)
+    phone_normalized = models.CharField("Телефон (E.164)", max_length=20, blank=True, db_index=True, editable=False)
     telegram_id = models.CharField("Telegram ID", max_length=50, blank=True, unique=True)
     telegram_username = models.CharField("Telegram Username", max_length=100, blank=True)
     
@@ -37,14 +58,116 @@ class Lead(models.Model):
     created_at = models.DateTimeField("Дата создания", auto_now_add=True)
     updated_at = models.DateTimeField("Дата обновления", auto_now=True)
 
+    # Сводка по последнему сообщению (обновляется в ChatMessage.save)
+    last_msg_time = models.DateTimeField("Последнее сообщение", null=True, blank=True, editable=False)
+    last_msg_text = models.CharField("Текст последнего сообщения", max_length=255, blank=True, editable=False)
+    last_msg_type = models.CharField("Тип последнего сообщения", max_length=10, blank=True, editable=False)
+
     class Meta:
         verbose_name = "Лид (Заявка)"
         verbose_name_plural = "Лиды (Заявки)"
+        indexes = [
+            # Сортировка и постраничная выдача сайдбара в чате (id - для однозначного курсора)
+            models.Index(fields=['-status', '-last_msg_time', '-created_at', '-id'], name='lead_sidebar_idx'),
+            # То же с фильтром по источнику
+            models.Index(fields=['source', '-status', '-last_msg_time', '-created_at', '-id'], name='lead_source_sidebar_idx'),
+            # Счетчик новых и фильтр по статусу в админке
+            models.Index(fields=['status', '-created_at'], name='lead_status_created_idx'),
+            models.Index(fields=['-created_at'], name='lead_created_idx'),
+            # Инкрементальный опрос чата (updated_at > ts)
+            models.Index(fields=['updated_at'], name='lead_updated_idx'),
+        ]
 
     def __str__(self):
         contact = self.phone if self.phone else f"@{self.telegram_username}"
         return f"{self.first_name} | {contact}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Запоминаем статус из базы, чтобы в save() знать, был ли переход из/в 'new'
+        instance._loaded_status = instance.__dict__.get('status')
+        return instance
+
+    # Сводку пишут только сообщения (условным UPDATE), а не save() лида
+    SUMMARY_FIELDS = ('last_msg_time', 'last_msg_text', 'last_msg_type')
+
+    def save(self, *args, **kwargs):
+        self.phone_normalized = normalize_phone(self.phone)
+        adding = self._state.adding
+        update_fields = kwargs.get('update_fields')
+        saves_status = 'status' in self.__dict__ and (update_fields is None or 'status' in update_fields)
+        if not adding and update_fields is None and not kwargs.get('force_insert') and not args:
+            self._save_keeping_summary(**kwargs)
+        else:
+            super().save(*args, **kwargs)
+        if adding:
+            analytics.leads_created([self])
+
+        # Счетчик непрочитанных: поправляем только при переходе из/в 'new'
+        if saves_status:
+            if adding or hasattr(self, '_loaded_status'):
+                unread.status_changed(getattr(self, '_loaded_status', None), self.status)
+            else:
+                unread.invalidate()
+            self._loaded_status = self.status
+        lead_cache.invalidate(self.telegram_id)
+        events.publish({'type': 'lead', 'lead': self.pk, 'status': self.status})
+
+    def _save_keeping_summary(self, **kwargs):
+        """
+        Полный save() (форма админки) записал бы загруженную тогда сводку
+        поверх более свежей, которую бот успел записать после загрузки, -
+        поэтому пишем все поля, кроме сводки. Если строки уже нет (лида удалили,
+        pk задан руками), остается обычный save(): он вставит строку заново.
+        """
+        deferred = self.get_deferred_fields()
+        fields = [
+            field.name for field in self._meta.concrete_fields
+            if not field.primary_key and field.name not in self.SUMMARY_FIELDS and field.attname not in deferred
+        ]
+        try:
+            with transaction.atomic(using=kwargs.get('using') or self._state.db):
+                super().save(update_fields=fields, **kwargs)
+        except DatabaseError:
+            if type(self)._base_manager.using(kwargs.get('using') or self._state.db).filter(pk=self.pk).exists():
+                raise
+            super().save(**kwargs)
+
+    def delete(self, *args, **kwargs):
+        lead_cache.invalidate(self.telegram_id)
+        unread.status_changed(getattr(self, '_loaded_status', None), None)
+        analytics.leads_created([self], delta=-1)
+        return super().delete(*args, **kwargs)
+
+    @classmethod
+    def mark_unread(cls, lead_id):
+        """Возвращает лиду статус 'Новый' одним UPDATE, только если он другой."""
+        updated = cls.objects.filter(pk=lead_id).exclude(status=LeadStatus.NEW).update(
+            status=LeadStatus.NEW, updated_at=now()
+        )
+        if updated:
+            unread.adjust(updated)
+            events.publish({'type': 'lead', 'lead': lead_id, 'status': LeadStatus.NEW})
+        return updated
+
+    @classmethod
+    def mark_unread_many(cls, lead_ids):
+        """
+        То же для нескольких лидов одним UPDATE (пакетная запись бота).
+        Возвращает id тех, чей статус поменялся; событие вкладкам - после коммита.
+        """
+        stale = cls.objects.filter(pk__in=lead_ids).exclude(status=LeadStatus.NEW)
+        changed = list(stale.values_list('pk', flat=True))
+        if changed:
+            unread.adjust(stale.filter(pk__in=changed).update(status=LeadStatus.NEW, updated_at=now()))
+
+            def publish():
+                for lead_id in changed:
+                    events.publish({'type': 'lead', 'lead': lead_id, 'status': LeadStatus.NEW})
+            transaction.on_commit(publish)
+        return changed
+
 
 class Teacher(models.Model):
     full_name = models.CharField("ФИО Преподавателя", max_length=150)
@@ -85,6 +208,7 @@ class Student(models.Model):
     lead = models.OneToOneField(Lead, on_delete=models.SET_NULL, null=True, blank=True, verbose_name="Из какого лида")
     full_name = models.CharField("ФИО", max_length=150)
     phone = models.CharField("Телефон", max_length=20)
+    phone_normalized = models.CharField("Телефон (E.164)", max_length=20, blank=True, db_index=True, editable=False)
     group = models.ForeignKey(Group, on_delete=models.SET_NULL, null=True, blank=True, verbose_name="Группа", related_name="students")
     student_status = models.CharField("Статус студента", max_length=20, choices=STATUS_CHOICES, default='active')
     balance = models.IntegerField("Остаток уроков", default=0)
@@ -97,6 +221,23 @@ class Student(models.Model):
     def __str__(self):
         return f"{self.full_name} ({self.get_student_status_display()})"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Лид из базы - чтобы в save() заметить привязку к другому лиду (воронка в аналитике)
+        instance._loaded_lead_id = instance.__dict__.get('lead_id')
+        return instance
+
+    def save(self, *args, **kwargs):
+        self.phone_normalized = normalize_phone(self.phone)
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+
+        old_lead_id = None if adding else getattr(self, '_loaded_lead_id', self.lead_id)
+        if old_lead_id != self.lead_id:
+            analytics.student_linked(old_lead_id, self.lead_id)
+        self._loaded_lead_id = self.lead_id
+
 
 class Lesson(models.Model):
     group = models.ForeignKey(Group, on_delete=models.CASCADE, verbose_name="Группа", related_name="lessons")
@@ -107,6 +248,10 @@ class Lesson(models.Model):
         verbose_name = "Проведенный урок"
         verbose_name_plural = "Журнал уроков"
         ordering = ['-date']
+        indexes = [
+            models.Index(fields=['-date'], name='lesson_date_idx'),
+            models.Index(fields=['group', '-date'], name='lesson_group_date_idx'),
+        ]
 
     def __str__(self):
         return f"{self.group.name} - {self.date}"
@@ -127,24 +272,81 @@ class Attendance(models.Model):
         verbose_name = "Отметка"
         verbose_name_plural = "Отметки"
         unique_together = ('lesson', 'student')
+        indexes = [
+            # Подсчет прогулов студента
+            models.Index(fields=['student', 'status'], name='attendance_student_status_idx'),
+        ]
 
     def __str__(self):
         return f"{self.student} - {self.get_status_display()}"
     
+    # Сколько уроков списывает отметка и после скольких прогулов студент исключается
+    CHARGED_STATUSES = ('present', 'absent')
+    BAN_AFTER_ABSENCES = 3
+
     def save(self, *args, **kwargs):
         is_new = self.pk is None
-        super().save(*args, **kwargs)
-        
-        if is_new:
-            if self.status in ['present', 'absent']:
-                self.student.balance -= 1
-                self.student.save()
-
-            if self.status == 'absent':
-                absent_count = Attendance.objects.filter(student=self.student, status='absent').count()
-                if absent_count >= 3:
-                    self.student.student_status = 'banned'
-                    self.student.save()
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if is_new:
+                self.apply_to_student()
+                analytics.attendance_marked(self.lesson, {self.student_id: self.status})
+
+    def apply_to_student(self):
+        """
+        Списывает урок и проверяет правило исключения одним UPDATE прямо в базе
+        (F-выражения), без чтения баланса в Python - параллельные отметки не теряются.
+        """
+        if Attendance.apply_marks({self.student_id: self.status}):
+            _refresh_if_cached(self, 'student', ['balance', 'student_status'])
+
+    @classmethod
+    def apply_marks(cls, marks):
+        """
+        Применяет к студентам уже сохраненные отметки {student_id: status}:
+        не больше двух UPDATE на любое число студентов. Возвращает True, если что-то изменилось.
+        """
+        absent = [sid for sid, status in marks.items() if status == 'absent']
+        charged = [sid for sid, status in marks.items() if status in cls.CHARGED_STATUSES and status != 'absent']
+
+        if absent:
+            absences = Attendance.objects.filter(student=OuterRef('pk'), status='absent') \
+                .values('student').annotate(total=Count('pk')).values('total')
+            Student.objects.filter(pk__in=absent).update(
+                balance=F('balance') - 1,
+                student_status=Case(
+                    When(GreaterThanOrEqual(Subquery(absences), cls.BAN_AFTER_ABSENCES), then=Value('banned')),
+                    default=F('student_status'),
+                ),
+            )
+        if charged:
+            Student.objects.filter(pk__in=charged).update(balance=F('balance') - 1)
+        return bool(absent or charged)
+
+    @classmethod
+    def bulk_mark(cls, lesson, marks):
+        """
+        Отмечает весь урок разом. marks - {студент или его id: статус}.
+        Уже отмеченные студенты пропускаются. Число запросов не зависит от размера группы.
+        Возвращает созданные отметки.
+        """
+        valid = dict(cls.STATUS_CHOICES)
+        marks = {getattr(student, 'pk', student): status for student, status in marks.items()}
+        unknown = {status for status in marks.values() if status not in valid}
+        if unknown:
+            raise ValueError(f"Неизвестный статус отметки: {', '.join(sorted(unknown))}")
+
+        with transaction.atomic():
+            already = set(
+                cls.objects.filter(lesson=lesson, student_id__in=marks).values_list('student_id', flat=True)
+            )
+            new_marks = {sid: status for sid, status in marks.items() if sid not in already}
+            created = cls.objects.bulk_create([
+                cls(lesson=lesson, student_id=sid, status=status) for sid, status in new_marks.items()
+            ])
+            cls.apply_marks(new_marks)
+            analytics.attendance_marked(lesson, new_marks)
+        return created
 
 
 class Tariff(models.Model):
@@ -166,11 +368,20 @@ class Payment(models.Model):
     date = models.DateTimeField("Дата и время", default=now)
     amount = models.DecimalField("Сумма оплаты", max_digits=10, decimal_places=0)
     comment = models.TextField("Комментарий", blank=True)
+    # Группа студента в момент оплаты: выручка по группам не переезжает вслед за студентом
+    group = models.ForeignKey(
+        Group, on_delete=models.SET_NULL, null=True, blank=True, editable=False,
+        verbose_name="Группа на момент оплаты", related_name="+",
+    )
 
     class Meta:
         verbose_name = "Платеж"
         verbose_name_plural = "История оплат"
         ordering = ['-date']
+        indexes = [
+            models.Index(fields=['-date'], name='payment_date_idx'),
+            models.Index(fields=['student', '-date'], name='payment_student_date_idx'),
+        ]
 
     def __str__(self):
         return f"{self.student} - {self.amount}"
@@ -179,15 +390,21 @@ class Payment(models.Model):
         is_new = self.pk is None
         if not self.amount and self.tariff:
             self.amount = self.tariff.price
-
-        super().save(*args, **kwargs)
-        
-        if is_new and self.tariff:
-            self.student.balance += self.tariff.lessons_count
-            self.student.total_paid += self.amount
-            if self.student.student_status != 'active':
-                self.student.student_status = 'active'
-            self.student.save()
+        if is_new and self.group_id is None:
+            self.group_id = Student.objects.filter(pk=self.student_id).values_list('group_id', flat=True).first()
+
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if is_new and self.tariff:
+                # Начисление одним атомарным UPDATE, без read-modify-write
+                Student.objects.filter(pk=self.student_id).update(
+                    balance=F('balance') + self.tariff.lessons_count,
+                    total_paid=F('total_paid') + self.amount,
+                    student_status='active',
+                )
+                _refresh_if_cached(self, 'student', ['balance', 'total_paid', 'student_status'])
+            if is_new:
+                analytics.payment_created(self)
 
 
 class Task(models.Model):
@@ -214,6 +431,9 @@ class Task(models.Model):
         verbose_name = "Задача"
         verbose_name_plural = "Задачи сотрудникам"
         ordering = ['status', '-priority']
+        indexes = [
+            models.Index(fields=['status', '-priority'], name='task_status_priority_idx'),
+        ]
 
     def __str__(self):
         return f"{self.title} ({self.assigned_to})"
@@ -231,18 +451,183 @@ class ChatMessage(models.Model):
     text = models.TextField("Текст/Подпись", blank=True, null=True)
     
     # Новые поля
-    attachment = models.FileField("Вложение", upload_to='chat_files/', blank=True, null=True)
+    attachment = models.FileField("Вложение", upload_to='chat_files/', storage=chat_storage, blank=True, null=True)
+    thumbnail = models.FileField("Превью", upload_to='chat_thumbs/', blank=True, null=True, editable=False)
+    # Бот не смог скачать файл из Telegram - лента показывает ошибку вместо "Загружается..."
+    media_error = models.CharField("Ошибка загрузки файла", max_length=255, blank=True, editable=False)
     msg_type = models.CharField("Тип", max_length=10, choices=MESSAGE_TYPES, default='text')
     
     is_from_manager = models.BooleanField("От менеджера?", default=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # Очередь отправки ответов менеджера (см. core/outbox.py)
+    file_name = models.CharField("Имя файла", max_length=255, blank=True, editable=False)
+    delivery_status = models.CharField("Доставка", max_length=10, choices=DeliveryStatus.choices, blank=True, editable=False)
+    delivery_attempts = models.PositiveSmallIntegerField("Попыток отправки", default=0, editable=False)
+    next_attempt_at = models.DateTimeField("Следующая попытка", null=True, blank=True, editable=False)
+    delivery_error = models.CharField("Ошибка доставки", max_length=255, blank=True, editable=False)
+
     class Meta:
         ordering = ['created_at']
         verbose_name = "Сообщение чата"
         verbose_name_plural = "Сообщения чата"
+        indexes = [
+            # История переписки с лидом
+            models.Index(fields=['lead', 'created_at'], name='chatmessage_lead_created_idx'),
+            # Очередь отправки (core/outbox.py). Не частичный: SQLite не применяет
+            # частичный индекс, когда значения приходят параметрами запроса
+            models.Index(fields=['delivery_status', 'id'], name='chatmessage_outbox_idx'),
+        ]
 
     def __str__(self):
         type_icon = "📷" if self.msg_type == 'image' else "🎤" if self.msg_type == 'voice' else "📝"
         direction = "➡️" if self.is_from_manager else "⬅️"
-        return f"{direction} {type_icon} {self.text or 'Вложение'}"
\ No newline at end of file
+        return f"{direction} {type_icon} {self.text or 'Вложение'}"
+
+    def save(self, *args, **kwargs):
+        is_new = self.pk is None
+        super().save(*args, **kwargs)
+
+        if is_new:
+            # Обновляем сводку в лиде одним UPDATE (без перезаписи всей строки)
+            summary = self.summary_fields()
+            updated = Lead.objects.filter(
+                models.Q(last_msg_time__isnull=True) | models.Q(last_msg_time__lte=self.created_at),
+                pk=self.lead_id,
+            ).update(**summary)
+            # Чтобы последующий lead.save() не затер сводку старыми значениями
+            if updated and ChatMessage.lead.is_cached(self):
+                for field, value in summary.items():
+                    setattr(self.lead, field, value)
+
+            events.publish({'type': 'message', 'lead': self.lead_id, 'id': self.pk})
+
+    def summary_fields(self):
+        return {
+            'last_msg_time': self.created_at,
+            'last_msg_text': (self.text or '')[:255],
+            'last_msg_type': self.msg_type,
+        }
+
+# --- РАССЫЛКИ ---
+
+class BroadcastStatus(models.TextChoices):
+    DRAFT = 'draft', '📝 Черновик'
+    RUNNING = 'running', '📤 Идет отправка'
+    PAUSED = 'paused', '⏸ Пауза'
+    DONE = 'done', '✅ Завершена'
+
+
+class Broadcast(models.Model):
+    """
+    Массовая рассылка через бота по сегменту лидов или студентов.
+    Отправляет core/broadcast.py, по одному BroadcastRecipient на получателя.
+    """
+    AUDIENCE_CHOICES = [
+        ('leads', 'Лиды'),
+        ('students', 'Студенты'),
+    ]
+
+    title = models.CharField("Название", max_length=200)
+    text = models.TextField("Текст сообщения")
+    attachment = models.FileField("Вложение", upload_to='broadcast_files/', storage=chat_storage, blank=True, null=True)
+
+    # Сегмент: пустое поле - без ограничения
+    audience = models.CharField("Кому", max_length=10, choices=AUDIENCE_CHOICES, default='leads')
+    lead_status = models.CharField("Статус лида", max_length=20, choices=LeadStatus.choices, blank=True)
+    lead_source = models.CharField("Источник лида", max_length=100, blank=True)
+    group = models.ForeignKey(Group, on_delete=models.SET_NULL, null=True, blank=True, verbose_name="Группа студентов")
+    student_status = models.CharField("Статус студента", max_length=20, choices=Student.STATUS_CHOICES, blank=True)
+
+    status = models.CharField("Статус", max_length=10, choices=BroadcastStatus.choices, default=BroadcastStatus.DRAFT, editable=False)
+    total = models.PositiveIntegerField("Получателей", default=0, editable=False)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, editable=False, verbose_name="Автор")
+    created_at = models.DateTimeField("Создана", auto_now_add=True)
+    started_at = models.DateTimeField("Запущена", null=True, blank=True, editable=False)
+    finished_at = models.DateTimeField("Завершена", null=True, blank=True, editable=False)
+
+    class Meta:
+        verbose_name = "Рассылка"
+        verbose_name_plural = "Рассылки"
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.title} ({self.get_status_display()})"
+
+
+class BroadcastRecipient(models.Model):
+    """Получатель рассылки и статус доставки ему (те же поля, что у ChatMessage для core/outbox.py)."""
+    broadcast = models.ForeignKey(Broadcast, on_delete=models.CASCADE, related_name='recipients')
+    lead = models.ForeignKey(Lead, on_delete=models.CASCADE, related_name='broadcast_deliveries')
+    delivery_status = models.CharField("Доставка", max_length=10, choices=DeliveryStatus.choices, default=DeliveryStatus.QUEUED)
+    delivery_attempts = models.PositiveSmallIntegerField("Попыток отправки", default=0)
+    next_attempt_at = models.DateTimeField("Следующая попытка", null=True, blank=True)
+    delivery_error = models.CharField("Ошибка доставки", max_length=255, blank=True)
+
+    class Meta:
+        verbose_name = "Получатель рассылки"
+        verbose_name_plural = "Получатели рассылки"
+        constraints = [
+            # Повторный запуск досоздает получателей, но никому не пишет дважды
+            models.UniqueConstraint(fields=['broadcast', 'lead'], name='broadcast_recipient_unique'),
+        ]
+        indexes = [
+            # Очередь рассылки и счетчики прогресса
+            models.Index(fields=['broadcast', 'delivery_status', 'id'], name='broadcast_recipient_queue_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.broadcast_id} → {self.lead_id}: {self.get_delivery_status_display()}"
+
+
+# --- АНАЛИТИКА ---
+
+class DailyStat(models.Model):
+    """
+    Дневная сводка для дашборда: одна строка на (метрику, день, ключ).
+    Пишется в core/analytics.py, целиком пересчитывается командой rebuild_rollups.
+    """
+    metric = models.CharField("Метрика", max_length=30)
+    day = models.DateField("День")
+    key = models.CharField("Ключ", max_length=100, blank=True)  # id тарифа/группы/преподавателя или источник лида
+    count = models.IntegerField("Количество", default=0)
+    total = models.DecimalField("Сумма", max_digits=14, decimal_places=0, default=0)
+
+    class Meta:
+        verbose_name = "Дневная сводка"
+        verbose_name_plural = "Дневные сводки"
+        constraints = [
+            # Он же индекс для виджетов: metric = ? AND day >= ? GROUP BY key
+            models.UniqueConstraint(fields=['metric', 'day', 'key'], name='dailystat_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.metric} {self.day} {self.key}: {self.count} / {self.total}"
+
+
+# --- WEBHOOK TELEGRAM ---
+
+class TelegramUpdate(models.Model):
+    """
+    Апдейт, принятый webhook'ом (core/webhook.py). update_id - первичный
+    ключ, поэтому повторная доставка того же апдейта не создаст вторую
+    строку и не будет обработана еще раз.
+    """
+    update_id = models.BigIntegerField("ID апдейта", primary_key=True)
+    payload = models.JSONField("Апдейт")
+    received_at = models.DateTimeField("Получен", auto_now_add=True)
+    attempts = models.PositiveSmallIntegerField("Попыток", default=0)
+    locked_until = models.DateTimeField("Обрабатывается до", null=True, blank=True)
+    processed_at = models.DateTimeField("Обработан", null=True, blank=True)
+    error = models.CharField("Ошибка", max_length=255, blank=True)
+
+    class Meta:
+        verbose_name = "Апдейт Telegram"
+        verbose_name_plural = "Апдейты Telegram"
+        indexes = [
+            # Очередь: processed_at IS NULL ORDER BY update_id; и чистка старых
+            models.Index(fields=['processed_at', 'update_id'], name='telegramupdate_queue_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.update_id}: {'обработан' if self.processed_at else 'в очереди'}"
@@ -0,0 +1,269 @@
+"""
+Очередь отправки ответов менеджера в Telegram.
+
+Дашборд только сохраняет сообщение со статусом "в очереди" и сразу
+возвращает страницу. Отправляет Outbox в отдельном потоке (в runbot или
+командой send_outbox), соблюдая лимиты Telegram: не больше ~30 сообщений
+в секунду всего и одного сообщения в секунду в один чат. Временные ошибки
+(сеть, 429, 5xx) повторяются с экспоненциальной задержкой, постоянные
+(бот заблокирован, чат не найден) сразу помечаются как "не доставлено".
+
+Сообщение забирается в работу условным UPDATE, поэтому несколько
+отправителей не отправят одно и то же дважды. Если отправитель упал
+посреди отправки, сообщение вернется в очередь по истечении lease.
+Сообщения одного чата уходят строго по порядку: пока более раннее ждет
+повтора, следующие за ним тоже ждут.
+
+Ошибки Bot API считаются в метрике bot_telegram_api_errors_total (core/metrics.py).
+"""
+import heapq
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from telebot.apihelper import ApiTelegramException
+
+from . import events, metrics
+from .metrics import log_event
+from .models import ChatMessage, DeliveryStatus
+
+logger = logging.getLogger('core.outbox')
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class RateLimiter:
+    """Глобальный лимит (token bucket) и минимальный интервал между сообщениями в один чат."""
+
+    def __init__(self, per_second=30, per_chat_interval=1.0, clock=time.monotonic):
+        self.per_second = per_second
+        self.per_chat_interval = per_chat_interval
+        self.clock = clock
+        self._tokens = float(per_second)
+        self._refilled_at = clock()
+        self._chat_next = {}
+
+    def _refill(self, now):
+        self._tokens = min(self.per_second, self._tokens + (now - self._refilled_at) * self.per_second)
+        self._refilled_at = now
+
+    def global_delay(self):
+        """Сколько секунд ждать, пока общий лимит позволит следующее сообщение."""
+        self._refill(self.clock())
+        return (1 - self._tokens) / self.per_second if self._tokens < 1 else 0
+
+    def chat_delay(self, chat_id):
+        return max(self._chat_next.get(chat_id, 0) - self.clock(), 0)
+
+    def acquire(self, chat_id):
+        now = self.clock()
+        self._refill(now)
+        self._tokens -= 1
+        self._chat_next[chat_id] = now + self.per_chat_interval
+        # Старые записи о чатах не нужны - не даем словарю расти бесконечно
+        if len(self._chat_next) > 10000:
+            self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+
+
+PENDING_STATUSES = [DeliveryStatus.QUEUED, DeliveryStatus.SENDING]
+
+
+class PermanentError(Exception):
+    """Повторять бесполезно: бот заблокирован, чат не найден и т.п."""
+
+
+class Outbox:
+    """
+    Отправитель очереди. Работает с любой моделью, у которой есть поля
+    delivery_status/delivery_attempts/next_attempt_at/delivery_error
+    (рассылки в core/broadcast.py переопределяют pending и send).
+    """
+    model = ChatMessage
+
+    def __init__(self, bot, limiter=None, max_attempts=None, backoff=None, backoff_max=None, lease=None,
+                 sleep=time.sleep):
+        self.bot = bot
+        self.sleep = sleep
+        self.limiter = limiter or RateLimiter(
+            per_second=_setting('OUTBOX_RATE_PER_SECOND', 30),
+            per_chat_interval=_setting('OUTBOX_PER_CHAT_INTERVAL', 1.0),
+        )
+        self.max_attempts = max_attempts or _setting('OUTBOX_MAX_ATTEMPTS', 6)
+        self.backoff = backoff if backoff is not None else _setting('OUTBOX_BACKOFF', 2)
+        self.backoff_max = backoff_max or _setting('OUTBOX_BACKOFF_MAX', 300)
+        self.lease = lease or _setting('OUTBOX_LEASE', 120)
+        self.stats = dict.fromkeys(('sent', 'retried', 'failed'), 0)
+
+    # --- ОЧЕРЕДЬ ---
+
+    def pending(self, limit=500):
+        """
+        Неотправленные сообщения по порядку создания. По запросу на статус:
+        каждый идет по индексу (delivery_status, id) без сортировки, а
+        упорядоченные списки просто сливаются.
+        """
+        queries = [
+            ChatMessage.objects.select_related('lead').filter(delivery_status=status).order_by('id')[:limit]
+            for status in PENDING_STATUSES
+        ]
+        return list(heapq.merge(*queries, key=lambda msg: msg.id))[:limit]
+
+    def claim(self, msg):
+        """Забирает сообщение себе. False - его уже взял другой отправитель."""
+        lease_until = timezone.now() + timedelta(seconds=self.lease)
+        return bool(
+            self.model.objects.filter(
+                pk=msg.pk, delivery_status=msg.delivery_status, next_attempt_at=msg.next_attempt_at,
+            ).update(delivery_status=DeliveryStatus.SENDING, next_attempt_at=lease_until)
+        )
+
+    def run_once(self, limit=500):
+        """
+        Один проход по очереди. Чат, которому еще рано писать, пропускается
+        целиком - иначе его следующие сообщения обогнали бы отложенное.
+        Возвращает число отправленных.
+        """
+        sent = 0
+        now = timezone.now()
+        waiting_chats = set()
+        for msg in self.pending(limit):
+            chat_id = self.chat_id(msg)
+            if chat_id in waiting_chats:
+                continue
+            # Ждет повтора или его прямо сейчас отправляет другой отправитель
+            if msg.next_attempt_at and msg.next_attempt_at > now:
+                waiting_chats.add(chat_id)
+                continue
+            if self.limiter.chat_delay(chat_id):
+                waiting_chats.add(chat_id)
+                continue
+            wait = self.limiter.global_delay()
+            if wait:
+                self.sleep(wait)
+            if not self.claim(msg):
+                waiting_chats.add(chat_id)
+                continue
+            self.limiter.acquire(chat_id)
+            if self.deliver(msg):
+                sent += 1
+            else:
+                waiting_chats.add(chat_id)
+        return sent
+
+    # --- ОТПРАВКА ---
+
+    def deliver(self, msg):
+        try:
+            self.send(msg)
+        except Exception as e:
+            self._failed(msg, e)
+            return False
+
+        self.model.objects.filter(pk=msg.pk).update(
+            delivery_status=DeliveryStatus.SENT, next_attempt_at=None, delivery_error='',
+            delivery_attempts=msg.delivery_attempts + 1,
+        )
+        self.stats['sent'] += 1
+        self._publish(msg)
+        return True
+
+    def chat_id(self, msg):
+        return msg.lead.telegram_id
+
+    def send(self, msg):
+        return self.send_to(self.chat_id(msg), msg.text, msg.attachment, msg.msg_type == 'image', msg.file_name)
+
+    def send_to(self, chat_id, text, attachment=None, is_photo=False, file_name=''):
+        """Один вызов Bot API. Ошибки, которые повторять бесполезно, превращаются в PermanentError."""
+        method = ('sendPhoto' if is_photo else 'sendDocument') if attachment else 'sendMessage'
+        try:
+            if attachment:
+                with attachment.open('rb') as f:
+                    if is_photo:
+                        return self.bot.send_photo(chat_id, f, caption=text or None)
+                    return self.bot.send_document(
+                        chat_id, f, caption=text or None, visible_file_name=file_name or None,
+                    )
+            return self.bot.send_message(chat_id, text)
+        except ApiTelegramException as e:
+            metrics.API_ERRORS.inc(method=method, code=e.error_code)
+            if e.error_code == 429 or e.error_code >= 500:
+                raise
+            raise PermanentError(e.description) from e
+        except FileNotFoundError as e:
+            raise PermanentError(f'Файл вложения пропал: {attachment.name}') from e
+
+    def _failed(self, msg, error):
+        attempts = msg.delivery_attempts + 1
+        permanent = isinstance(error, PermanentError) or attempts >= self.max_attempts
+        update = {'delivery_attempts': attempts, 'delivery_error': str(error)[:255]}
+
+        if permanent:
+            update.update(delivery_status=DeliveryStatus.FAILED, next_attempt_at=None)
+            self.stats['failed'] += 1
+            log_event(
+                logger, 'delivery_failed', level='warning',
+                model=self.model.__name__, id=msg.pk, attempts=attempts, error=str(error),
+            )
+        else:
+            update.update(
+                delivery_status=DeliveryStatus.QUEUED,
+                next_attempt_at=timezone.now() + timedelta(seconds=self.retry_delay(attempts, error)),
+            )
+            self.stats['retried'] += 1
+
+        self.model.objects.filter(pk=msg.pk).update(**update)
+        if permanent:
+            self._publish(msg)
+
+    def retry_delay(self, attempts, error=None):
+        # 429 от Telegram говорит, сколько ждать
+        if isinstance(error, ApiTelegramException) and error.error_code == 429:
+            retry_after = (error.result_json or {}).get('parameters', {}).get('retry_after')
+            if retry_after:
+                return retry_after
+        return min(self.backoff * 2 ** (attempts - 1), self.backoff_max)
+
+    def _publish(self, msg):
+        events.publish({'type': 'delivery', 'lead': msg.lead_id, 'id': msg.pk})
+
+
+class OutboxWorker(threading.Thread):
+    """
+    Разбирает очередь, пока не попросят остановиться. Если передан
+    отправитель рассылок, он получает то, что осталось от лимита после
+    ответов менеджеров, - живые диалоги не ждут массовую рассылку.
+    """
+
+    def __init__(self, outbox, poll_interval=None, broadcasts=None):
+        super().__init__(name='outbox', daemon=True)
+        self.outbox = outbox
+        self.broadcasts = broadcasts
+        self.poll_interval = poll_interval or _setting('OUTBOX_POLL_INTERVAL', 1)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        try:
+            while not self._stop_event.is_set():
+                try:
+                    sent = self.outbox.run_once()
+                    if self.broadcasts:
+                        sent += self.broadcasts.run_once()
+                except Exception as e:
+                    # Например, база занята - попробуем на следующем круге
+                    log_event(logger, 'outbox_error', level='warning', error=str(e))
+                    sent = 0
+                if not sent:
+                    self._stop_event.wait(self.poll_interval)
+        finally:
+            connection.close()
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        self.join(timeout)
@@ -0,0 +1,196 @@
+"""
+Замеры производительности каждого запроса.
+
+PerfMiddleware считает для запроса время целиком, число SQL-запросов и
+их суммарное время, попадания в кэш и размер ответа. Результат уходит в
+заголовок Server-Timing (видно во вкладке Network браузера) и строкой
+JSON в логгер core.perf.
+
+Попадания и промахи отмечают сами кэши через cache_lookup(): счетчик
+непрочитанных (unread.get_count) и кэш лидов бота (LeadCache.get).
+
+Middleware работает и под WSGI, и под ASGI: асинхронные представления (SSE)
+не уводятся в отдельный поток. Под ASGI синхронная часть запроса (ORM)
+выполняется в потоке sync_to_async со своими соединениями - счетчик SQL
+ставится на них там же.
+
+Замеряется доля запросов PERF_SAMPLE_RATE (0 - выключено, запрос проходит
+мимо без единой лишней операции). Если задан PERF_SLOW_REQUEST_MS, у
+замеряемых запросов дополнительно запоминаются текст SQL и место вызова,
+и запросы дольше порога пишутся целиком в логгер core.perf.slow.
+"""
+import json
+import logging
+import random
+import time
+import traceback
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger('core.perf')
+slow_logger = logging.getLogger('core.perf.slow')
+
+_current = ContextVar('perf_request_stats', default=None)
+
+# Сколько самых долгих SQL писать в лог медленного запроса
+SLOW_SQL_LIMIT = 50
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class RequestStats:
+    def __init__(self, capture_sql=False):
+        self.capture_sql = capture_sql
+        self.queries = 0
+        self.db_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.sql = []
+
+    def __call__(self, execute, sql, params, many, context):
+        """execute_wrapper: время каждого обращения к базе."""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.queries += 1
+            self.db_time += duration
+            if self.capture_sql:
+                self.sql.append({'sql': sql, 'ms': round(duration * 1000, 2), 'stack': _app_stack()})
+
+
+def _app_stack(limit=8):
+    """Последние кадры стека из кода проекта - откуда пришел запрос к базе."""
+    base = str(settings.BASE_DIR)
+    frames = [
+        f"{frame.filename[len(base) + 1:]}:{frame.lineno} in {frame.name}"
+        for frame in traceback.extract_stack()
+        if frame.filename.startswith(base) and 'site-packages' not in frame.filename
+        and frame.filename != __file__
+    ]
+    return frames[-limit:]
+
+
+def cache_lookup(hit):
+    """Отмечает чтение из кэша в замере текущего запроса (если он замеряется)."""
+    stats = _current.get()
+    if stats is not None:
+        if hit:
+            stats.cache_hits += 1
+        else:
+            stats.cache_misses += 1
+
+
+def _response_size(response):
+    if response.streaming:
+        return None
+    return len(response.content)
+
+
+def server_timing(total_ms, stats):
+    return ', '.join([
+        f'total;dur={total_ms:.1f}',
+        f'db;dur={stats.db_time * 1000:.1f};desc="{stats.queries} queries"',
+        f'cache;desc="hits={stats.cache_hits} misses={stats.cache_misses}"',
+    ])
+
+
+def _wrap_connections(stats):
+    """Ставит stats на все соединения текущего потока. Закрыть - stack.close()."""
+    stack = ExitStack()
+    for conn in connections.all():
+        stack.enter_context(conn.execute_wrapper(stats))
+    return stack
+
+
+class PerfMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not self.sampled(request):
+            return self.get_response(request)
+
+        stats = self.new_stats()
+        token = _current.set(stats)
+        start = time.perf_counter()
+        try:
+            with _wrap_connections(stats):
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, stats, start)
+
+    async def __acall__(self, request):
+        if not self.sampled(request):
+            return await self.get_response(request)
+
+        stats = self.new_stats()
+        # ORM под ASGI работает в потоке sync_to_async (thread_sensitive - одном
+        # на запрос) со своими соединениями: счетчик ставим на них в том же потоке
+        stack = await sync_to_async(_wrap_connections)(stats)
+        token = _current.set(stats)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+            await sync_to_async(stack.close)()
+        return self.finish(request, response, stats, start)
+
+    def new_stats(self):
+        return RequestStats(capture_sql=_setting('PERF_SLOW_REQUEST_MS', None) is not None)
+
+    def finish(self, request, response, stats, start):
+        total_ms = (time.perf_counter() - start) * 1000
+        threshold = _setting('PERF_SLOW_REQUEST_MS', None)
+
+        if _setting('PERF_SERVER_TIMING', True):
+            timing = server_timing(total_ms, stats)
+            if response.has_header('Server-Timing'):
+                timing = f"{response['Server-Timing']}, {timing}"
+            response['Server-Timing'] = timing
+
+        record = self.record(request, response, total_ms, stats)
+        logger.info(json.dumps(record, ensure_ascii=False), extra={'perf': record})
+        if threshold is not None and total_ms >= threshold:
+            slowest = sorted(stats.sql, key=lambda q: q['ms'], reverse=True)[:SLOW_SQL_LIMIT]
+            slow = dict(record, sql=slowest)
+            slow_logger.warning(json.dumps(slow, ensure_ascii=False), extra={'perf': slow})
+        return response
+
+    def sampled(self, request):
+        rate = _setting('PERF_SAMPLE_RATE', 0.05)
+        if not rate or request.path.startswith(tuple(_setting('PERF_EXCLUDE_PATHS', ()))):
+            return False
+        return rate >= 1 or random.random() < rate
+
+    def record(self, request, response, total_ms, stats):
+        match = getattr(request, 'resolver_match', None)
+        return {
+            'method': request.method,
+            'path': request.path,
+            'view': match.view_name if match else None,
+            'status': response.status_code,
+            'ms': round(total_ms, 1),
+            'db_queries': stats.queries,
+            'db_ms': round(stats.db_time * 1000, 1),
+            'cache_hits': stats.cache_hits,
+            'cache_misses': stats.cache_misses,
+            'bytes': _response_size(response),
+        }
@@ -0,0 +1,68 @@
+"""
+Нормализация телефонов к виду E.164: "+998909370520".
+
+Без кода страны в базе хранятся местные номера (9 цифр: "90 937 05 20"),
+им дописывается PHONE_DEFAULT_COUNTRY_CODE из настроек.
+"""
+import re
+
+from django.conf import settings
+
+_NOT_DIGITS = re.compile(r'\D')
+_PHONE_CHARS = re.compile(r'^[\d\s()+\-.]+$')
+
+LOCAL_LENGTH = 9  # 90 937 05 20
+
+
+def default_country_code():
+    return getattr(settings, 'PHONE_DEFAULT_COUNTRY_CODE', '998')
+
+
+def normalize_phone(raw, country_code=None):
+    """Возвращает номер в виде "+<цифры>" или '' если это не похоже на телефон."""
+    if not raw:
+        return ''
+    raw = raw.strip()
+    digits = _NOT_DIGITS.sub('', raw)
+    if len(digits) < 5:
+        return ''
+
+    if raw.startswith('+'):
+        return f'+{digits}'
+    if digits.startswith('00'):
+        return f'+{digits[2:]}'
+
+    code = country_code or default_country_code()
+    if len(digits) == LOCAL_LENGTH:
+        return f'+{code}{digits}'
+    if len(digits) == LOCAL_LENGTH + 1 and digits.startswith('8'):
+        # Старый формат набора: 8 90 937 05 20
+        return f'+{code}{digits[1:]}'
+    if len(digits) > LOCAL_LENGTH:
+        return f'+{digits}'
+    # Короткие номера (городские без кода и т.п.) храним как есть
+    return digits
+
+
+def looks_like_phone(term):
+    """Похоже ли поисковое слово на полный номер телефона."""
+    return bool(term and _PHONE_CHARS.match(term) and len(_NOT_DIGITS.sub('', term)) >= LOCAL_LENGTH)
+
+
+def backfill_normalized(model, batch_size=1000):
+    """Заполняет phone_normalized у всех строк модели. Возвращает число измененных."""
+    updated = 0
+    batch = []
+    for obj in model.objects.only('id', 'phone', 'phone_normalized').iterator(chunk_size=batch_size):
+        normalized = normalize_phone(obj.phone)
+        if normalized != obj.phone_normalized:
+            obj.phone_normalized = normalized
+            batch.append(obj)
+        if len(batch) >= batch_size:
+            model.objects.bulk_update(batch, ['phone_normalized'])
+            updated += len(batch)
+            batch = []
+    if batch:
+        model.objects.bulk_update(batch, ['phone_normalized'])
+        updated += len(batch)
+    return updated
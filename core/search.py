@@ -0,0 +1,323 @@
+"""
+Полнотекстовый поиск по сообщениям чата и по лидам.
+
+В SQLite это таблицы FTS5 с внешним содержимым (сами тексты лежат в
+core_chatmessage / core_lead, в FTS - только индекс). Индекс обновляют
+триггеры, поэтому он не отстает ни от save(), ни от bulk_create/update()
+бота и импорта. В PostgreSQL вместо FTS5 - GIN-индексы по to_tsvector,
+их база поддерживает сама.
+
+Результаты отсортированы по релевантности (bm25 / ts_rank).
+"""
+import re
+from functools import reduce
+from operator import and_
+
+from django.db import connection
+from django.db.models import Q
+
+MESSAGE_TABLE = 'core_chatmessage_fts'
+LEAD_TABLE = 'core_lead_fts'
+LEAD_COLUMNS = ('first_name', 'last_name', 'telegram_username', 'phone_normalized', 'source', 'manager_comment')
+
+# Максимум слов в запросе - длинные запросы FTS обрабатывает заметно дольше
+MAX_TERMS = 8
+# Сообщения ранжируются среди стольких последних совпадений. Частые слова
+# ("группа") встречаются в сотнях тысяч сообщений, и считать bm25 для всех
+# дороже, чем сам поиск; свежая переписка менеджерам все равно важнее.
+RANK_WINDOW = 5000
+
+_WORD = re.compile(r'\w+')
+
+
+def _sqlite_schema():
+    columns = ', '.join(LEAD_COLUMNS)
+    new_values = ', '.join(f'new.{c}' for c in LEAD_COLUMNS)
+    old_values = ', '.join(f'old.{c}' for c in LEAD_COLUMNS)
+    tokenize = "tokenize='unicode61 remove_diacritics 2'"
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {MESSAGE_TABLE} USING fts5(text, content='core_chatmessage', content_rowid='id', {tokenize})",
+        f"""CREATE TRIGGER IF NOT EXISTS {MESSAGE_TABLE}_ai AFTER INSERT ON core_chatmessage BEGIN
+            INSERT INTO {MESSAGE_TABLE}(rowid, text) VALUES (new.id, new.text);
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {MESSAGE_TABLE}_ad AFTER DELETE ON core_chatmessage BEGIN
+            INSERT INTO {MESSAGE_TABLE}({MESSAGE_TABLE}, rowid, text) VALUES ('delete', old.id, old.text);
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {MESSAGE_TABLE}_au AFTER UPDATE OF text ON core_chatmessage BEGIN
+            INSERT INTO {MESSAGE_TABLE}({MESSAGE_TABLE}, rowid, text) VALUES ('delete', old.id, old.text);
+            INSERT INTO {MESSAGE_TABLE}(rowid, text) VALUES (new.id, new.text);
+        END""",
+        f"INSERT INTO {MESSAGE_TABLE}({MESSAGE_TABLE}) VALUES ('rebuild')",
+
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {LEAD_TABLE} USING fts5({columns}, content='core_lead', content_rowid='id', {tokenize})",
+        f"""CREATE TRIGGER IF NOT EXISTS {LEAD_TABLE}_ai AFTER INSERT ON core_lead BEGIN
+            INSERT INTO {LEAD_TABLE}(rowid, {columns}) VALUES (new.id, {new_values});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {LEAD_TABLE}_ad AFTER DELETE ON core_lead BEGIN
+            INSERT INTO {LEAD_TABLE}({LEAD_TABLE}, rowid, {columns}) VALUES ('delete', old.id, {old_values});
+        END""",
+        # Только при смене индексируемых полей: сводка last_msg_* меняется на каждое сообщение
+        f"""CREATE TRIGGER IF NOT EXISTS {LEAD_TABLE}_au AFTER UPDATE OF {columns} ON core_lead BEGIN
+            INSERT INTO {LEAD_TABLE}({LEAD_TABLE}, rowid, {columns}) VALUES ('delete', old.id, {old_values});
+            INSERT INTO {LEAD_TABLE}(rowid, {columns}) VALUES (new.id, {new_values});
+        END""",
+        f"INSERT INTO {LEAD_TABLE}({LEAD_TABLE}) VALUES ('rebuild')",
+    ]
+
+
+def _sqlite_drop():
+    statements = []
+    for table in (MESSAGE_TABLE, LEAD_TABLE):
+        statements += [f'DROP TRIGGER IF EXISTS {table}_{suffix}' for suffix in ('ai', 'ad', 'au')]
+        statements.append(f'DROP TABLE IF EXISTS {table}')
+    return statements
+
+
+def _pg_lead_document():
+    return " || ' ' || ".join(f"coalesce({c}, '')" for c in LEAD_COLUMNS)
+
+
+PG_MESSAGE_DOCUMENT = "to_tsvector('simple', coalesce(text, ''))"
+
+
+def _pg_schema():
+    return [
+        f"CREATE INDEX IF NOT EXISTS chatmessage_text_search_idx ON core_chatmessage USING gin ({PG_MESSAGE_DOCUMENT})",
+        f"CREATE INDEX IF NOT EXISTS lead_search_idx ON core_lead USING gin (to_tsvector('simple', {_pg_lead_document()}))",
+    ]
+
+
+def _pg_drop():
+    return ['DROP INDEX IF EXISTS chatmessage_text_search_idx', 'DROP INDEX IF EXISTS lead_search_idx']
+
+
+# --- СХЕМА (команда rebuild_search_index и проверка после migrate; миграция 0007 держит свою копию) ---
+
+def has_fts5(conn):
+    with conn.cursor() as cursor:
+        cursor.execute('PRAGMA compile_options')
+        return any(row[0] == 'ENABLE_FTS5' for row in cursor.fetchall())
+
+
+def install(conn):
+    """Создает индексы поиска. Возвращает False, если база их не поддерживает."""
+    if conn.vendor == 'sqlite':
+        if not has_fts5(conn):
+            return False
+        statements = _sqlite_schema()
+    elif conn.vendor == 'postgresql':
+        statements = _pg_schema()
+    else:
+        return False
+    with conn.cursor() as cursor:
+        for sql in statements:
+            cursor.execute(sql)
+    return True
+
+
+def ensure_installed(conn):
+    """
+    Досоздает пропавшие триггеры и пересобирает индекс. SQLite теряет
+    триггеры, когда миграция пересоздает таблицу (ALTER через копию), и
+    индекс молча перестает обновляться - поэтому проверяем после каждого migrate.
+    """
+    if conn.vendor != 'sqlite' or not is_available(conn):
+        return False
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND name IN (%s)" % ', '.join(['%s'] * 6),
+            [f'{table}_{suffix}' for table in (MESSAGE_TABLE, LEAD_TABLE) for suffix in ('ai', 'ad', 'au')],
+        )
+        if cursor.fetchone()[0] == 6:
+            return False
+        for sql in _sqlite_schema():
+            cursor.execute(sql)
+    return True
+
+
+def uninstall(conn):
+    statements = {'sqlite': _sqlite_drop, 'postgresql': _pg_drop}.get(conn.vendor)
+    if statements:
+        with conn.cursor() as cursor:
+            for sql in statements():
+                cursor.execute(sql)
+
+
+def rebuild(conn=connection):
+    """Пересобирает индекс целиком (после ручных правок базы или восстановления из бэкапа)."""
+    with conn.cursor() as cursor:
+        if conn.vendor == 'sqlite':
+            for table in (MESSAGE_TABLE, LEAD_TABLE):
+                cursor.execute(f"INSERT INTO {table}({table}) VALUES ('rebuild')")
+                cursor.execute(f"INSERT INTO {table}({table}) VALUES ('optimize')")
+        elif conn.vendor == 'postgresql':
+            for sql in _pg_drop():
+                cursor.execute(sql)
+            for sql in _pg_schema():
+                cursor.execute(sql)
+
+
+def is_available(conn=connection):
+    if conn.vendor == 'postgresql':
+        return True
+    if conn.vendor != 'sqlite':
+        return False
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [MESSAGE_TABLE])
+        return cursor.fetchone() is not None
+
+
+# --- ЗАПРОСЫ ---
+
+def terms(query):
+    """Слова запроса без синтаксиса FTS: кавычки, звездочки и т.п. от пользователя не доходят до MATCH."""
+    return [word.lower() for word in _WORD.findall(query or '')][:MAX_TERMS]
+
+
+def _match_expression(words):
+    # Каждое слово - префикс: "вечерн" находит и "вечерние", и "вечерних"
+    if connection.vendor == 'postgresql':
+        return ' & '.join(f'{word}:*' for word in words)
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def _fetch(sql, params):
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def _sqlite_recent_matches():
+    # FTS5 отдает совпадения по убыванию rowid лениво, ранг считается только для них
+    return f"SELECT rowid, rank FROM {MESSAGE_TABLE} WHERE {MESSAGE_TABLE} MATCH %s ORDER BY rowid DESC LIMIT %s"
+
+
+def _pg_recent_matches():
+    return (
+        f"SELECT id, lead_id, text FROM core_chatmessage "
+        f"WHERE {PG_MESSAGE_DOCUMENT} @@ to_tsquery('simple', %s) ORDER BY id DESC LIMIT %s"
+    )
+
+
+def search_messages(query, limit=20):
+    """Сообщения по релевантности. У каждого есть .snippet с найденными словами в [скобках]."""
+    from .models import ChatMessage
+    words = terms(query)
+    if not words:
+        return []
+    if not is_available():
+        return _fallback_messages(words, limit)
+    match = _match_expression(words)
+
+    if connection.vendor == 'postgresql':
+        rows = _fetch(
+            f"SELECT id FROM ({_pg_recent_matches()}) m, to_tsquery('simple', %s) q "
+            f"ORDER BY ts_rank({PG_MESSAGE_DOCUMENT}, q) DESC, id DESC LIMIT %s",
+            [match, RANK_WINDOW, match, limit],
+        )
+    else:
+        rows = _fetch(
+            f"SELECT rowid FROM ({_sqlite_recent_matches()}) ORDER BY rank LIMIT %s",
+            [match, RANK_WINDOW, limit],
+        )
+
+    found = ChatMessage.objects.select_related('lead').in_bulk([row[0] for row in rows])
+    results = [found[row[0]] for row in rows if row[0] in found]
+    for msg in results:
+        msg.snippet = snippet(msg.text, words)
+    return results
+
+
+def snippet(text, words, size=12):
+    """
+    Кусок текста вокруг первого совпадения, найденные слова в [скобках].
+    Считается в Python по уже загруженной странице: snippet()/ts_headline
+    в базе для префиксных запросов заметно дороже самого поиска.
+    """
+    tokens = (text or '').split()
+    words = tuple(words)
+
+    def matches(token):
+        return any(part.lower().startswith(words) for part in _WORD.findall(token))
+
+    hits = [i for i, token in enumerate(tokens) if matches(token)]
+    start = max(hits[0] - 2, 0) if hits else 0
+    window = tokens[start:start + size]
+    result = ' '.join(f'[{token}]' if matches(token) else token for token in window)
+    if start > 0:
+        result = '… ' + result
+    if start + size < len(tokens):
+        result += ' …'
+    return result
+
+
+def lead_ids(query, limit=1000):
+    """
+    id лидов по релевантности: сначала совпадения в полях самого лида,
+    затем лиды, в переписке с которыми встречаются слова запроса.
+    """
+    words = terms(query)
+    if not words:
+        return []
+    if not is_available():
+        return _fallback_lead_ids(words, limit)
+    match = _match_expression(words)
+
+    if connection.vendor == 'postgresql':
+        lead_document = f"to_tsvector('simple', {_pg_lead_document()})"
+        by_fields = _fetch(
+            f"SELECT id FROM core_lead, to_tsquery('simple', %s) q WHERE {lead_document} @@ q "
+            f"ORDER BY ts_rank({lead_document}, q) DESC LIMIT %s",
+            [match, limit],
+        )
+        by_messages = _fetch(
+            f"SELECT lead_id FROM ({_pg_recent_matches()}) m, to_tsquery('simple', %s) q "
+            f"GROUP BY lead_id ORDER BY max(ts_rank({PG_MESSAGE_DOCUMENT}, q)) DESC LIMIT %s",
+            [match, RANK_WINDOW, match, limit],
+        )
+    else:
+        by_fields = _fetch(
+            f"SELECT rowid FROM {LEAD_TABLE} WHERE {LEAD_TABLE} MATCH %s ORDER BY rank LIMIT %s",
+            [match, limit],
+        )
+        by_messages = _fetch(
+            f"SELECT m.lead_id FROM ({_sqlite_recent_matches()}) f JOIN core_chatmessage m ON m.id = f.rowid "
+            f"GROUP BY m.lead_id ORDER BY min(f.rank) LIMIT %s",
+            [match, RANK_WINDOW, limit],
+        )
+
+    ids = list(dict.fromkeys(row[0] for row in by_fields + by_messages))
+    return ids[:limit]
+
+
+def search_leads(query, limit=20):
+    """Лиды по релевантности (см. lead_ids)."""
+    from .models import Lead
+    ids = lead_ids(query, limit)
+    found = Lead.objects.in_bulk(ids)
+    return [found[i] for i in ids if i in found]
+
+
+# --- БЕЗ ИНДЕКСА (SQLite без FTS5, другие базы) ---
+# Медленный LIKE по всей таблице, но поиск хотя бы работает
+
+def _fallback_messages(words, limit):
+    from .models import ChatMessage
+    condition = reduce(and_, (Q(text__icontains=word) for word in words))
+    results = list(ChatMessage.objects.select_related('lead').filter(condition).order_by('-id')[:limit])
+    for msg in results:
+        msg.snippet = snippet(msg.text, words)
+    return results
+
+
+def _fallback_lead_ids(words, limit):
+    from .models import ChatMessage, Lead
+
+    def matches_any_field(word):
+        return reduce(lambda q, column: q | Q(**{f'{column}__icontains': word}), LEAD_COLUMNS, Q())
+
+    by_fields = Lead.objects.filter(reduce(and_, map(matches_any_field, words))).values_list('id', flat=True)
+    condition = reduce(and_, (Q(text__icontains=word) for word in words))
+    by_messages = ChatMessage.objects.filter(condition).values_list('lead_id', flat=True).distinct()
+    ids = list(dict.fromkeys(list(by_fields[:limit]) + list(by_messages[:limit])))
+    return ids[:limit]
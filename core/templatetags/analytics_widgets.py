@@ -0,0 +1,10 @@
+from django import template
+from core import analytics
+
+register = template.Library()
+
+
+@register.simple_tag
+def analytics_dashboard(days=30, months=6):
+    """Данные виджетов дашборда из дневных сводок (см. core/analytics.py)."""
+    return analytics.dashboard(days=days, months=months)
@@ -0,0 +1,125 @@
+"""
+Фейковый Telegram API для тестов и нагрузочных прогонов без сети.
+
+FakeTelegramBot подменяет telebot.TeleBot в части get_file/send_*
+(в errors можно сложить исключения для следующих отправок), FakeSession отдает "скачанные" файлы с заданной задержкой, а
+make_message собирает объект апдейта в том виде, в котором его видят
+хендлеры core/bot.py.
+"""
+import itertools
+import threading
+import time
+from types import SimpleNamespace
+
+from telebot.apihelper import ApiTelegramException
+
+_ids = itertools.count(1)
+
+
+def make_message(user_id=1, text=None, photo=None, voice=None, caption=None,
+                 username='client', first_name='Client', message_id=None, date=None):
+    """Сообщение Telegram в минимальном виде, нужном хендлерам."""
+    content_type = 'photo' if photo else 'voice' if voice else 'text'
+    return SimpleNamespace(
+        message_id=message_id or next(_ids),
+        content_type=content_type,
+        date=date or int(time.time()),
+        text=text,
+        caption=caption,
+        photo=[SimpleNamespace(file_id=photo)] if photo else None,
+        voice=SimpleNamespace(file_id=voice) if voice else None,
+        from_user=SimpleNamespace(id=user_id, username=username, first_name=first_name),
+        chat=SimpleNamespace(id=user_id),
+    )
+
+
+class FakeTelegramBot:
+    token = '123456:FAKE'
+
+    def __init__(self, errors=None):
+        self.sent = []
+        self.errors = list(errors or [])
+        self._lock = threading.Lock()
+
+    def get_file(self, file_id):
+        return SimpleNamespace(file_id=file_id, file_path=f'files/{file_id}')
+
+    def _record(self, method, chat_id, payload, **kwargs):
+        with self._lock:
+            if self.errors:
+                raise self.errors.pop(0)
+            self.sent.append((method, str(chat_id), payload, kwargs))
+        return SimpleNamespace(message_id=next(_ids))
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self._record('send_message', chat_id, text, **kwargs)
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        return self._record('send_photo', chat_id, photo, **kwargs)
+
+    def send_document(self, chat_id, document, **kwargs):
+        return self._record('send_document', chat_id, document, **kwargs)
+
+
+def api_error(code, description='Error', retry_after=None):
+    """Ошибка Bot API в том виде, в котором ее бросает telebot."""
+    result_json = {'ok': False, 'error_code': code, 'description': description}
+    if retry_after:
+        result_json['parameters'] = {'retry_after': retry_after}
+    return ApiTelegramException('sendMessage', SimpleNamespace(status_code=code), result_json)
+
+
+class FakeResponse:
+    def __init__(self, body, status_code=200):
+        self.body = body
+        self.status_code = status_code
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise IOError(f'HTTP {self.status_code}')
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+
+class FakeSession:
+    """Отдает файл размером size байт (или body) через latency секунд и считает параллельность."""
+
+    def __init__(self, size=1024, latency=0.0, status_code=200, body=None):
+        self.size = size
+        self.body = body
+        self.latency = latency
+        self.status_code = status_code
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def get(self, url, stream=False, timeout=None):
+        with self._lock:
+            self.requests.append(url)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.latency)
+        finally:
+            with self._lock:
+                self.active -= 1
+        return FakeResponse(self.body if self.body is not None else b'x' * self.size, self.status_code)
+
+
+def make_jpeg(size=(1600, 1200), color=(200, 30, 30)):
+    """Настоящая JPEG-картинка для проверки превью (нужен Pillow)."""
+    from io import BytesIO
+    from PIL import Image
+
+    buffer = BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'JPEG')
+    return buffer.getvalue()
@@ -1,3 +1,2057 @@
-from django.test import TestCase
+import asyncio
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from PIL import Image
+
+from asgiref.sync import iscoroutinefunction
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, OperationalError, close_old_connections, connection
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import analytics, benchmark, broadcast, events, media, metrics, search, unread, webhook
+from . import bot as telegram
+from .ingest import MediaPipeline, MessageWriter, PendingMessage
+from .lead_cache import LeadCache, lead_cache
+from .metrics import MetricsServer, Registry
+from .outbox import Outbox, RateLimiter
+from .perf import PerfMiddleware
+from .testing import FakeSession, FakeTelegramBot, api_error, make_jpeg, make_message
+from .models import Lead, ChatMessage, DeliveryStatus, Broadcast, BroadcastRecipient, DailyStat, TelegramUpdate, Student, Group, Lesson, Attendance, Tariff, Payment, Task, Teacher
+from .phones import normalize_phone
+from .views import SIDEBAR_ORDER
+
+AJAX = {'HTTP_X_REQUESTED_WITH': 'XMLHttpRequest'}
+
+# Замеры запросов (core/perf.py) и события бота не печатаем на каждый тестовый запрос
+logging.getLogger('core.perf').setLevel(logging.WARNING)
+logging.getLogger('core').setLevel(logging.WARNING)
+
+
+def make_lead(n, **kwargs):
+    defaults = {'first_name': f'Lead {n}', 'telegram_id': f'tg_{n}', 'status': 'process'}
+    defaults.update(kwargs)
+    return Lead.objects.create(**defaults)
+
+
+class ChatDeltaTests(TestCase):
+    def setUp(self):
+        self.staff = User.objects.create_user('manager', password='pass', is_staff=True)
+        self.client.force_login(self.staff)
+        self.lead = make_lead(0)
+        ChatMessage.objects.create(lead=self.lead, text='Привет')
+
+    def poll(self, lead=None, **params):
+        url = reverse('chat_dashboard', args=[lead.id]) if lead else reverse('chat_index')
+        return self.client.get(url, params, **AJAX).json()
+
+    def test_full_load_returns_cursor(self):
+        data = self.poll(self.lead)
+        self.assertEqual(data['cursor'], ChatMessage.objects.latest('id').id)
+        self.assertEqual([m['text'] for m in data['messages']], ['Привет'])
+        self.assertEqual(len(data['leads']), 1)
+
+    def test_delta_returns_only_new_messages_and_changed_leads(self):
+        first = self.poll(self.lead)
+        other = make_lead(1)
+        make_lead(2)
+        ChatMessage.objects.create(lead=self.lead, text='Еще вопрос')
+        ChatMessage.objects.create(lead=other, text='Другой чат')
+
+        data = self.poll(self.lead, since=first['cursor'], ts=first['ts'])
+        self.assertTrue(data['delta'])
+        self.assertEqual([m['text'] for m in data['messages']], ['Еще вопрос'])
+        self.assertTrue({l['id'] for l in data['leads']} >= {self.lead.id, other.id})
+        self.assertEqual(data['cursor'], ChatMessage.objects.latest('id').id)
+
+    def test_idle_poll_cost_does_not_grow_with_data(self):
+        first = self.poll(self.lead)
+        params = {'since': first['cursor'], 'ts': first['ts']}
+
+        # сессия + пользователь + открытый лид + новые сообщения + изменившиеся лиды
+        with self.assertNumQueries(5):
+            data = self.poll(self.lead, **params)
+        self.assertEqual(data['leads'], [])
+        self.assertEqual(data['messages'], [])
+
+        for n in range(1, 30):
+            ChatMessage.objects.create(lead=make_lead(n), text='old')
+        first = self.poll(self.lead)
+        params = {'since': first['cursor'], 'ts': first['ts']}
+
+        with self.assertNumQueries(5):
+            data = self.poll(self.lead, **params)
+        self.assertEqual(data['leads'], [])
+
+    @override_settings(CHAT_DELTA_MAX_MESSAGES=3)
+    def test_stale_cursor_gets_resync_instead_of_backlog(self):
+        first = self.poll(self.lead)
+        for n in range(4):
+            ChatMessage.objects.create(lead=make_lead(n + 1), text='old')
+
+        # Вкладка долго спала - не вычитываем все, что накопилось, а просим перечитать
+        with self.assertNumQueries(4):
+            data = self.poll(self.lead, since=first['cursor'], ts=first['ts'])
+        self.assertEqual(data, {'delta': True, 'resync': True})
+
+    def test_bad_cursor_is_rejected(self):
+        response = self.client.get(reverse('chat_index'), {'since': 'abc'}, **AJAX)
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse('chat_index'), {'since': 1, 'ts': '2024-13-45T00:00:00'}, **AJAX)
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(CHAT_PAGE_SIZE=5)
+class ChatHistoryPaginationTests(TestCase):
+    def setUp(self):
+        self.staff = User.objects.create_user('manager', password='pass', is_staff=True)
+        self.client.force_login(self.staff)
+        self.lead = make_lead(0)
+        for n in range(12):
+            ChatMessage.objects.create(lead=self.lead, text=f'msg {n}')
+        self.url = reverse('chat_dashboard', args=[self.lead.id])
+
+    def test_full_load_returns_only_latest_page(self):
+        data = self.client.get(self.url, **AJAX).json()
+        self.assertEqual([m['text'] for m in data['messages']], [f'msg {n}' for n in range(7, 12)])
+        self.assertTrue(data['older'])
+
+    def test_before_walks_back_without_gaps_or_overlap(self):
+        data = self.client.get(self.url, **AJAX).json()
+        seen = [m['text'] for m in data['messages']]
+        older = data['older']
+        while older:
+            page = self.client.get(self.url, {'before': older}, **AJAX).json()
+            seen = [m['text'] for m in page['history']] + seen
+            older = page['older']
+        self.assertEqual(seen, [f'msg {n}' for n in range(12)])
+
+    def test_equal_timestamps_are_split_by_id(self):
+        # Сообщения пачкой из бота могут получить одинаковое время
+        ChatMessage.objects.update(created_at=timezone.now())
+        data = self.client.get(self.url, **AJAX).json()
+        page = self.client.get(self.url, {'before': data['older']}, **AJAX).json()
+        ids = [m['id'] for m in page['history']] + [m['id'] for m in data['messages']]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set(ids)), 10)
+
+    def test_page_cost_does_not_grow_with_history(self):
+        data = self.client.get(self.url, **AJAX).json()
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(self.url, {'before': data['older']}, **AJAX)
+
+        ChatMessage.objects.bulk_create(
+            ChatMessage(lead=self.lead, text='old') for _ in range(500)
+        )
+        with CaptureQueriesContext(connection) as large:
+            self.client.get(self.url, {'before': data['older']}, **AJAX)
+        self.assertEqual(len(small.captured_queries), len(large.captured_queries))
+
+    def test_bad_cursor_is_rejected(self):
+        response = self.client.get(self.url, {'before': 'вчера'}, **AJAX)
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(self.url, {'before': '2024-13-45T00:00:00|1'}, **AJAX)
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(SIDEBAR_PAGE_SIZE=5)
+class SidebarPaginationTests(TestCase):
+    def setUp(self):
+        self.staff = User.objects.create_user('manager', password='pass', is_staff=True)
+        self.client.force_login(self.staff)
+        now = timezone.now()
+        statuses = ['new', 'process', 'won']
+        for n in range(23):
+            lead = make_lead(n, status=statuses[n % 3], source='Import' if n % 2 else 'Website')
+            # Часть лидов без сообщений (NULL), у части одинаковое время
+            if n % 4:
+                Lead.objects.filter(pk=lead.pk).update(last_msg_time=now - timedelta(minutes=n // 2))
+        self.url = reverse('chat_index')
+
+    def walk(self, **params):
+        data = self.client.get(self.url, params, **AJAX).json()
+        ids = [l['id'] for l in data['leads']]
+        pages = 1
+        while data['next']:
+            data = self.client.get(self.url, {**params, 'after': data['next']}, **AJAX).json()
+            ids += [l['id'] for l in data['leads']]
+            pages += 1
+        return ids, pages
+
+    def expected(self, **filters):
+        return list(Lead.objects.filter(**filters).order_by(*SIDEBAR_ORDER).values_list('id', flat=True))
+
+    def test_pages_cover_all_leads_in_sidebar_order(self):
+        ids, pages = self.walk()
+        self.assertEqual(ids, self.expected())
+        self.assertEqual(pages, 5)
+
+    def test_filters_by_status_and_source(self):
+        ids, _ = self.walk(status='new', source='Import')
+        self.assertEqual(ids, self.expected(status='new', source='Import'))
+        self.assertTrue(ids)
+
+    def test_unknown_status_filter_is_ignored(self):
+        data = self.client.get(self.url, {'status': 'nope'}, **AJAX).json()
+        self.assertEqual(len(data['leads']), 5)
+
+    def test_page_cost_is_bounded(self):
+        first = self.client.get(self.url, **AJAX).json()
+        Lead.objects.bulk_create(
+            Lead(first_name='old', telegram_id=f'bulk_{n}', status='lost') for n in range(300)
+        )
+        with CaptureQueriesContext(connection) as ctx:
+            data = self.client.get(self.url, {'after': first['next']}, **AJAX).json()
+        self.assertEqual(len(data['leads']), 5)
+        # сессия + пользователь + не больше четырех веток курсора
+        self.assertLessEqual(len(ctx.captured_queries), 6)
+
+    def test_bad_cursor_is_rejected(self):
+        response = self.client.get(self.url, {'after': 'new|x|y|1'}, **AJAX)
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(self.url, {'after': 'new||2024-13-45T00:00:00|1'}, **AJAX)
+        self.assertEqual(response.status_code, 400)
+
+    def test_delta_asks_for_resync_after_mass_change(self):
+        first = self.client.get(self.url, **AJAX).json()
+        Lead.objects.update(updated_at=timezone.now() + timedelta(seconds=1))
+        data = self.client.get(self.url, {'since': first['cursor'], 'ts': first['ts']}, **AJAX).json()
+        self.assertTrue(data['resync'])
+        self.assertEqual(data['leads'], [])
+
+
+class FullTextSearchTests(TestCase):
+    def setUp(self):
+        self.staff = User.objects.create_user('manager', password='pass', is_staff=True, is_superuser=True)
+        self.client.force_login(self.staff)
+        self.asker = make_lead(0, first_name='Дилноза')
+        self.other = make_lead(1, first_name='Азиз', manager_comment='Хочет HSK4 вечером')
+        ChatMessage.objects.create(lead=self.asker, text='Здравствуйте! Есть ВЕЧЕРНИЕ группы HSK4?')
+        ChatMessage.objects.create(lead=self.asker, text='Спасибо')
+        ChatMessage.objects.create(lead=make_lead(2), text='Группы HSK3 по утрам')
+
+    def test_messages_found_by_word_prefix_in_any_case(self):
+        results = search.search_messages('вечерн hsk4')
+        self.assertEqual([m.lead_id for m in results], [self.asker.id])
+        self.assertIn('[ВЕЧЕРНИЕ]', results[0].snippet)
+
+    def test_leads_matched_by_own_fields_come_first(self):
+        self.assertEqual(search.lead_ids('HSK4 вечер'), [self.other.id, self.asker.id])
+
+    def test_index_follows_updates_and_deletes(self):
+        msg = ChatMessage.objects.create(lead=self.asker, text='Оплачу завтра')
+        self.assertEqual(len(search.search_messages('оплачу')), 1)
+        ChatMessage.objects.filter(pk=msg.pk).update(text='Оплатил')
+        self.assertEqual(search.search_messages('оплачу'), [])
+        self.assertEqual(len(search.search_messages('оплатил')), 1)
+        msg.delete()
+        self.assertEqual(search.search_messages('оплатил'), [])
+
+        Lead.objects.bulk_create([Lead(first_name='Шахзод', telegram_id='import_1')])
+        self.assertEqual(len(search.search_leads('шахзод')), 1)
+
+    def test_query_syntax_from_user_is_ignored(self):
+        for query in ['"HSK4', 'HSK4 OR *', 'NEAR(a b)', '***', '']:
+            search.search_messages(query)
+            search.lead_ids(query)
+
+    def test_api_returns_leads_and_messages(self):
+        data = self.client.get(reverse('api_search'), {'q': 'вечер'}).json()
+        self.assertEqual(data['messages'][0]['lead'], self.asker.id)
+        self.assertEqual({l['id'] for l in data['leads']}, {self.asker.id, self.other.id})
+
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('api_search'), {'q': 'hsk4'}).status_code, 302)
+
+    def test_admin_search_finds_lead_by_conversation(self):
+        response = self.client.get(reverse('admin:core_lead_changelist'), {'q': 'вечерние группы'})
+        self.assertEqual(list(response.context['cl'].result_list), [self.asker])
+
+    def test_admin_search_keeps_relevance_order(self):
+        newer = make_lead(3, first_name='Камола')
+        ChatMessage.objects.create(lead=newer, text='HSK4 вечером есть?')
+        url = reverse('admin:core_lead_changelist')
+
+        # Совпадение в полях лида выше совпадений в переписке, хотя лид старше
+        results = list(self.client.get(url, {'q': 'HSK4 вечер'}).context['cl'].result_list)
+        self.assertEqual(results[0], self.other)
+        self.assertEqual(set(results), {self.other, self.asker, newer})
+
+        # Сортировку, выбранную менеджером, не трогаем
+        results = self.client.get(url, {'q': 'HSK4 вечер', 'o': '-1'}).context['cl'].result_list
+        self.assertEqual(list(results), sorted(results, key=lambda lead: lead.first_name, reverse=True))
+
+    def test_rebuild_command_and_like_fallback(self):
+        out = StringIO()
+        call_command('rebuild_search_index', stdout=out)
+        self.assertIn('пересобран', out.getvalue())
+        self.assertEqual(len(search.search_messages('вечерние')), 1)
+
+        with mock.patch.object(search, 'is_available', return_value=False):
+            self.assertEqual([m.lead_id for m in search.search_messages('hsk4')], [self.asker.id])
+            self.assertEqual(set(search.lead_ids('hsk4')), {self.asker.id, self.other.id})
+
+
+class LeadLastMessageTests(TestCase):
+    def test_message_create_updates_lead_summary(self):
+        lead = make_lead(0)
+        ChatMessage.objects.create(lead=lead, text='Первое')
+        msg = ChatMessage.objects.create(lead=lead, msg_type='voice')
+
+        lead.refresh_from_db()
+        self.assertEqual(lead.last_msg_time, msg.created_at)
+        self.assertEqual(lead.last_msg_text, '')
+        self.assertEqual(lead.last_msg_type, 'voice')
+
+    def test_full_save_keeps_newer_summary(self):
+        lead = make_lead(0)
+        # Менеджер открыл форму лида, а клиент тем временем написал
+        form_copy = Lead.objects.get(pk=lead.pk)
+        ChatMessage.objects.create(lead=lead, text='Пока вы редактировали')
+
+        form_copy.manager_comment = 'Перезвонить'
+        form_copy.save()
+
+        lead.refresh_from_db()
+        self.assertEqual(lead.manager_comment, 'Перезвонить')
+        self.assertEqual(lead.last_msg_text, 'Пока вы редактировали')
+        self.assertIsNotNone(lead.last_msg_time)
+
+    def test_full_save_of_missing_row_inserts_it(self):
+        lead = make_lead(0)
+        stale = Lead.objects.get(pk=lead.pk)
+        Lead.objects.filter(pk=lead.pk).delete()
+
+        # Как обычный save() Django: строки нет - вставляем заново
+        stale.manager_comment = 'Вернулся'
+        stale.save()
+        self.assertEqual(Lead.objects.get(pk=lead.pk).manager_comment, 'Вернулся')
+
+        # pk задан руками, строки с ним еще не было
+        Lead(pk=500, first_name='Ли', telegram_id='500').save()
+        self.assertTrue(Lead.objects.filter(pk=500).exists())
+
+    def test_backfill_command(self):
+        lead = make_lead(0)
+        empty = make_lead(1)
+        msg = ChatMessage.objects.create(lead=lead, text='x' * 300)
+        Lead.objects.update(last_msg_time=None, last_msg_text='', last_msg_type='')
+
+        call_command('backfill_last_messages', stdout=StringIO())
+
+        lead.refresh_from_db()
+        empty.refresh_from_db()
+        self.assertEqual(lead.last_msg_time, msg.created_at)
+        self.assertEqual(lead.last_msg_text, 'x' * 255)
+        self.assertEqual(lead.last_msg_type, 'text')
+        self.assertIsNone(empty.last_msg_time)
+        self.assertEqual(empty.last_msg_text, '')
+
+
+class ChatEventsTests(TestCase):
+    def test_broker_fans_out_events_from_other_threads(self):
+        broker = events.InProcessBroker()
+
+        async def receive():
+            first, second = broker.listen(), broker.listen()
+            pending = [asyncio.ensure_future(anext(first)), asyncio.ensure_future(anext(second))]
+            await asyncio.sleep(0)
+            threading.Thread(target=broker.publish, args=({'type': 'lead', 'lead': 1},)).start()
+            results = await asyncio.wait_for(asyncio.gather(*pending), timeout=2)
+            await first.aclose()
+            await second.aclose()
+            return results
+
+        self.assertEqual(asyncio.run(receive()), [{'type': 'lead', 'lead': 1}] * 2)
+        self.assertEqual(broker.subscriber_count(), 0)
+
+    def test_slow_subscriber_gets_resync(self):
+        broker = events.InProcessBroker(maxsize=2)
+
+        async def receive():
+            stream = broker.listen()
+            pending = asyncio.ensure_future(anext(stream))
+            await asyncio.sleep(0)
+            for n in range(5):
+                broker.publish({'type': 'message', 'id': n})
+            received = await asyncio.wait_for(pending, timeout=2)
+            await stream.aclose()
+            return received
+
+        # Очередь переполнилась - вместо потерянных событий приходит resync
+        self.assertEqual(asyncio.run(receive()), {'type': 'resync'})
+
+    def test_watcher_pushes_changes_made_by_other_processes(self):
+        lead = make_lead(0, status='new')
+        broker = mock.Mock()
+        watcher = events.MessageWatcher(broker, 0)
+        last = watcher.snapshot()
+
+        self.assertEqual(watcher.poll(last), last)
+        broker.publish.assert_not_called()
+
+        # Другой процесс (админка, бот) поменял статус лида - без события в наш брокер
+        Lead.objects.filter(pk=lead.pk).update(status='process', updated_at=timezone.now() + timedelta(seconds=1))
+        last = watcher.poll(last)
+        broker.publish.assert_called_once_with({'type': 'lead'})
+
+        broker.reset_mock()
+        msg = ChatMessage.objects.create(lead=lead, text='Из runbot')
+        Lead.objects.filter(pk=lead.pk).update(updated_at=last[1])
+        watcher.poll(last)
+        broker.publish.assert_called_once_with({'type': 'message', 'id': msg.pk})
+
+    def test_watcher_restarts_for_tab_opened_while_it_exits(self):
+        watcher = events.MessageWatcher(events.InProcessBroker(), 60)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        with mock.patch.object(watcher, '_run', release.wait):
+            watcher.ensure_running()
+            first = watcher._thread
+            # Вкладка вызвала ensure_running, но еще не подписалась - поток ее ждет
+            self.assertTrue(watcher._keep_running())
+            # Подписчиков нет - поток выходит, хотя еще жив (закрывает соединение)
+            self.assertFalse(watcher._keep_running())
+            self.assertTrue(first.is_alive())
+            watcher.ensure_running()
+        self.assertIsNot(watcher._thread, first)
+
+    async def test_stream_delivers_published_events(self):
+        staff = await User.objects.acreate(username='manager', is_staff=True)
+        await self.async_client.aforce_login(staff)
+        broker = events.InProcessBroker()
+
+        with mock.patch.object(events, '_broker', broker), \
+                mock.patch.object(events, '_watcher', events.MessageWatcher(broker, 0)):
+            response = await self.async_client.get(reverse('api_events'))
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            stream = aiter(response.streaming_content)
+            self.assertEqual(await anext(stream), b'retry: 3000\n\n')
+
+            pending = asyncio.ensure_future(anext(stream))
+            while not broker.subscriber_count():
+                await asyncio.sleep(0)
+            broker.publish({'type': 'lead', 'lead': 7, 'status': 'new'})
+            chunk = await asyncio.wait_for(pending, timeout=2)
+            await stream.aclose()
+
+        self.assertEqual(chunk, b'event: lead\ndata: {"type": "lead", "lead": 7, "status": "new"}\n\n')
+
+    def test_wsgi_pages_poll_instead_of_streaming(self):
+        staff = User.objects.create(username='manager', is_staff=True)
+        self.client.force_login(staff)
+
+        # Под WSGI поток не дошел бы до браузера - вкладка остается на опросе
+        response = self.client.get(reverse('chat_index'))
+        self.assertFalse(response.context['chat_events_push'])
+        self.assertEqual(self.client.get(reverse('api_events')).status_code, 501)
+
+    async def test_asgi_pages_open_event_stream(self):
+        staff = await User.objects.acreate(username='manager', is_staff=True)
+        await self.async_client.aforce_login(staff)
+
+        response = await self.async_client.get(reverse('chat_index'))
+        self.assertTrue(response.context['chat_events_push'])
+
+    def test_writes_publish_after_commit(self):
+        broker = mock.Mock()
+        with mock.patch.object(events, '_broker', broker):
+            with self.captureOnCommitCallbacks(execute=True):
+                lead = make_lead(0)
+                msg = ChatMessage.objects.create(lead=lead, text='Привет')
+                self.assertFalse(broker.publish.called)
+
+        broker.publish.assert_any_call({'type': 'lead', 'lead': lead.id, 'status': 'process'})
+        broker.publish.assert_any_call({'type': 'message', 'lead': lead.id, 'id': msg.id})
+
+
+class MediaPipelineTests(TransactionTestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        override = override_settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.lead = make_lead(0)
+
+    def run_pipeline(self, session, count, workers=4, queue_size=100):
+        pipeline = MediaPipeline(FakeTelegramBot(), workers=workers, queue_size=queue_size, session=session)
+        pipeline.start()
+        messages = []
+        for n in range(count):
+            msg = pipeline.save_message(self.lead, text=f'caption {n}', msg_type='image')
+            # Текст уже в базе, хотя файл еще не скачан
+            self.assertTrue(ChatMessage.objects.filter(pk=msg.pk, attachment='').exists())
+            pipeline.submit(msg, f'file{n}', f'photo_{n}.jpg')
+            messages.append(msg)
+        pipeline.stop()
+        return pipeline, messages
+
+    def test_downloads_are_concurrent_and_bounded(self):
+        session = FakeSession(size=200 * 1024, latency=0.05)
+        pipeline, messages = self.run_pipeline(session, count=12, workers=3)
+
+        self.assertEqual(session.max_active, 3)
+        stats = pipeline.snapshot()
+        self.assertEqual((stats['received'], stats['downloaded'], stats['failed']), (12, 12, 0))
+        self.assertEqual(stats['bytes'], 12 * 200 * 1024)
+        self.assertEqual(stats['queue_depth'], 0)
+        for msg in messages:
+            msg.refresh_from_db()
+            self.assertEqual(msg.attachment.size, 200 * 1024)
+        # Одинаковые файлы легли на диск один раз
+        self.assertEqual(len({msg.attachment.name for msg in messages}), 1)
+
+    def test_full_queue_applies_backpressure(self):
+        pipeline, _ = self.run_pipeline(FakeSession(latency=0.05), count=6, workers=1, queue_size=1)
+        self.assertGreater(pipeline.snapshot()['blocked'], 0)
+        self.assertEqual(pipeline.snapshot()['downloaded'], 6)
+
+    def test_failed_download_keeps_text(self):
+        pipeline, messages = self.run_pipeline(FakeSession(status_code=404), count=1)
+        self.assertEqual(pipeline.snapshot()['failed'], 1)
+        msg = ChatMessage.objects.get(pk=messages[0].pk)
+        self.assertEqual((msg.text, msg.attachment.name), ('caption 0', ''))
+        self.assertIn('404', msg.media_error)
+
+        # Открытая лента получает ошибку вместо файла и перестает его ждать
+        self.client.force_login(User.objects.create_user('manager', password='pass', is_staff=True))
+        data = self.client.get(
+            reverse('chat_dashboard', args=[self.lead.id]), {'since': msg.pk, 'pending': msg.pk}, **AJAX,
+        ).json()
+        self.assertEqual([(m['id'], m['file_url']) for m in data['media']], [(msg.pk, None)])
+        self.assertIn('404', data['media'][0]['media_error'])
+
+    def test_pipeline_builds_thumbnail_for_images_only(self):
+        pipeline = MediaPipeline(FakeTelegramBot(), workers=1, session=FakeSession(body=make_jpeg()))
+        pipeline.start()
+        photo = pipeline.save_message(self.lead, msg_type='image')
+        pipeline.submit(photo, 'ph1', 'photo_1.jpg')
+        voice = pipeline.save_message(self.lead, msg_type='voice')
+        pipeline.submit(voice, 'vc1', 'voice_2.ogg')
+        pipeline.stop()
+
+        photo.refresh_from_db()
+        voice.refresh_from_db()
+        with Image.open(photo.thumbnail.path) as thumb:
+            self.assertLessEqual(max(thumb.size), 320)
+        self.assertFalse(voice.thumbnail)
+
+        self.client.force_login(User.objects.create_user('manager', password='pass', is_staff=True))
+        data = self.client.get(reverse('chat_dashboard', args=[self.lead.id]), **AJAX).json()
+        urls = {m['id']: m['thumb_url'] for m in data['messages']}
+        self.assertEqual(urls[photo.id], photo.thumbnail.url)
+        self.assertIsNone(urls[voice.id])
+
+    def test_bot_handlers_use_pipeline(self):
+        pipeline = MediaPipeline(FakeTelegramBot(), workers=2, session=FakeSession())
+        pipeline.start()
+        with mock.patch.object(telegram, 'pipeline', pipeline):
+            telegram.handle_text(make_message(user_id=42, text='Здравствуйте'))
+            telegram.handle_photo(make_message(user_id=42, photo='ph1', caption='Скрин'))
+            telegram.handle_voice(make_message(user_id=42, voice='vc1'))
+        pipeline.stop()
+
+        lead = Lead.objects.get(telegram_id='42')
+        self.assertEqual(
+            [(m.msg_type, bool(m.attachment)) for m in lead.messages.order_by('id')],
+            [('text', False), ('image', True), ('voice', True)],
+        )
+
+
+class ChatMediaStorageTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        override = override_settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.lead = make_lead(0)
+
+    def stored_files(self, directory='chat_files'):
+        found = []
+        for root, _, files in os.walk(os.path.join(self.media_root, directory)):
+            found += files
+        return found
+
+    def test_identical_content_is_stored_once(self):
+        first = ChatMessage.objects.create(lead=self.lead, attachment=ContentFile(b'same', name='Still_1.JPG'))
+        second = ChatMessage.objects.create(lead=self.lead, attachment=ContentFile(b'same', name='Still_1_copy.jpg'))
+        other = ChatMessage.objects.create(lead=self.lead, attachment=ContentFile(b'other', name='Still_2.jpg'))
+
+        self.assertEqual(first.attachment.name, second.attachment.name)
+        self.assertNotEqual(first.attachment.name, other.attachment.name)
+        self.assertTrue(media.is_hashed(first.attachment.name))
+        self.assertTrue(first.attachment.name.endswith('.jpg'))
+        self.assertEqual(len(self.stored_files()), 2)
+
+    def test_concurrent_save_of_the_same_blob(self):
+        # Оба потока увидели, что файла еще нет, и пишут одно и то же содержимое
+        barrier = threading.Barrier(2)
+        names = []
+
+        def save():
+            barrier.wait(timeout=5)
+            names.append(media.chat_storage.save('chat_files/photo.jpg', ContentFile(b'same blob')))
+
+        with mock.patch.object(media.ContentAddressedStorage, 'exists', return_value=False):
+            threads = [threading.Thread(target=save, daemon=True) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(timeout=5)
+
+        self.assertEqual(len(names), 2)
+        self.assertEqual(names[0], names[1])
+        self.assertEqual(self.stored_files(), [os.path.basename(names[0])])
+        with media.chat_storage.open(names[0]) as f:
+            self.assertEqual(f.read(), b'same blob')
+
+    def test_dedup_command_moves_legacy_files(self):
+        os.makedirs(os.path.join(self.media_root, 'chat_files'))
+        jpeg = make_jpeg()
+        for name in ('Still_1.jpg', 'Still_1_copy.jpg'):
+            with open(os.path.join(self.media_root, 'chat_files', name), 'wb') as f:
+                f.write(jpeg)
+            msg = ChatMessage.objects.create(lead=self.lead, msg_type='image')
+            ChatMessage.objects.filter(pk=msg.pk).update(attachment=f'chat_files/{name}')
+        lost = ChatMessage.objects.create(lead=self.lead, msg_type='image')
+        ChatMessage.objects.filter(pk=lost.pk).update(attachment='chat_files/lost.jpg')
+
+        out = StringIO()
+        call_command('dedup_chat_media', stdout=out)
+
+        names = set(ChatMessage.objects.exclude(attachment='chat_files/lost.jpg').values_list('attachment', flat=True))
+        self.assertEqual(len(names), 1)
+        self.assertTrue(media.is_hashed(names.pop()))
+        self.assertEqual(len(self.stored_files()), 1)
+        self.assertEqual(len(self.stored_files('chat_thumbs')), 1)
+        self.assertIn('Удалено старых копий: 2', out.getvalue())
+        self.assertIn('Файлов нет на диске: 1', out.getvalue())
+
+
+class MediaServingTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        override = override_settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.client.force_login(User.objects.create_user('manager', password='pass', is_staff=True))
+
+        self.body = bytes(range(256)) * 40
+        msg = ChatMessage.objects.create(lead=make_lead(0), msg_type='voice',
+                                         attachment=ContentFile(self.body, name='voice_1.ogg'))
+        self.url = msg.attachment.url
+        with open(os.path.join(self.media_root, 'chat_files', 'legacy.pdf'), 'wb') as f:
+            f.write(b'%PDF-1.4 legacy')
+
+    def content(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_full_file_is_streamed_with_immutable_cache(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.content(response), self.body)
+        self.assertEqual(response['Content-Type'], 'audio/ogg')
+        self.assertEqual(response['Content-Length'], str(len(self.body)))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertIn('immutable', response['Cache-Control'])
+
+        legacy = self.client.get('/media/chat_files/legacy.pdf')
+        self.assertEqual(legacy['Cache-Control'], 'private, no-cache')
+
+    def test_manager_image_thumbnail_is_built_on_first_fetch(self):
+        lead = make_lead(1, telegram_id='111')
+        chat_url = reverse('chat_dashboard', args=[lead.id])
+        photo = SimpleUploadedFile('scan.jpg', make_jpeg(), content_type='image/jpeg')
+        self.client.post(chat_url, {'message_text': '', 'attachment': photo})
+        msg = ChatMessage.objects.get(lead=lead)
+        # Запрос отправки превью не строил - только записал его будущее имя
+        self.assertTrue(msg.thumbnail.name.startswith('chat_thumbs/'))
+        self.assertFalse(os.path.exists(msg.thumbnail.path))
+
+        response = self.client.get(msg.thumbnail.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertTrue(os.path.exists(msg.thumbnail.path))
+        # Имя превью выводится из хэша оригинала - кэшируется навсегда, как и он
+        self.assertEqual(response['Cache-Control'], 'private, max-age=31536000, immutable')
+
+        broken = SimpleUploadedFile('broken.jpg', b'not a jpeg', content_type='image/jpeg')
+        self.client.post(chat_url, {'message_text': '', 'attachment': broken})
+        msg = ChatMessage.objects.filter(lead=lead).latest('id')
+        with self.assertLogs('core.media', 'WARNING'):
+            response = self.client.get(msg.thumbnail.url)
+        # Превью не выходит - отдаем оригинал, и лента больше его не просит
+        self.assertRedirects(response, msg.attachment.url, fetch_redirect_response=False)
+        msg.refresh_from_db()
+        self.assertFalse(msg.thumbnail)
+
+    def test_range_requests(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(self.content(response), self.body[10:20])
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.body)}')
+        self.assertEqual(response['Content-Length'], '10')
+
+        self.assertEqual(self.content(self.client.get(self.url, HTTP_RANGE='bytes=-5')), self.body[-5:])
+        self.assertEqual(self.content(self.client.get(self.url, HTTP_RANGE='bytes=10000-')), self.body[10000:])
+
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={len(self.body)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.body)}')
+
+        # Конец раньше начала - не ошибка, а повод отдать файл целиком
+        response = self.client.get(self.url, HTTP_RANGE='bytes=5-3')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.content(response), self.body)
+
+    def test_conditional_requests(self):
+        first = self.client.get(self.url)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag']).status_code, 304)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=first['Last-Modified']).status_code, 304)
+
+        # Файл "поменялся" - вместо куска отдаем его целиком
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_access_and_paths(self):
+        self.assertEqual(self.client.get('/media/../config/settings.py').status_code, 404)
+        self.assertEqual(self.client.get('/media/chat_files/missing.jpg').status_code, 404)
+        self.assertEqual(self.client.get('/media/chat_files/').status_code, 404)
+        self.client.logout()
+        self.assertEqual(self.client.get(self.url).status_code, 302)
+
+    def test_sendfile_modes(self):
+        path = self.url[len('/media/'):]
+        with override_settings(MEDIA_SENDFILE='x-accel-redirect'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{path}')
+        self.assertEqual(response.content, b'')
+        self.assertIn('immutable', response['Cache-Control'])
+
+        with override_settings(MEDIA_SENDFILE='x-sendfile'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Sendfile'], os.path.join(self.media_root, path))
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class OutboxTests(TestCase):
+    def setUp(self):
+        self.staff = User.objects.create_user('manager', password='pass', is_staff=True)
+        self.client.force_login(self.staff)
+        self.lead = make_lead(0, telegram_id='111')
+        self.clock = FakeClock()
+        self.bot = FakeTelegramBot()
+        self.outbox = Outbox(self.bot, limiter=RateLimiter(per_second=30, per_chat_interval=1, clock=self.clock))
+
+    def queue(self, lead=None, text='Ответ'):
+        return ChatMessage.objects.create(
+            lead=lead or self.lead, text=text, is_from_manager=True, delivery_status=DeliveryStatus.QUEUED,
+        )
+
+    def test_dashboard_queues_reply_without_calling_telegram(self):
+        with mock.patch('core.outbox.Outbox.send') as send:
+            response = self.client.post(reverse('chat_dashboard', args=[self.lead.id]), {'message_text': 'Здравствуйте'})
+        self.assertEqual(response.status_code, 302)
+        send.assert_not_called()
+        msg = ChatMessage.objects.get(lead=self.lead)
+        self.assertEqual(msg.delivery_status, DeliveryStatus.QUEUED)
+        self.assertTrue(msg.is_from_manager)
+
+    def test_run_once_sends_and_marks_sent(self):
+        msg = self.queue()
+        self.assertEqual(self.outbox.run_once(), 1)
+        self.assertEqual(self.bot.sent[0][:3], ('send_message', '111', 'Ответ'))
+        msg.refresh_from_db()
+        self.assertEqual(msg.delivery_status, DeliveryStatus.SENT)
+        self.assertEqual(msg.delivery_attempts, 1)
+
+    def test_transient_error_is_retried_with_backoff(self):
+        msg = self.queue()
+        self.bot.errors = [api_error(502, 'Bad Gateway')]
+        self.assertEqual(self.outbox.run_once(), 0)
+        msg.refresh_from_db()
+        self.assertEqual(msg.delivery_status, DeliveryStatus.QUEUED)
+        self.assertEqual(msg.delivery_attempts, 1)
+        self.assertGreater(msg.next_attempt_at, timezone.now() + timedelta(seconds=1))
+
+        # Рано - не трогаем
+        self.assertEqual(self.outbox.run_once(), 0)
+        ChatMessage.objects.filter(pk=msg.pk).update(next_attempt_at=timezone.now())
+        self.clock.now += 1
+        self.assertEqual(self.outbox.run_once(), 1)
+        msg.refresh_from_db()
+        self.assertEqual(msg.delivery_status, DeliveryStatus.SENT)
+        self.assertEqual(msg.delivery_attempts, 2)
+
+    def test_flood_wait_respects_retry_after(self):
+        msg = self.queue()
+        self.bot.errors = [api_error(429, 'Too Many Requests', retry_after=40)]
+        self.outbox.run_once()
+        msg.refresh_from_db()
+        self.assertGreater(msg.next_attempt_at, timezone.now() + timedelta(seconds=35))
+
+    def test_permanent_error_fails_immediately(self):
+        msg = self.queue()
+        self.bot.errors = [api_error(403, 'Forbidden: bot was blocked by the user')]
+        self.outbox.run_once()
+        msg.refresh_from_db()
+        self.assertEqual(msg.delivery_status, DeliveryStatus.FAILED)
+        self.assertIn('blocked', msg.delivery_error)
+
+    def test_gives_up_after_max_attempts(self):
+        msg = self.queue()
+        ChatMessage.objects.filter(pk=msg.pk).update(delivery_attempts=self.outbox.max_attempts - 1)
+        self.bot.errors = [ConnectionError('timeout')]
+        self.outbox.run_once()
+        msg.refresh_from_db()
+        self.assertEqual(msg.delivery_status, DeliveryStatus.FAILED)
+
+    def test_per_chat_limit_and_order(self):
+        other = make_lead(1, telegram_id='222')
+        first, second = self.queue(text='1'), self.queue(text='2')
+        self.queue(lead=other, text='другой чат')
+
+        # Второе сообщение в тот же чат ждет секунду, другой чат не ждет
+        self.assertEqual(self.outbox.run_once(), 2)
+        self.assertEqual([(chat, text) for _, chat, text, _ in self.bot.sent], [('111', '1'), ('222', 'другой чат')])
+        self.clock.now += 1
+        self.assertEqual(self.outbox.run_once(), 1)
+        self.assertEqual(self.bot.sent[-1][2], '2')
+
+    def test_retry_blocks_later_messages_of_same_chat(self):
+        self.queue(text='1')
+        second = self.queue(text='2')
+        self.bot.errors = [api_error(500, 'Internal Server Error')]
+        self.outbox.run_once()
+        self.clock.now += 5
+        self.assertEqual(self.outbox.run_once(), 0)
+        second.refresh_from_db()
+        self.assertEqual(second.delivery_status, DeliveryStatus.QUEUED)
+
+    def test_message_is_claimed_once(self):
+        msg = self.queue()
+        stale = ChatMessage.objects.get(pk=msg.pk)
+        self.assertTrue(self.outbox.claim(msg))
+        self.assertFalse(self.outbox.claim(stale))
+
+    def test_delta_reports_delivery_status(self):
+        msg = self.queue()
+        first = self.client.get(reverse('chat_dashboard', args=[self.lead.id]), **AJAX).json()
+        self.assertEqual(first['messages'][0]['delivery'], 'queued')
+
+        self.bot.errors = [api_error(400, 'Bad Request: chat not found')]
+        self.outbox.run_once()
+        data = self.client.get(
+            reverse('chat_dashboard', args=[self.lead.id]),
+            {'since': first['cursor'], 'ts': first['ts'], 'outbox': msg.id}, **AJAX,
+        ).json()
+        self.assertEqual(data['delivery'], [{'id': msg.id, 'delivery': 'failed', 'error': 'Bad Request: chat not found'}])
+
+
+class BroadcastTests(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.bot = FakeTelegramBot()
+        self.sender = broadcast.BroadcastSender(
+            self.bot, limiter=RateLimiter(per_second=30, per_chat_interval=1, clock=self.clock),
+        )
+        for n in range(5):
+            make_lead(n, telegram_id=str(1000 + n), status='lost', source='Import')
+        make_lead(5, telegram_id='2000', status='lost', source='Instagram')
+        make_lead(6, telegram_id='web_abc', status='lost', source='Import')
+        make_lead(7, telegram_id='import_abc', status='lost', source='Import')
+
+    def make_broadcast(self, **kwargs):
+        defaults = {'title': 'Скидка', 'text': 'Скидка 20% до пятницы', 'lead_status': 'lost', 'lead_source': 'Import'}
+        defaults.update(kwargs)
+        return Broadcast.objects.create(**defaults)
+
+    def test_segment_skips_leads_without_chat(self):
+        self.assertEqual(broadcast.segment(self.make_broadcast()).count(), 5)
+
+    def test_student_segment_goes_through_lead(self):
+        group = Group.objects.create(name='HSK3 вечер', level='HSK3', days_description='Пн/Ср')
+        lead = Lead.objects.get(telegram_id='2000')
+        Student.objects.create(full_name='Ли', phone='+998901112233', group=group, lead=lead)
+        Student.objects.create(full_name='Без лида', phone='+998901112234', group=group)
+        b = self.make_broadcast(audience='students', group=group)
+        self.assertEqual(list(broadcast.segment(b)), [lead])
+
+    def test_sends_to_every_recipient_and_finishes(self):
+        b = self.make_broadcast()
+        self.assertEqual(broadcast.start(b), 5)
+        self.assertEqual(self.sender.run_once(), 5)
+        self.assertEqual(sorted(chat for _, chat, _, _ in self.bot.sent), [str(1000 + n) for n in range(5)])
+
+        b.refresh_from_db()
+        self.assertEqual(b.status, 'done')
+        stats = broadcast.progress(b)
+        self.assertEqual((stats['sent'], stats['failed'], stats['remaining']), (5, 0, 0))
+
+    def test_round_takes_one_second_of_rate_limit(self):
+        b = self.make_broadcast()
+        broadcast.start(b)
+        self.sender.limiter.per_second = 2
+        self.assertEqual(self.sender.run_once(), 2)
+        b.refresh_from_db()
+        self.assertEqual(b.status, 'running')
+        self.assertEqual(broadcast.progress(b)['remaining'], 3)
+
+    def test_resume_after_crash_does_not_resend(self):
+        b = self.make_broadcast()
+        broadcast.start(b)
+        done = BroadcastRecipient.objects.filter(broadcast=b).order_by('id')[:2]
+        BroadcastRecipient.objects.filter(id__in=[r.id for r in done]).update(delivery_status='sent')
+        # Отправитель упал посреди отправки: lease уже истек
+        stuck = BroadcastRecipient.objects.filter(broadcast=b, delivery_status='queued').order_by('id').first()
+        BroadcastRecipient.objects.filter(pk=stuck.pk).update(
+            delivery_status='sending', next_attempt_at=timezone.now() - timedelta(seconds=1),
+        )
+
+        # Повторный start не создает дублей
+        self.assertEqual(broadcast.start(b), 5)
+        self.assertEqual(self.sender.run_once(), 3)
+        self.assertEqual(BroadcastRecipient.objects.filter(broadcast=b, delivery_status='sent').count(), 5)
+
+    def test_paused_broadcast_is_not_sent(self):
+        b = self.make_broadcast()
+        broadcast.start(b)
+        broadcast.pause(b)
+        self.assertEqual(self.sender.run_once(), 0)
+        broadcast.resume(b)
+        self.assertEqual(self.sender.run_once(), 5)
+
+    def test_blocked_recipient_fails_without_stopping_broadcast(self):
+        b = self.make_broadcast()
+        broadcast.start(b)
+        self.bot.errors = [api_error(403, 'Forbidden: bot was blocked by the user')]
+        self.assertEqual(self.sender.run_once(), 4)
+        b.refresh_from_db()
+        self.assertEqual(b.status, 'done')
+        self.assertEqual(broadcast.progress(b)['failed'], 1)
+
+    def test_estimate_for_large_campaign(self):
+        self.assertEqual(broadcast.format_duration(broadcast.estimate_seconds(50000)), '27 мин')
+
+    def test_command_starts_and_reports(self):
+        b = self.make_broadcast()
+        out = StringIO()
+        call_command('broadcast', b.pk, '--start', stdout=out)
+        self.assertIn('5 получателей', out.getvalue())
+        self.assertIn('отправлено 0/5', out.getvalue())
+
+
+class AnalyticsRollupTests(TestCase):
+    def setUp(self):
+        teacher = Teacher.objects.create(full_name='Ван Лаоши', phone='901')
+        self.group = Group.objects.create(name='HSK3 вечер', level='HSK3', days_description='Пн/Ср', teacher=teacher)
+        self.tariff = Tariff.objects.create(name='8 уроков', price=400000, lessons_count=8)
+
+    def rollups(self):
+        return sorted(DailyStat.objects.values_list('metric', 'day', 'key', 'count', 'total'))
+
+    def fill(self):
+        leads = [make_lead(n, source='Instagram' if n % 2 else 'Telegram') for n in range(4)]
+        students = [
+            Student.objects.create(full_name=f'Ученик {n}', phone=f'90{n:07d}', group=self.group, lead=lead)
+            for n, lead in enumerate(leads[:2])
+        ]
+        Payment.objects.create(student=students[0], tariff=self.tariff)
+        Payment.objects.create(student=students[0], tariff=self.tariff)
+        Payment.objects.create(student=students[1], tariff=None, amount=150000)
+        lessons = make_lessons(2, self.group)
+        Attendance.bulk_mark(lessons[0], {students[0].id: 'present', students[1].id: 'absent'})
+        Attendance.objects.create(lesson=lessons[1], student=students[0], status='present')
+        Attendance.objects.create(lesson=lessons[1], student=students[1], status='excused')
+        return leads, students
+
+    def test_incremental_rollups_match_rebuild(self):
+        self.fill()
+        incremental = self.rollups()
+        self.assertTrue(incremental)
+        analytics.rebuild()
+        self.assertEqual(self.rollups(), incremental)
+
+    def test_revenue_stays_with_group_after_student_moves(self):
+        leads, students = self.fill()
+        other = Group.objects.create(name='HSK4 утро', level='HSK4', days_description='Вт/Чт')
+        student = Student.objects.get(pk=students[0].pk)
+        student.group = other
+        student.save()
+        Payment.objects.create(student=student, tariff=self.tariff)
+
+        incremental = self.rollups()
+        analytics.rebuild()
+        self.assertEqual(self.rollups(), incremental)
+        revenue = {
+            key: total for metric, day, key, count, total in incremental if metric == analytics.REVENUE_GROUP
+        }
+        self.assertEqual(revenue, {str(self.group.pk): 950000, str(other.pk): 400000})
+
+    def test_dashboard_widgets(self):
+        self.fill()
+        stats = analytics.dashboard()
+
+        self.assertEqual(stats['revenue_by_month'][-1]['amount'], 950000)
+        self.assertEqual(
+            [(row['name'], row['count'], row['amount']) for row in stats['revenue_by_tariff']],
+            [('8 уроков', 2, 800000), ('Без тарифа', 1, 150000)],
+        )
+        self.assertEqual(stats['attendance_by_group'], [{'name': 'HSK3 вечер', 'marks': 3, 'rate': 67}])
+        self.assertEqual(stats['attendance_by_teacher'][0]['name'], 'Ван Лаоши')
+        funnel = {row['source']: (row['leads'], row['students'], row['paid']) for row in stats['funnel']}
+        self.assertEqual(funnel, {'Telegram': (2, 1, 1), 'Instagram': (2, 1, 1)})
+
+    def test_dashboard_reads_only_rollups(self):
+        self.fill()
+        # Выручка по дням, 7 сводок за период и названия тарифов, групп и преподавателей -
+        # сколько бы ни было оплат и отметок
+        with self.assertNumQueries(11):
+            analytics.dashboard()
+
+    def test_rebuild_since_keeps_older_days(self):
+        self.fill()
+        old = timezone.localdate() - timedelta(days=40)
+        DailyStat.objects.create(metric=analytics.FUNNEL_LEADS, day=old, key='Архив', count=7)
+        out = StringIO()
+        call_command('rebuild_rollups', '--since', str(timezone.localdate()), stdout=out)
+        self.assertTrue(DailyStat.objects.filter(day=old, key='Архив').exists())
+        self.assertIn('Сводки пересчитаны', out.getvalue())
+
+    def test_student_relink_moves_funnel(self):
+        leads, students = self.fill()
+        student = Student.objects.get(pk=students[0].pk)
+        student.lead = leads[2]
+        student.save()
+        incremental = self.rollups()
+        analytics.rebuild()
+        # Оплаты остаются за студентом - сравниваем только ступень "стал студентом"
+        students_only = lambda rows: [row for row in rows if row[0] == analytics.FUNNEL_STUDENTS]
+        self.assertEqual(students_only(self.rollups()), students_only(incremental))
+
+    def test_admin_index_shows_widgets(self):
+        self.fill()
+        admin_user = User.objects.create_superuser('boss', 'boss@example.com', 'pass')
+        self.client.force_login(admin_user)
+        response = self.client.get(reverse('admin:index'))
+        self.assertContains(response, 'Выручка по месяцам')
+        self.assertContains(response, 'Instagram')
+
+
+class BenchmarkQueryCountTests(TransactionTestCase):
+    def test_queries_from_other_threads_are_counted(self):
+        def work():
+            Lead.objects.count()
+            connection.close()
+
+        def action():
+            thread = threading.Thread(target=action.queries.wrap(work))
+            thread.start()
+            thread.join()
+            Lead.objects.exists()
+        action.queries = benchmark.QueryCounter()
+
+        result = benchmark.measure(action, iterations=2, warmup=0)
+        self.assertEqual(result['queries'], 2)
+
+
+class BenchmarkTests(TestCase):
+    def test_seed_and_run_scenarios(self):
+        rows = benchmark.seed(scale=0.0002, log=lambda *args: None)
+        self.assertEqual((rows['Lead'], rows['ChatMessage'], rows['Student']), (20, 1000, 2))
+        self.assertTrue(search.is_available())
+        self.assertTrue(DailyStat.objects.exists())
+
+        names = [
+            'chat_dashboard.ajax_full', 'chat_dashboard.history_page', 'api_get_unread', 'admin.lead.changelist',
+            'import_leads', 'bot.text_update',
+        ]
+        report = benchmark.run(names, iterations=3, import_iterations=1, import_rows=10, log=lambda *args: None)
+        self.assertEqual(set(report['results']), set(names))
+        unread_stats = report['results']['api_get_unread']
+        self.assertEqual(unread_stats['iterations'], 3)
+        self.assertLessEqual(unread_stats['p50_ms'], unread_stats['p95_ms'])
+        self.assertGreater(unread_stats['queries'], 0)
+        self.assertGreater(report['results']['chat_dashboard.history_page']['queries'], 0)
+        self.assertIn('rows_per_sec', report['results']['import_leads'])
+        self.assertEqual(report['meta']['rows']['Lead'], 20)
+
+    def test_percentile_is_nearest_rank(self):
+        values = list(range(1, 101))
+        self.assertEqual(benchmark.percentile(values, 50), 50)
+        self.assertEqual(benchmark.percentile(values, 95), 95)
+        self.assertEqual(benchmark.percentile([7], 99), 7)
+
+    def test_compare_flags_latency_and_query_regressions(self):
+        def report(p95, queries):
+            return {'results': {'api_get_unread': {'p95_ms': p95, 'queries': queries}}}
+
+        self.assertEqual(benchmark.compare(report(10, 2), report(11, 2)), [])
+        # Шум коротких сценариев не считается регрессией
+        self.assertEqual(benchmark.compare(report(0.2, 2), report(0.5, 2)), [])
+        problems = benchmark.compare(report(10, 2), report(20, 3))
+        self.assertEqual(len(problems), 2)
+
+    def test_seed_refuses_non_empty_database(self):
+        make_lead(0)
+        with self.assertRaisesMessage(CommandError, 'База не пустая'):
+            call_command('benchmark', '--seed', stdout=StringIO())
+
+    def test_run_refuses_database_not_seeded_by_benchmark(self):
+        make_lead(0)
+        with self.assertRaisesMessage(CommandError, 'База не наполнена'):
+            call_command('benchmark', stdout=StringIO())
+        self.assertFalse(User.objects.filter(username='benchmark').exists())
+
+
+# В проде замеряется только доля запросов - здесь все, чтобы замер был в каждом ответе
+@override_settings(PERF_SAMPLE_RATE=1)
+class PerfMiddlewareTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.client.force_login(User.objects.create_superuser('admin', password='pass'))
+        make_lead(0, status='new')
+
+    def timing(self, response):
+        return dict(
+            (part.split(';')[0], part) for part in response['Server-Timing'].split(', ')
+        )
+
+    def test_server_timing_and_log_line(self):
+        with self.assertLogs('core.perf', 'INFO') as logs:
+            first = self.client.get(reverse('api_unread_count'), **AJAX)
+            second = self.client.get(reverse('api_unread_count'), **AJAX)
+
+        self.assertIn('db', self.timing(first))
+        # Первый запрос считает из базы (ETag и тело), второй берет из кэша
+        self.assertIn('misses=1"', self.timing(first)['cache'])
+        self.assertIn('misses=0"', self.timing(second)['cache'])
+
+        record = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(record['view'], 'api_unread_count')
+        self.assertEqual(record['status'], 200)
+        self.assertEqual(record['bytes'], len(second.content))
+        # сессия + пользователь, счетчик из кэша
+        self.assertEqual(record['db_queries'], 2)
+        self.assertEqual(logs.records[-1].perf, record)
+
+    async def test_async_views_stay_async(self):
+        async def view(request):
+            await Lead.objects.acount()
+            lead_cache.get('nobody')
+            return HttpResponse('ok')
+
+        middleware = PerfMiddleware(view)
+        # Под ASGI цепочка не переводится в поток ради middleware
+        self.assertTrue(iscoroutinefunction(middleware))
+        with self.assertLogs('core.perf', 'INFO') as logs:
+            response = await middleware(RequestFactory().get('/async/'))
+
+        self.assertIn('total;dur=', response['Server-Timing'])
+        record = json.loads(logs.records[-1].getMessage())
+        self.assertEqual((record['db_queries'], record['cache_hits'], record['cache_misses']), (1, 0, 1))
+
+    def test_covers_chat_dashboard_and_admin(self):
+        lead = Lead.objects.get()
+        with self.assertLogs('core.perf', 'INFO') as logs:
+            self.client.get(reverse('chat_dashboard', args=[lead.id]))
+            self.client.get(reverse('admin:core_lead_changelist'))
+        views = [json.loads(r.getMessage())['view'] for r in logs.records]
+        self.assertEqual(views, ['chat_dashboard', 'admin:core_lead_changelist'])
+
+    @override_settings(PERF_SAMPLE_RATE=0)
+    def test_sampling_off_passes_request_through(self):
+        with self.assertNoLogs('core.perf', 'INFO'):
+            response = self.client.get(reverse('api_unread_count'), **AJAX)
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    @override_settings(PERF_SLOW_REQUEST_MS=0)
+    def test_slow_request_log_has_sql_and_stack(self):
+        with self.assertLogs('core.perf.slow', 'WARNING') as logs:
+            self.client.get(reverse('api_unread_count'), **AJAX)
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(len(record['sql']), record['db_queries'])
+        self.assertTrue(any('core_lead' in q['sql'] for q in record['sql']))
+        unread_query = next(q for q in record['sql'] if 'core_lead' in q['sql'])
+        self.assertTrue(any('core/unread.py' in frame for frame in unread_query['stack']))
+
+    def test_no_slow_log_without_threshold(self):
+        with self.assertNoLogs('core.perf.slow', 'WARNING'):
+            self.client.get(reverse('api_unread_count'), **AJAX)
+
+
+class BotMetricsTests(TransactionTestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        override = override_settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        lead_cache.clear()
+
+    def run_handlers(self, session, *messages):
+        pipeline = MediaPipeline(FakeTelegramBot(), workers=1, session=session)
+        pipeline.start()
+        with mock.patch.object(telegram, 'pipeline', pipeline):
+            for message in messages:
+                handler = {'text': telegram.handle_text, 'photo': telegram.handle_photo}[message.content_type]
+                handler(message)
+        pipeline.stop()
+
+    def test_registry_renders_prometheus_text(self):
+        registry = Registry()
+        counter = registry.counter('x_total', 'Счетчик', ['kind'])
+        counter.inc(kind='a"b')
+        counter.inc(2, kind='a"b')
+        histogram = registry.histogram('x_seconds', 'Время', buckets=(0.1, 1))
+        histogram.observe(0.1)
+        histogram.observe(0.5)
+        histogram.observe(5)
+
+        text = registry.render()
+        self.assertIn('# TYPE x_total counter\nx_total{kind="a\\"b"} 3\n', text)
+        self.assertIn('x_seconds_bucket{le="0.1"} 1\n', text)
+        self.assertIn('x_seconds_bucket{le="1"} 2\n', text)
+        self.assertIn('x_seconds_bucket{le="+Inf"} 3\n', text)
+        self.assertIn('x_seconds_count 3\n', text)
+        with self.assertRaises(ValueError):
+            counter.inc(other='x')
+
+    def test_metrics_endpoint(self):
+        registry = Registry()
+        registry.gauge('x_depth', 'Очередь', func=lambda: 7)
+        server = MetricsServer(port=0, registry=registry).start()
+        self.addCleanup(server.stop)
+
+        url = f'http://127.0.0.1:{server.port}'
+        with urllib.request.urlopen(f'{url}/metrics') as response:
+            self.assertTrue(response.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+            self.assertIn('x_depth 7', response.read().decode())
+        with self.assertRaises(urllib.error.HTTPError):
+            urllib.request.urlopen(f'{url}/other')
+
+    def test_handlers_record_latency_lag_downloads_and_db_writes(self):
+        updates = metrics.UPDATES.get(content_type='photo')
+        handled = metrics.HANDLER_SECONDS.get(content_type='text')[0]
+        lag_sum = metrics.UPDATE_LAG.get(content_type='text')[1]
+        downloads = metrics.DOWNLOAD_BYTES.get(content_type='image')
+        writes = metrics.DB_WRITE_SECONDS.get(operation='message')[0]
+        lead_writes = metrics.DB_WRITE_SECONDS.get(operation='lead')[0]
+
+        self.run_handlers(
+            FakeSession(size=2048),
+            make_message(user_id=7, text='Здравствуйте', date=int(time.time()) - 30),
+            make_message(user_id=7, photo='ph1'),
+        )
+
+        self.assertEqual(metrics.UPDATES.get(content_type='photo'), updates + 1)
+        self.assertEqual(metrics.HANDLER_SECONDS.get(content_type='text')[0], handled + 1)
+        self.assertGreaterEqual(metrics.UPDATE_LAG.get(content_type='text')[1] - lag_sum, 29)
+        self.assertEqual(metrics.DOWNLOAD_BYTES.get(content_type='image'), (downloads[0] + 1, downloads[1] + 2048))
+        self.assertEqual(metrics.DB_WRITE_SECONDS.get(operation='message')[0], writes + 2)
+        self.assertEqual(metrics.DB_WRITE_SECONDS.get(operation='lead')[0], lead_writes + 2)
+        self.assertIn('bot_media_download_seconds_bucket{content_type="image",le="0.005"}', metrics.REGISTRY.render())
+
+    def test_errors_are_counted_and_logged(self):
+        failures = metrics.DOWNLOAD_FAILURES.get(content_type='image')
+        file_errors = metrics.API_ERRORS.get(method='file', code='404')
+        with self.assertLogs('core.bot', 'WARNING') as logs:
+            self.run_handlers(FakeSession(status_code=404), make_message(user_id=8, photo='ph1'))
+        self.assertEqual(metrics.DOWNLOAD_FAILURES.get(content_type='image'), failures + 1)
+        self.assertEqual(metrics.API_ERRORS.get(method='file', code='404'), file_errors + 1)
+        self.assertEqual(json.loads(logs.records[0].getMessage())['event'], 'media_download_failed')
+
+        handler_errors = metrics.HANDLER_ERRORS.get(content_type='text')
+        with mock.patch.object(telegram, 'get_or_create_lead', side_effect=OperationalError('locked')):
+            with self.assertLogs('core.bot', 'ERROR'), self.assertRaises(OperationalError):
+                telegram.handle_text(make_message(user_id=8, text='Привет'))
+        self.assertEqual(metrics.HANDLER_ERRORS.get(content_type='text'), handler_errors + 1)
+
+        send_errors = metrics.API_ERRORS.get(method='sendMessage', code='403')
+        lead = Lead.objects.get(telegram_id='8')
+        ChatMessage.objects.create(lead=lead, text='Ответ', is_from_manager=True, delivery_status=DeliveryStatus.QUEUED)
+        with self.assertLogs('core.outbox', 'WARNING'):
+            Outbox(FakeTelegramBot(errors=[api_error(403, 'Forbidden: bot was blocked by the user')])).run_once()
+        self.assertEqual(metrics.API_ERRORS.get(method='sendMessage', code='403'), send_errors + 1)
+
+
+def telegram_update(update_id, user_id=500, **message):
+    """Апдейт в том виде, в котором его присылает Telegram (как записанный с живого бота)."""
+    if 'photo' not in message:
+        message.setdefault('text', 'Здравствуйте, сколько стоит курс?')
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id % 1000,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Айгерим', 'username': 'aigerim', 'language_code': 'ru'},
+            'chat': {'id': user_id, 'first_name': 'Айгерим', 'username': 'aigerim', 'type': 'private'},
+            'date': int(time.time()),
+            **message,
+        },
+    }
+
+
+@override_settings(TELEGRAM_WEBHOOK_SECRET='s3cret', TELEGRAM_WEBHOOK_WORKER=False)
+class TelegramWebhookTests(TestCase):
+    def setUp(self):
+        lead_cache.clear()
+        self.pipeline = MediaPipeline(FakeTelegramBot(), workers=1, session=FakeSession())
+        patcher = mock.patch.object(telegram, 'pipeline', self.pipeline)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.dispatcher = webhook.Dispatcher(bot=telegram.make_bot(threaded=False, token='1:TEST'), backoff=0)
+
+    def post(self, payload, secret='s3cret'):
+        headers = {'HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN': secret} if secret else {}
+        body = payload if isinstance(payload, str) else json.dumps(payload)
+        return self.client.post(reverse('telegram_webhook'), body, content_type='application/json', **headers)
+
+    def test_update_is_acknowledged_then_handled_once(self):
+        # Только INSERT апдейта (в тесте - внутри SAVEPOINT)
+        with self.assertNumQueries(3):
+            response = self.post(telegram_update(1001))
+        self.assertEqual(response.status_code, 200)
+        # Ответ ушел до обработки: сообщения еще нет
+        self.assertFalse(ChatMessage.objects.exists())
+
+        # Telegram не дождался ответа и прислал тот же апдейт еще раз
+        self.assertEqual(self.post(telegram_update(1001)).status_code, 200)
+        self.assertEqual(TelegramUpdate.objects.count(), 1)
+
+        self.assertEqual(self.dispatcher.run_once(), 1)
+        self.assertEqual(self.dispatcher.run_once(), 0)
+        self.post(telegram_update(1001))
+        self.assertEqual(self.dispatcher.run_once(), 0)
+
+        msg = ChatMessage.objects.get()
+        self.assertEqual((msg.lead.telegram_id, msg.text), ('500', 'Здравствуйте, сколько стоит курс?'))
+        self.assertEqual(msg.lead.status, 'new')
+        self.assertIsNotNone(TelegramUpdate.objects.get().processed_at)
+
+    def test_updates_are_handled_in_order_by_the_same_handlers(self):
+        photo = [
+            {'file_id': 'small', 'file_unique_id': 'AQADs', 'file_size': 1200, 'width': 90, 'height': 90},
+            {'file_id': 'big', 'file_unique_id': 'AQADb', 'file_size': 98000, 'width': 1280, 'height': 960},
+        ]
+        self.post(telegram_update(2002, photo=photo, caption='Скрин оплаты'))
+        self.post(telegram_update(2001))
+        self.assertEqual(self.dispatcher.run_once(), 2)
+
+        messages = list(ChatMessage.objects.order_by('id').values_list('msg_type', 'text'))
+        self.assertEqual(messages, [('text', 'Здравствуйте, сколько стоит курс?'), ('image', 'Скрин оплаты')])
+        self.assertEqual(self.pipeline.queue.get_nowait().file_id, 'big')
+
+    def test_rejects_bad_requests(self):
+        self.assertEqual(self.post(telegram_update(1), secret='wrong').status_code, 403)
+        self.assertEqual(self.post(telegram_update(1), secret=None).status_code, 403)
+        self.assertEqual(self.post('not json').status_code, 400)
+        self.assertEqual(self.post({'message': {}}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('telegram_webhook')).status_code, 405)
+        with override_settings(TELEGRAM_WEBHOOK_SECRET=''):
+            self.assertEqual(self.post(telegram_update(1)).status_code, 404)
+        self.assertFalse(TelegramUpdate.objects.exists())
+
+    def test_failed_handler_is_retried_then_kept_with_error(self):
+        self.post(telegram_update(3001))
+        dispatcher = webhook.Dispatcher(bot=self.dispatcher.bot, max_attempts=2, backoff=0)
+        with mock.patch.object(telegram, 'get_or_create_lead', side_effect=OperationalError('database is locked')):
+            with self.assertLogs('core.bot', 'WARNING'):
+                self.assertEqual(dispatcher.run_once(), 0)
+                update = TelegramUpdate.objects.get()
+                self.assertEqual((update.attempts, update.processed_at), (1, None))
+                self.assertEqual(dispatcher.run_once(), 0)
+
+        update.refresh_from_db()
+        self.assertEqual(update.attempts, 2)
+        self.assertIsNotNone(update.processed_at)
+        self.assertEqual(update.error, 'database is locked')
+        self.assertEqual(dispatcher.run_once(), 0)
+
+    def test_claim_and_prune(self):
+        self.post(telegram_update(4001))
+        update = TelegramUpdate.objects.get()
+        self.assertTrue(self.dispatcher.claim(update))
+        # Второй процесс с устаревшей копией строки апдейт не получит
+        self.assertFalse(self.dispatcher.claim(update))
+        self.assertEqual(self.dispatcher.pending(), [])
+
+        TelegramUpdate.objects.update(processed_at=timezone.now() - timedelta(days=3))
+        self.assertEqual(self.dispatcher.prune(keep_days=2), 1)
+
+
+@override_settings(TELEGRAM_WEBHOOK_SECRET='s3cret', TELEGRAM_WEBHOOK_WORKER=False)
+class BatchedWebhookTests(TransactionTestCase):
+    def setUp(self):
+        lead_cache.clear()
+        self.pipeline = MediaPipeline(FakeTelegramBot(), workers=1, session=FakeSession(), batch_size=50, batch_delay=60)
+        patcher = mock.patch.object(telegram, 'pipeline', self.pipeline)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.dispatcher = webhook.Dispatcher(bot=telegram.make_bot(threaded=False, token='1:TEST'), backoff=0, flush_timeout=5)
+
+    def test_only_updates_with_written_messages_are_processed(self):
+        self.pipeline.start()
+        self.addCleanup(self.pipeline.stop)
+        webhook.accept(telegram_update(5001, user_id=501, text='Записано'))
+        webhook.accept(telegram_update(5002, user_id=502, text='Сломается'))
+        insert = MessageWriter._insert
+
+        def failing_insert(messages):
+            if any(msg.text == 'Сломается' for msg in messages):
+                raise IntegrityError('FOREIGN KEY constraint failed')
+            insert(messages)
+
+        with mock.patch.object(MessageWriter, '_insert', side_effect=failing_insert):
+            with self.assertLogs('core.bot', 'WARNING'):
+                self.assertEqual(self.dispatcher.run_once(), 1)
+        failed = TelegramUpdate.objects.get(pk=5002)
+        self.assertEqual((failed.processed_at, failed.attempts, failed.error), (None, 1, 'FOREIGN KEY constraint failed'))
+        self.assertIsNotNone(TelegramUpdate.objects.get(pk=5001).processed_at)
+
+        # Повтор переписывает только упавший апдейт - записанное не задваивается
+        self.assertEqual(self.dispatcher.run_once(), 1)
+        self.assertEqual(sorted(ChatMessage.objects.values_list('text', flat=True)), ['Записано', 'Сломается'])
+
+    def test_stuck_writer_fails_the_update_instead_of_hanging(self):
+        # Поток записи не запущен - сообщение так и не окажется в базе
+        self.dispatcher.flush_timeout = 0.05
+        webhook.accept(telegram_update(6001))
+        with self.assertLogs('core.bot', 'WARNING'):
+            self.assertEqual(self.dispatcher.run_once(), 0)
+        update = TelegramUpdate.objects.get()
+        self.assertEqual((update.processed_at, update.attempts), (None, 1))
+        self.assertEqual(update.error, 'Сообщение еще не записано в базу')
+
+
+class MessageWriterTests(TransactionTestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        override = override_settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        lead_cache.clear()
+        self.lead = make_lead(0, status='process')
+
+    def start_writer(self, **kwargs):
+        writer = MessageWriter(**kwargs)
+        writer.start()
+        self.addCleanup(writer.stop)
+        return writer
+
+    def test_full_batch_is_one_transaction(self):
+        writer = self.start_writer(batch_size=3, batch_delay=60)
+        other = make_lead(1, status='new')
+        batches = metrics.WRITE_BATCH_SIZE.get()[0]
+
+        pending = [writer.save(self.lead, 'раз'), writer.save(other, 'два'), writer.save(self.lead, 'три')]
+        saved = [p.wait(timeout=5) for p in pending]
+
+        self.assertEqual([m.text for m in ChatMessage.objects.order_by('id')], ['раз', 'два', 'три'])
+        self.assertEqual([m.pk for m in saved], list(ChatMessage.objects.order_by('id').values_list('pk', flat=True)))
+        self.assertEqual(metrics.WRITE_BATCH_SIZE.get()[0], batches + 1)
+        self.lead.refresh_from_db()
+        # Клиент написал - лид снова "Новый", в сводке последнее сообщение пачки
+        self.assertEqual((self.lead.status, self.lead.last_msg_text), ('new', 'три'))
+
+    def test_partial_batch_is_written_after_delay(self):
+        writer = self.start_writer(batch_size=100, batch_delay=0.02)
+        pending = writer.save(self.lead, 'одно')
+        self.assertIsNone(pending.pk)
+        self.assertEqual(pending.wait(timeout=5).text, 'одно')
+        self.assertIsNotNone(pending.pk)
+
+    def test_flush_and_stop_write_everything_accepted(self):
+        writer = self.start_writer(batch_size=100, batch_delay=60)
+        for n in range(5):
+            writer.save(self.lead, f'm{n}')
+        writer.flush(timeout=5)
+        self.assertEqual(ChatMessage.objects.count(), 5)
+
+        last = writer.save(self.lead, 'перед остановкой')
+        writer.stop()
+        self.assertTrue(last.done())
+        self.assertEqual(ChatMessage.objects.count(), 6)
+
+    def test_failed_batch_is_reported_to_waiters_and_flush(self):
+        writer = self.start_writer(batch_size=1, batch_delay=60)
+        writer.attempts = 1
+        with mock.patch.object(ChatMessage.objects, 'bulk_create', side_effect=OperationalError('database is locked')):
+            with self.assertLogs('core.bot', 'ERROR'):
+                pending = writer.save(self.lead, 'потеряется?')
+                with self.assertRaises(OperationalError):
+                    pending.wait(timeout=5)
+                with self.assertRaises(OperationalError):
+                    writer.flush(timeout=5)
+        # Ошибка сообщается один раз
+        writer.flush(timeout=5)
+        self.assertFalse(ChatMessage.objects.exists())
+
+    def test_deleted_lead_drops_only_its_messages(self):
+        writer = self.start_writer(batch_size=3, batch_delay=60)
+        gone = make_lead(1)
+        dropped = metrics.MESSAGES_DROPPED.get()
+        # Лида удалили из админки, а бот еще держит его в кэше
+        Lead.objects.filter(pk=gone.pk).delete()
+
+        with self.assertLogs('core.bot', 'WARNING') as logs:
+            burst = [writer.save(self.lead, 'раз'), writer.save(gone, 'в пустоту'), writer.save(self.lead, 'два')]
+            self.assertEqual(burst[0].wait(timeout=5).text, 'раз')
+            with self.assertRaises(IntegrityError):
+                burst[1].wait(timeout=5)
+            self.assertEqual(burst[2].wait(timeout=5).text, 'два')
+            with self.assertRaises(IntegrityError):
+                writer.flush(timeout=5)
+        events = [json.loads(record.getMessage())['event'] for record in logs.records]
+        self.assertEqual(events, ['message_batch_failed', 'message_dropped'])
+        self.assertEqual(metrics.MESSAGES_DROPPED.get(), dropped + 1)
+
+        # Поток записи жив: следующие сообщения доходят до базы
+        writer.save(self.lead, 'три')
+        writer.flush(timeout=5)
+        self.assertEqual(list(ChatMessage.objects.order_by('id').values_list('text', flat=True)), ['раз', 'два', 'три'])
+
+    def test_deleted_cached_lead_is_relinked(self):
+        gone = telegram.get_or_create_lead(make_message(user_id=9, first_name='Ли'))
+        # Удаление в другом процессе (админка): до нашего кэша оно не доходит
+        Lead.objects.filter(pk=gone.pk).delete()
+        self.assertEqual(lead_cache.get('9').id, gone.pk)
+
+        # Ошибка внешнего ключа при записи сообщения - лид ищется (создается) заново
+        with mock.patch.object(telegram, 'pipeline', MediaPipeline(FakeTelegramBot(), workers=1)):
+            telegram.handle_text(make_message(user_id=9, first_name='Ли', text='Снова пишу'))
+
+        msg = ChatMessage.objects.get()
+        self.assertEqual(msg.text, 'Снова пишу')
+        self.assertNotEqual(msg.lead_id, gone.pk)
+        self.assertEqual((msg.lead.telegram_id, msg.lead.status), ('9', 'new'))
+        self.assertEqual(lead_cache.get('9').id, msg.lead_id)
+
+    def test_deleted_cached_lead_is_relinked_in_batch(self):
+        pipeline = MediaPipeline(FakeTelegramBot(), workers=1, batch_size=50, batch_delay=60)
+        pipeline.start()
+        self.addCleanup(pipeline.stop)
+        with mock.patch.object(telegram, 'pipeline', pipeline):
+            gone = telegram.get_or_create_lead(make_message(user_id=77, first_name='Ли'))
+            # Лида удалили из админки, а бот еще держит его в кэше
+            Lead.objects.filter(pk=gone.pk).delete()
+            telegram.handle_text(make_message(user_id=self.lead.telegram_id, text='раз'))
+            telegram.handle_text(make_message(user_id=77, first_name='Ли', text='снова пишу'))
+            with self.assertLogs('core.bot', 'WARNING'):
+                pipeline.flush(timeout=5)
+
+        msg = ChatMessage.objects.get(text='снова пишу')
+        self.assertNotEqual(msg.lead_id, gone.pk)
+        self.assertEqual((msg.lead.telegram_id, msg.lead.status), ('77', 'new'))
+        self.assertEqual(ChatMessage.objects.count(), 2)
+
+    def test_handlers_with_batched_pipeline(self):
+        pipeline = MediaPipeline(FakeTelegramBot(), workers=1, session=FakeSession(size=512), batch_size=50, batch_delay=60)
+        pipeline.start()
+        telegram_id = self.lead.telegram_id
+        with mock.patch.object(telegram, 'pipeline', pipeline):
+            with self.assertNumQueries(1):
+                # Лида ищем сразу, а статус и сообщение пишутся пачкой
+                telegram.handle_text(make_message(user_id=telegram_id, text='Здравствуйте'))
+            telegram.handle_photo(make_message(user_id=telegram_id, photo='ph1', caption='Скрин'))
+            self.assertEqual(Lead.objects.get(pk=self.lead.pk).status, 'process')
+            pipeline.flush(timeout=5)
+        self.assertEqual(Lead.objects.get(pk=self.lead.pk).status, 'new')
+        pipeline.stop()
+
+        photo = ChatMessage.objects.get(msg_type='image')
+        self.assertEqual((photo.text, photo.attachment.size), ('Скрин', 512))
+        self.assertEqual(ChatMessage.objects.count(), 2)
+
+
+class LeadCacheTests(TestCase):
+    def setUp(self):
+        self.get_or_create_lead = telegram.get_or_create_lead
+        lead_cache.clear()
+        self.addCleanup(lead_cache.clear)
+
+    def test_repeat_messages_cost_one_conditional_update(self):
+        first = self.get_or_create_lead(make_message(user_id=7, first_name='Ли'))
+        Lead.objects.filter(pk=first.pk).update(status='process')
+
+        with self.assertNumQueries(1):
+            lead = self.get_or_create_lead(make_message(user_id=7))
+        self.assertEqual((lead.pk, lead.first_name, lead.status), (first.pk, 'Ли', 'new'))
+        self.assertEqual(Lead.objects.get(pk=first.pk).status, 'new')
+
+        # Статус уже "Новый" - только условный UPDATE, который ничего не меняет
+        with self.assertNumQueries(1):
+            self.get_or_create_lead(make_message(user_id=7))
+        # Статус поставит MessageWriter вместе с сообщением - в базу не ходим вовсе
+        with self.assertNumQueries(0):
+            self.get_or_create_lead(make_message(user_id=7), mark_unread=False)
+
+    def test_lead_save_invalidates_entry(self):
+        lead = self.get_or_create_lead(make_message(user_id=8, first_name='Old'))
+        lead = Lead.objects.get(pk=lead.pk)
+        lead.first_name = 'New'
+        lead.save()
+
+        self.assertIsNone(lead_cache.get('8'))
+        self.assertEqual(self.get_or_create_lead(make_message(user_id=8)).first_name, 'New')
+
+    def test_lru_eviction_and_ttl(self):
+        cache = LeadCache(maxsize=2, ttl=60)
+        for n in range(3):
+            cache.set(str(n), Lead(id=n, first_name='x', status='new'))
+        self.assertIsNone(cache.get('0'))
+        self.assertEqual(cache.get('2').id, 2)
+
+        cache.ttl = -1
+        cache.set('3', Lead(id=3, first_name='x', status='new'))
+        self.assertIsNone(cache.get('3'))
+
+
+class ImportLeadsTests(TestCase):
+    def write_csv(self, rows, delimiter=';', header=('', 'No;Name;Tel number;Language;Level')):
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(list(header) + [delimiter.join(r) for r in rows]))
+        return path
+
+    def import_csv(self, path, *args):
+        out = StringIO()
+        call_command('import_leads', path, *args, stdout=out)
+        return out.getvalue()
+
+    def test_import_skips_existing_duplicates_and_invalid_rows(self):
+        make_lead(0, phone='909370520')
+        path = self.write_csv([
+            ('1', 'Shakir', '90 937 05 20', '', ''),
+            ('2', 'Rcylen', '90 056 88 17', '', 'HSK2'),
+            ('3', '', '90-056-88-17', '', ''),
+            ('4', 'Bad', '12', '', ''),
+            ('5', 'Mohi', '94 494 14 02', '', ''),
+        ])
+
+        output = self.import_csv(path, '--batch-size', '2')
+
+        self.assertIn('Добавлено новых: 2', output)
+        self.assertIn('Пропущено (уже были): 1', output)
+        self.assertIn('Повторы внутри файла: 1', output)
+        lead = Lead.objects.get(phone='900568817')
+        self.assertEqual((lead.first_name, lead.source), ('Rcylen', 'Import'))
+        self.assertIn('HSK2', lead.manager_comment)
+
+    def test_dry_run_writes_nothing(self):
+        path = self.write_csv([('1', 'A', '901111111', '', ''), ('2', 'B', '902222222', '', '')])
+        output = self.import_csv(path, '--dry-run')
+        self.assertIn('Будет добавлено: 2', output)
+        self.assertFalse(Lead.objects.exists())
+
+    def test_custom_delimiter_and_header_skip(self):
+        path = self.write_csv([('1', 'A', '901111111')], delimiter=',', header=('No,Name,Tel',))
+        self.import_csv(path, '--delimiter', ',', '--skip-rows', '1')
+        self.assertTrue(Lead.objects.filter(phone='901111111').exists())
+
+    def test_queries_per_batch_are_constant(self):
+        path = self.write_csv([(str(n), f'L{n}', f'90{n:07d}', '', '') for n in range(500)])
+        # На каждый кусок из 250 строк: SELECT существующих, SAVEPOINT, RELEASE,
+        # 4 INSERT (SQLite ограничивает число параметров в одном запросе) и UPDATE
+        # сводки воронки; первый кусок еще создает строку сводки (SAVEPOINT, INSERT, RELEASE)
+        with self.assertNumQueries(2 * 8 + 3):
+            self.import_csv(path, '--batch-size', '250')
+        self.assertEqual(Lead.objects.count(), 500)
+
+
+class PhoneNormalizationTests(TestCase):
+    def test_normalize_phone(self):
+        cases = {
+            '90 937 05 20': '+998909370520',
+            '90-937-05-20': '+998909370520',
+            '(90) 937 05 20': '+998909370520',
+            '8 90 937 05 20': '+998909370520',
+            '998909370520': '+998909370520',
+            '+998 90 937-05-20': '+998909370520',
+            '00998909370520': '+998909370520',
+            '+7 916 123 45 67': '+79161234567',
+            '123': '',
+            '': '',
+            None: '',
+        }
+        for raw, expected in cases.items():
+            self.assertEqual(normalize_phone(raw), expected, raw)
+
+    def test_models_fill_normalized_phone_on_save(self):
+        lead = make_lead(0, phone='90 937 05 20')
+        student = Student.objects.create(full_name='Ученик', phone='+998 94 494 14 02')
+        self.assertEqual(lead.phone_normalized, '+998909370520')
+        self.assertEqual(student.phone_normalized, '+998944941402')
+
+    def test_backfill_command(self):
+        lead = make_lead(0, phone='90 937 05 20')
+        Lead.objects.update(phone_normalized='')
+        call_command('normalize_phones', stdout=StringIO())
+        lead.refresh_from_db()
+        self.assertEqual(lead.phone_normalized, '+998909370520')
+
+    def test_admin_search_by_any_phone_format(self):
+        admin_user = User.objects.create_superuser('admin', password='pass')
+        self.client.force_login(admin_user)
+        lead = make_lead(0, phone='90 937 05 20')
+        make_lead(1, phone='94 494 14 02')
+
+        response = self.client.get(reverse('admin:core_lead_changelist'), {'q': '+998 (90) 937-05-20'})
+        self.assertEqual(list(response.context['cl'].result_list), [lead])
+
+    def test_web_form_reuses_lead_with_same_phone(self):
+        lead = make_lead(0, phone='909370520', status='lost')
+        response = self.client.post(reverse('index'), {'first_name': 'Шакир', 'phone': '+998 90 937 05 20'})
+
+        self.assertTrue(response.context['success'])
+        self.assertEqual(Lead.objects.count(), 1)
+        lead.refresh_from_db()
+        self.assertEqual(lead.status, 'new')
+
+
+class QueryPlanAuditTests(TestCase):
+    def test_hot_queries_use_indexes(self):
+        out = StringIO()
+        call_command('audit_query_plans', '--strict', stdout=out)
+        self.assertIn('идут по индексам', out.getvalue())
+
+    def test_full_scan_fails(self):
+        from core.management.commands import audit_query_plans
+
+        queries = [('лиды по фамилии', lambda: Lead.objects.filter(last_name='Ли'))]
+        with mock.patch.object(audit_query_plans, 'HOT_QUERIES', queries):
+            with self.assertRaisesMessage(CommandError, 'лиды по фамилии'):
+                call_command('audit_query_plans', stdout=StringIO())
+
+
+def make_lessons(count, group=None):
+    group = group or Group.objects.create(name='HSK3 вечер', level='HSK3', days_description='Пн/Ср')
+    return [Lesson.objects.create(group=group, topic=f'Урок {n}') for n in range(count)]
+
+
+class BalanceAccountingTests(TestCase):
+    def setUp(self):
+        self.student = Student.objects.create(full_name='Ученик', phone='901111111', balance=10)
+        self.tariff = Tariff.objects.create(name='8 уроков', price=400000, lessons_count=8)
+
+    def test_attendance_charges_and_bans_after_three_absences(self):
+        lessons = make_lessons(4)
+        Attendance.objects.create(lesson=lessons[0], student=self.student, status='excused')
+        for lesson in lessons[1:3]:
+            Attendance.objects.create(lesson=lesson, student=self.student, status='absent')
+        self.student.refresh_from_db()
+        self.assertEqual((self.student.balance, self.student.student_status), (8, 'active'))
+
+        mark = Attendance(lesson=lessons[3], student_id=self.student.pk, status='absent')
+        # SAVEPOINT, INSERT, UPDATE с подсчетом прогулов, UPDATE дневной сводки, RELEASE
+        with self.assertNumQueries(5):
+            mark.save()
+        self.student.refresh_from_db()
+        self.assertEqual((self.student.balance, self.student.student_status), (7, 'banned'))
+
+    def test_payment_restores_student(self):
+        Student.objects.filter(pk=self.student.pk).update(student_status='banned')
+        student = Student.objects.get(pk=self.student.pk)
+        Payment.objects.create(student=student, tariff=self.tariff, amount=0)
+
+        # Объект в памяти тоже обновлен
+        self.assertEqual((student.balance, student.total_paid, student.student_status), (18, 400000, 'active'))
+
+
+class BalanceStressTests(TransactionTestCase):
+    WRITERS = 8
+    MARKS_PER_WRITER = 5
+
+    @staticmethod
+    def retry(op):
+        for attempt in range(100):
+            try:
+                return op()
+            except OperationalError:
+                # SQLite пускает одного писателя за раз - откат и новая попытка
+                time.sleep(0.01 * (attempt % 5 + 1))
+        raise RuntimeError('gave up')
+
+    def run_concurrently(self, make_ops):
+        errors = []
+
+        def worker(n):
+            try:
+                for op in make_ops(n):
+                    self.retry(op)
+            except Exception as e:
+                errors.append(f'writer {n}: {e!r}')
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(self.WRITERS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        close_old_connections()
+        self.assertEqual(errors, [])
+
+    def test_concurrent_attendance_and_payments_are_exact(self):
+        student = Student.objects.create(full_name='Ученик', phone='901111111', balance=0)
+        tariff = Tariff.objects.create(name='8 уроков', price=400000, lessons_count=8)
+        lessons = make_lessons(self.WRITERS * self.MARKS_PER_WRITER)
+
+        def ops(n):
+            # Каждый писатель работает со своей копией студента - как две открытые вкладки админки
+            me = self.retry(lambda: Student.objects.get(pk=student.pk))
+            if n % 2:
+                yield lambda: Payment.objects.create(student=me, tariff=tariff, amount=tariff.price)
+            for lesson in lessons[n * self.MARKS_PER_WRITER:(n + 1) * self.MARKS_PER_WRITER]:
+                yield lambda lesson=lesson: Attendance.objects.create(lesson=lesson, student=me, status='present')
+
+        self.run_concurrently(ops)
+
+        student.refresh_from_db()
+        payments = self.WRITERS // 2
+        marks = self.WRITERS * self.MARKS_PER_WRITER
+        self.assertEqual(Attendance.objects.count(), marks)
+        self.assertEqual(Payment.objects.count(), payments)
+        self.assertEqual(student.balance, payments * 8 - marks)
+        self.assertEqual(student.total_paid, Decimal(payments * 400000))
+
+
+class BulkAttendanceTests(TestCase):
+    def make_group(self, size):
+        group = Group.objects.create(name=f'Группа {size}', level='HSK1', days_description='Вт/Чт')
+        students = Student.objects.bulk_create([
+            Student(full_name=f'Ученик {n}', phone=f'90{n:07d}', group=group, balance=5) for n in range(size)
+        ])
+        return group, students
+
+    def test_query_count_does_not_depend_on_group_size(self):
+        for size in (5, 40):
+            group, students = self.make_group(size)
+            lesson = make_lessons(1, group)[0]
+            marks = {s.id: ('absent' if n % 3 == 0 else 'excused' if n % 3 == 1 else 'present')
+                     for n, s in enumerate(students)}
+            # SAVEPOINT, SELECT уже отмеченных, INSERT, 2 UPDATE, RELEASE
+            # и сводка посещаемости группы: UPDATE, а строки нет - SAVEPOINT, INSERT, RELEASE
+            with self.assertNumQueries(10):
+                Attendance.bulk_mark(lesson, marks)
+            self.assertEqual(lesson.attendance_records.count(), size)
+
+    def test_balances_bans_and_existing_marks(self):
+        group, (good, skipper, sick) = self.make_group(3)
+        lessons = make_lessons(3, group)
+        for lesson in lessons[:2]:
+            Attendance.objects.create(lesson=lesson, student=skipper, status='absent')
+        Attendance.objects.create(lesson=lessons[2], student=good, status='present')
+
+        created = Attendance.bulk_mark(lessons[2], {good: 'present', skipper: 'absent', sick: 'excused'})
+
+        self.assertEqual(len(created), 2)  # good уже был отмечен
+        good.refresh_from_db(); skipper.refresh_from_db(); sick.refresh_from_db()
+        self.assertEqual((good.balance, skipper.balance, sick.balance), (4, 2, 5))
+        self.assertEqual(skipper.student_status, 'banned')
+        self.assertEqual(good.student_status, 'active')
+
+    def test_unknown_status_rejected(self):
+        group, students = self.make_group(1)
+        with self.assertRaises(ValueError):
+            Attendance.bulk_mark(make_lessons(1, group)[0], {students[0].id: 'late'})
+        self.assertFalse(Attendance.objects.exists())
+
+    def test_admin_form_and_action(self):
+        self.client.force_login(User.objects.create_superuser('admin', password='pass'))
+        group, students = self.make_group(3)
+        lesson, other = make_lessons(2, group)
+        url = reverse('admin:core_lesson_mark', args=[lesson.id])
+
+        self.assertContains(self.client.get(url), students[0].full_name)
+        response = self.client.post(url, {f'status_{students[0].id}': 'absent', f'status_{students[1].id}': 'present'})
+        self.assertRedirects(response, reverse('admin:core_lesson_changelist'))
+        self.assertEqual(dict(lesson.attendance_records.values_list('student_id', 'status')),
+                         {students[0].id: 'absent', students[1].id: 'present'})
+
+        self.client.post(reverse('admin:core_lesson_changelist'),
+                         {'action': 'mark_all_present', '_selected_action': [other.id]})
+        self.assertEqual(other.attendance_records.filter(status='present').count(), 3)
+
+
+class ChangelistQueryCountTests(TestCase):
+    """Стоимость страницы списка в админке не должна расти вместе с числом строк."""
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', password='pass')
+        self.client.force_login(self.admin)
+        self.seq = 0
+
+    def next(self):
+        self.seq += 1
+        return self.seq
+
+    def add_student(self):
+        n = self.next()
+        teacher = Teacher.objects.create(full_name=f'Учитель {n}', phone='900000000')
+        group = Group.objects.create(name=f'Группа {n}', level='HSK2', teacher=teacher, days_description='Пн')
+        student = Student.objects.create(full_name=f'Ученик {n}', phone=f'91{n:07d}', group=group)
+        lesson = Lesson.objects.create(group=group, topic=f'Урок {n}')
+        Attendance.objects.create(lesson=lesson, student=student)
+        tariff = Tariff.objects.create(name=f'Тариф {n}', price=100, lessons_count=4)
+        Payment.objects.create(student=student, tariff=tariff, amount=100)
+        user = User.objects.create_user(f'worker{n}')
+        Task.objects.create(title=f'Позвонить {n}', assigned_to=user)
+        make_lead(n)
+
+    def page_cost(self, model_name):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse(f'admin:core_{model_name}_changelist'))
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def add_broadcasts(self):
+        self.add_student()
+        Broadcast.objects.create(title=f'Черновик {self.seq}', text='Привет')
+        started = Broadcast.objects.create(title=f'Рассылка {self.seq}', text='Привет')
+        broadcast.start(started)
+
+    def assert_constant_cost(self, model_name, add=None):
+        add = add or self.add_student
+        for _ in range(2):
+            add()
+        small = self.page_cost(model_name)
+        for _ in range(15):
+            add()
+        self.assertEqual(self.page_cost(model_name), small, model_name)
+
+    def test_lead_changelist(self):
+        self.assert_constant_cost('lead')
+
+    def test_student_changelist(self):
+        self.assert_constant_cost('student')
+
+    def test_group_changelist(self):
+        self.assert_constant_cost('group')
+
+    def test_lesson_changelist(self):
+        self.assert_constant_cost('lesson')
+
+    def test_payment_changelist(self):
+        self.assert_constant_cost('payment')
+
+    def test_task_changelist(self):
+        self.assert_constant_cost('task')
+
+    def test_broadcast_changelist(self):
+        self.assert_constant_cost('broadcast', self.add_broadcasts)
+
+    def test_teacher_and_tariff_changelists(self):
+        self.assert_constant_cost('teacher')
+        self.assert_constant_cost('tariff')
+
+    def test_computed_columns_are_sortable(self):
+        self.add_student()
+        group = Group.objects.get()
+        Student.objects.create(full_name='Второй', phone='909999999', group=group)
+
+        response = self.client.get(reverse('admin:core_group_changelist'), {'o': '5'})
+        self.assertEqual(response.context['cl'].result_list[0].students_total, 2)
+        response = self.client.get(reverse('admin:core_lesson_changelist'), {'o': '-4'})
+        self.assertEqual(response.context['cl'].result_list[0].checked_total, 1)
+
+
+class UnreadCounterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.client.force_login(User.objects.create_user('manager', password='pass', is_staff=True))
+
+    def get_unread(self, **headers):
+        return self.client.get(reverse('api_unread_count'), **AJAX, **headers)
+
+    def test_counter_follows_status_transitions_without_counting(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            lead = make_lead(0, status='new')
+            make_lead(1, status='new')
+            make_lead(2, status='process')
+        self.assertEqual(unread.reconcile(), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            # Менеджер открыл чат: new -> process
+            self.client.get(reverse('chat_dashboard', args=[lead.id]), **AJAX)
+            # Клиент снова написал: process -> new
+            Lead.mark_unread(Lead.objects.get(status='process', first_name='Lead 2').id)
+            # Правка из админки (list_editable): new -> lost
+            other = Lead.objects.get(first_name='Lead 1')
+            other.status = 'lost'
+            other.save()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(unread.get_count(), 1)
+        self.assertEqual(Lead.objects.filter(status='new').count(), 1)
+
+    def test_etag_and_not_modified(self):
+        make_lead(0, status='new')
+        response = self.get_unread()
+        self.assertEqual(response.json(), {'count': 1})
+        etag = response['ETag']
+
+        # сессия + пользователь, сам счетчик берется из кэша
+        with self.assertNumQueries(2):
+            response = self.get_unread(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            make_lead(1, status='new')
+        response = self.get_unread(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response.json()), (200, {'count': 2}))
+
+    def test_counter_is_reconciled_when_entry_expires(self):
+        make_lead(0, status='new')
+        self.assertEqual(unread.get_count(), 1)
+        Lead.objects.update(status='process')  # мимо счетчика
+        self.assertEqual(unread.get_count(), 1)
+
+        unread.invalidate()  # то же, что истечение UNREAD_COUNT_RECONCILE_SECONDS
+        self.assertEqual(unread.get_count(), 0)
+
+    def test_import_adjusts_counter(self):
+        unread.reconcile()
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write('\nheader\n1;A;901111111\n2;B;902222222')
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('import_leads', path, stdout=StringIO())
+        with self.assertNumQueries(0):
+            self.assertEqual(unread.get_count(), 2)
@@ -0,0 +1,65 @@
+"""
+Счетчик новых (непрочитанных) лидов в кэше Django.
+
+Каждый переход лида в статус 'new' и из него поправляет счетчик на месте
+(write-through), а раз в UNREAD_COUNT_RECONCILE_SECONDS запись истекает и
+пересчитывается из базы - так расхождения (например, правки из другого
+процесса при локальном кэше) не живут дольше этого интервала.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from . import perf
+
+CACHE_KEY = 'crm:unread_leads'
+
+
+def _cache():
+    return caches[getattr(settings, 'UNREAD_COUNT_CACHE', 'default')]
+
+
+def _timeout():
+    return getattr(settings, 'UNREAD_COUNT_RECONCILE_SECONDS', 60)
+
+
+def get_count():
+    """Число лидов в статусе 'new'. В базу ходит только если в кэше пусто."""
+    count = _cache().get(CACHE_KEY)
+    perf.cache_lookup(count is not None)
+    if count is None:
+        count = reconcile()
+    return count
+
+
+def reconcile():
+    """Пересчитывает счетчик по базе и кладет в кэш."""
+    from .models import Lead, LeadStatus
+    count = Lead.objects.filter(status=LeadStatus.NEW).count()
+    _cache().set(CACHE_KEY, count, _timeout())
+    return count
+
+
+def adjust(delta):
+    """Сдвигает счетчик после коммита. Если его нет в кэше - его просто пересчитают при чтении."""
+    if delta:
+        transaction.on_commit(lambda: _apply(delta))
+
+
+def _apply(delta):
+    cache = _cache()
+    try:
+        value = cache.incr(CACHE_KEY, delta)
+    except ValueError:
+        return
+    if value < 0:
+        cache.delete(CACHE_KEY)
+
+
+def status_changed(old, new):
+    from .models import LeadStatus
+    adjust((new == LeadStatus.NEW) - (old == LeadStatus.NEW))
+
+
+def invalidate():
+    _cache().delete(CACHE_KEY)
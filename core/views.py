@@ -1,91 +1,169 @@
+from django.conf import settings
 from django.shortcuts import render, get_object_or_404, redirect
+from django.urls import reverse
 from django.contrib.admin.views.decorators import staff_member_required
-from django.http import JsonResponse
-from django.db.models import Max, Subquery, OuterRef
-from .models import Lead, ChatMessage
-import telebot
-from decouple import config
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import (
+    FileResponse, Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse,
+    StreamingHttpResponse,
+)
+from django.db.models import F, Max, Q
+from django.utils import timezone
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date
+from django.views.decorators.cache import cache_control
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition, require_POST, require_safe
+from .models import Lead, LeadStatus, ChatMessage, DeliveryStatus
+from . import events, media, search, unread, webhook
+from .phones import normalize_phone
+import asyncio
+import hmac
+import json
+import mimetypes
+import os
+import stat
 import uuid
 
-bot = telebot.TeleBot(config('TELEGRAM_BOT_TOKEN'))
-
 def index(request):
     success = False
     if request.method == 'POST':
         name = request.POST.get('first_name')
         phone = request.POST.get('phone')
         if name and phone:
-            fake_id = f"web_{uuid.uuid4().hex[:10]}"
-            Lead.objects.create(first_name=name, phone=phone, source='Website', status='new', telegram_id=fake_id)
+            # Уже оставлял заявку с этим номером - не плодим дубли, а снова помечаем как новую
+            existing = Lead.objects.filter(phone_normalized=normalize_phone(phone)).exclude(phone_normalized='').first()
+            if existing:
+                Lead.mark_unread(existing.id)
+            else:
+                fake_id = f"web_{uuid.uuid4().hex[:10]}"
+                Lead.objects.create(first_name=name, phone=phone, source='Website', status='new', telegram_id=fake_id)
             success = True
     return render(request, 'index.html', {'success': success})
 
+def _unread_etag(request):
+    return f"unread-{unread.get_count()}"
+
 @staff_member_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=_unread_etag)
 def api_get_unread(request):
+    # Счетчик берется из кэша; если не изменился - браузер получит 304 без тела
     if request.headers.get('x-requested-with') == 'XMLHttpRequest':
-        count = Lead.objects.filter(status='new').count()
-        return JsonResponse({'count': count})
+        return JsonResponse({'count': unread.get_count()})
     return JsonResponse({'status': 'error'}, status=400)
 
+@staff_member_required
+def api_search(request):
+    """Поиск по лидам и переписке, лучшие совпадения первыми."""
+    query = request.GET.get('q', '')
+    try:
+        limit = min(int(request.GET.get('limit') or 20), 50)
+    except ValueError:
+        return JsonResponse({'status': 'error'}, status=400)
+
+    return JsonResponse({
+        'leads': [
+            {
+                'id': lead.id,
+                'name': lead.first_name,
+                'status': lead.status,
+                'url': reverse('chat_dashboard', args=[lead.id]),
+            }
+            for lead in search.search_leads(query, limit)
+        ],
+        'messages': [
+            {
+                'id': msg.id,
+                'lead': msg.lead_id,
+                'lead_name': msg.lead.first_name,
+                'snippet': msg.snippet,
+                'is_manager': msg.is_from_manager,
+                'created_at': msg.created_at.isoformat(),
+                'url': reverse('chat_dashboard', args=[msg.lead_id]),
+            }
+            for msg in search.search_messages(query, limit)
+        ],
+    })
+
+@staff_member_required
+async def chat_events(request):
+    """
+    Поток событий (Server-Sent Events) для открытых вкладок: новые сообщения
+    и смена статусов лидов. Пока событий нет - вкладка не стоит ничего.
+    Работает только под ASGI: под WSGI поток не отправился бы, заняв воркер.
+    """
+    if not events.push_supported(request):
+        return JsonResponse({'status': 'error'}, status=501)
+    events.get_watcher().ensure_running()
+    return StreamingHttpResponse(
+        _event_stream(events.get_broker()),
+        content_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+async def _event_stream(broker, heartbeat=15):
+    yield 'retry: 3000\n\n'
+    stream = broker.listen()
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(anext(stream))
+            done, _ = await asyncio.wait({pending}, timeout=heartbeat)
+            if not done:
+                # Пинг, чтобы прокси не закрыл соединение
+                yield ': ping\n\n'
+                continue
+            event = pending.result()
+            pending = None
+            yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+    finally:
+        if pending is not None:
+            pending.cancel()
+        await stream.aclose()
+
 @staff_member_required
 def chat_dashboard(request, lead_id=None):
-    # 1. Запрос для списка лидов (Сортировка)
-    newest_msg = ChatMessage.objects.filter(lead=OuterRef('pk')).order_by('-created_at')
-    
-    leads = Lead.objects.annotate(
-        last_msg_time=Max('messages__created_at'),
-        last_msg_text=Subquery(newest_msg.values('text')[:1]),
-        last_msg_type=Subquery(newest_msg.values('msg_type')[:1]) # Тип сообщения
-    ).order_by('-status', '-last_msg_time', '-created_at')
+    # 1. Запрос для списка лидов (Сортировка по индексу lead_sidebar_idx)
+    filters = _sidebar_filters(request)
+    leads = Lead.objects.filter(**filters).order_by(*SIDEBAR_ORDER)
     
     active_lead = None
-    messages = []
     
     if lead_id:
         active_lead = get_object_or_404(Lead, id=lead_id)
-        messages = active_lead.messages.all().order_by('created_at')
         
         # Если открыли чат - сбрасываем статус "Новый"
         if active_lead.status == 'new':
             active_lead.status = 'process'
-            active_lead.save()
+            active_lead.save(update_fields=['status', 'updated_at'])
 
     # --- AJAX ОТВЕТ (ДЛЯ LIVE UPDATE) ---
     if request.headers.get('x-requested-with') == 'XMLHttpRequest':
-        data = {}
-        
-        # Данные для сайдбара (обновляем список слева)
-        leads_data = []
-        for l in leads:
-            preview = l.last_msg_text
-            if not preview:
-                if l.last_msg_type == 'image': preview = '📷 Фото'
-                elif l.last_msg_type == 'voice': preview = '🎤 Голосовое'
-                else: preview = 'Нет сообщений'
-            
-            leads_data.append({
-                'id': l.id,
-                'name': l.first_name,
-                'status': l.status,
-                'time': l.last_msg_time.strftime("%H:%M") if l.last_msg_time else '',
-                'preview': preview,
-                'active': (l.id == active_lead.id) if active_lead else False
-            })
-        data['leads'] = leads_data
-
-        # Данные сообщений (если открыт чат)
+        # Клиент прислал курсор - отдаем только изменения
+        if 'since' in request.GET:
+            return _chat_delta(request, active_lead)
+        # Подгрузка более ранней истории чата
+        if 'before' in request.GET and active_lead:
+            return _chat_history(request, active_lead)
+        # Следующая страница сайдбара
+        if 'after' in request.GET:
+            return _sidebar_next(request, leads, active_lead)
+
+        data = {
+            'ts': timezone.now().isoformat(),
+            'cursor': _message_cursor(),
+        }
+        page, data['next'] = _sidebar_page(leads)
+        data['leads'] = [_serialize_lead(l, active_lead) for l in page]
+
+        # Данные сообщений (если открыт чат) - только последняя страница
         if active_lead:
-            msg_data = []
-            for msg in messages:
-                attachment_url = msg.attachment.url if msg.attachment else None
-                msg_data.append({
-                    'text': msg.text,
-                    'is_manager': msg.is_from_manager,
-                    'type': msg.msg_type,
-                    'file_url': attachment_url,
-                    'time': msg.created_at.strftime("%H:%M")
-                })
-            data['messages'] = msg_data
+            messages, data['older'] = _message_page(active_lead)
+            data['messages'] = [_serialize_message(msg) for msg in messages]
         
         return JsonResponse(data)
 
@@ -94,39 +172,455 @@ def chat_dashboard(request, lead_id=None):
         text = request.POST.get('message_text')
         file = request.FILES.get('attachment') # Получаем файл
         
-        try:
-            # 1. Отправка в Телеграм
-            tg_sent = False
-            if active_lead.telegram_id and not active_lead.telegram_id.startswith('web_'):
-                if file:
-                    # Если есть файл
-                    if file.content_type.startswith('image'):
-                        bot.send_photo(active_lead.telegram_id, file, caption=text)
-                        msg_type = 'image'
-                    else:
-                        bot.send_document(active_lead.telegram_id, file, caption=text)
-                        msg_type = 'document'
-                elif text:
-                    bot.send_message(active_lead.telegram_id, text)
-                    msg_type = 'text'
-                tg_sent = True
-
-            # 2. Сохранение в базу
-            if tg_sent:
-                ChatMessage.objects.create(
-                    lead=active_lead, 
-                    text=text, 
-                    attachment=file,
-                    msg_type=msg_type,
-                    is_from_manager=True
-                )
-        except Exception as e:
-            print(f"Ошибка отправки: {e}")
-            
+        # Сообщение только ставится в очередь - в Telegram его отправит Outbox
+        # (core/outbox.py), страница не ждет ответа API
+        if active_lead.telegram_id and not active_lead.telegram_id.startswith('web_') and (text or file):
+            if file:
+                msg_type = 'image' if file.content_type.startswith('image') else 'document'
+            else:
+                msg_type = 'text'
+            msg = ChatMessage.objects.create(
+                lead=active_lead,
+                text=text,
+                attachment=file,
+                file_name=file.name[:255] if file else '',
+                msg_type=msg_type,
+                is_from_manager=True,
+                delivery_status=DeliveryStatus.QUEUED,
+            )
+            if msg_type == 'image':
+                # Само превью строится при первом показе, а не в этом запросе
+                msg.thumbnail = media.planned_thumbnail(msg.attachment.name)
+                msg.save(update_fields=['thumbnail'])
+
         return redirect('chat_dashboard', lead_id=lead_id)
 
     return render(request, 'admin/chat_dashboard.html', {
-        'leads': leads,
         'active_lead': active_lead,
-        'messages': messages,
-    })
\ No newline at end of file
+        'filters': filters,
+        'statuses': LeadStatus.choices,
+        'sources': Lead.objects.exclude(source='').order_by('source').values_list('source', flat=True).distinct(),
+    })
+
+
+# --- САЙДБАР: ФИЛЬТРЫ И СТРАНИЦЫ ---
+
+# Порядок сайдбара. NULL (лиды без сообщений) явно в конце - и в SQLite, и в PostgreSQL
+SIDEBAR_ORDER = (
+    F('status').desc(),
+    F('last_msg_time').desc(nulls_last=True),
+    F('created_at').desc(),
+    F('id').desc(),
+)
+
+
+def _sidebar_filters(request):
+    filters = {}
+    status = request.GET.get('status')
+    if status in LeadStatus.values:
+        filters['status'] = status
+    source = request.GET.get('source')
+    if source:
+        filters['source'] = source
+    return filters
+
+
+def _sidebar_page(leads, after=None, limit=None):
+    """
+    Страница сайдбара после курсора after (ключ status, last_msg_time, created_at, id).
+
+    Одно условие "строка после курсора" через OR база не может отдать поиском по
+    индексу, поэтому оно разбито на ветки, каждая из которых - поиск диапазона
+    по lead_sidebar_idx. Ветки идут в порядке сортировки, запросы прекращаются,
+    как только страница набрана. Возвращает (лиды, курсор следующей страницы).
+    """
+    limit = limit or settings.SIDEBAR_PAGE_SIZE
+    branches = _sidebar_branches(after) if after else [Q()]
+
+    page = []
+    for branch in branches:
+        page += leads.filter(branch)[:limit + 1 - len(page)]
+        if len(page) > limit:
+            break
+
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = _sidebar_cursor(page[-1])
+    return page, next_cursor
+
+
+def _sidebar_branches(after):
+    status, last_msg_time, created_at, lead_id = after
+    # Лишнее условие created_at <= ... дает базе границу диапазона в индексе
+    same_time = Q(created_at__lte=created_at) & (
+        Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=lead_id)
+    )
+    if last_msg_time is None:
+        branches = [Q(status=status, last_msg_time__isnull=True) & same_time]
+    else:
+        branches = [
+            Q(status=status, last_msg_time=last_msg_time) & same_time,
+            Q(status=status, last_msg_time__lt=last_msg_time),
+            Q(status=status, last_msg_time__isnull=True),
+        ]
+    branches.append(Q(status__lt=status))
+    return branches
+
+
+def _sidebar_cursor(lead):
+    last = lead.last_msg_time.isoformat() if lead.last_msg_time else ''
+    return f"{lead.status}|{last}|{lead.created_at.isoformat()}|{lead.id}"
+
+
+def _parse_sidebar_cursor(value):
+    parts = (value or '').split('|')
+    if len(parts) != 4:
+        return None
+    status, last, created_at, lead_id = parts
+    try:
+        last = parse_datetime(last) if last else None
+        created_at = parse_datetime(created_at)
+    except ValueError:
+        # Формат даты верный, а сама дата нет (например, 13-й месяц)
+        return None
+    if status not in LeadStatus.values or not created_at or not lead_id.isdigit():
+        return None
+    if parts[1] and not last:
+        return None
+    return status, last, created_at, int(lead_id)
+
+
+def _sidebar_next(request, leads, active_lead):
+    after = _parse_sidebar_cursor(request.GET.get('after'))
+    if not after:
+        return JsonResponse({'status': 'error'}, status=400)
+    page, next_cursor = _sidebar_page(leads, after)
+    return JsonResponse({
+        'leads': [_serialize_lead(l, active_lead) for l in page],
+        'next': next_cursor,
+    })
+
+
+# --- СЕРИАЛИЗАЦИЯ ДЛЯ LIVE UPDATE ---
+
+def _serialize_lead(lead, active_lead=None):
+    preview = lead.last_msg_text
+    if not preview:
+        if lead.last_msg_type == 'image': preview = '📷 Фото'
+        elif lead.last_msg_type == 'voice': preview = '🎤 Голосовое'
+        else: preview = 'Нет сообщений'
+
+    return {
+        'id': lead.id,
+        'name': lead.first_name,
+        'status': lead.status,
+        'source': lead.source,
+        'time': lead.last_msg_time.strftime("%H:%M") if lead.last_msg_time else '',
+        'last_ts': lead.last_msg_time.isoformat() if lead.last_msg_time else None,
+        'created_ts': lead.created_at.isoformat(),
+        'preview': preview,
+        'active': (lead.id == active_lead.id) if active_lead else False
+    }
+
+
+def _serialize_message(msg):
+    return {
+        'id': msg.id,
+        'text': msg.text,
+        'is_manager': msg.is_from_manager,
+        'type': msg.msg_type,
+        'file_url': msg.attachment.url if msg.attachment else None,
+        'thumb_url': msg.thumbnail.url if msg.thumbnail else None,
+        'media_error': msg.media_error,
+        'delivery': msg.delivery_status,
+        'delivery_error': msg.delivery_error,
+        'time': msg.created_at.strftime("%H:%M")
+    }
+
+
+def _message_page(lead, before=None, limit=None):
+    """
+    Страница истории чата по ключу (created_at, id): последние limit сообщений
+    до курсора before. Идет по индексу (lead, created_at), поэтому стоит одинаково
+    и для 10, и для 100 000 сообщений. Возвращает (сообщения по возрастанию, курсор раньше).
+    """
+    limit = limit or settings.CHAT_PAGE_SIZE
+    page = lead.messages.order_by('-created_at', '-id')
+    if before:
+        created_at, msg_id = before
+        page = page.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=msg_id))
+
+    page = list(page[:limit + 1])
+    older = None
+    if len(page) > limit:
+        page = page[:limit]
+        older = _page_cursor(page[-1])
+    page.reverse()
+    return page, older
+
+
+def _page_cursor(msg):
+    return f"{msg.created_at.isoformat()}|{msg.id}"
+
+
+def _parse_page_cursor(value):
+    created_at, _, msg_id = (value or '').rpartition('|')
+    try:
+        created_at = parse_datetime(created_at)
+    except ValueError:
+        return None
+    if not created_at or not msg_id.isdigit():
+        return None
+    return created_at, int(msg_id)
+
+
+def _chat_history(request, active_lead):
+    before = _parse_page_cursor(request.GET.get('before'))
+    if not before:
+        return JsonResponse({'status': 'error'}, status=400)
+    messages, older = _message_page(active_lead, before)
+    return JsonResponse({
+        'history': [_serialize_message(msg) for msg in messages],
+        'older': older,
+    })
+
+
+def _message_cursor():
+    """Последний id сообщения - курсор для следующего опроса."""
+    return ChatMessage.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+
+
+def _chat_delta(request, active_lead):
+    """
+    Инкрементальный ответ для опроса: только новые сообщения после курсора
+    `since` и только те лиды, у которых что-то изменилось после `ts`.
+    Пустой опрос стоит фиксированное число запросов, независимо от размера базы.
+
+    Измененные лиды отдаются без фильтров сайдбара (со статусом и источником) -
+    клиент сам убирает тех, кто из фильтра выпал. Если их больше страницы
+    (например, после импорта) или курсор отстал больше чем на
+    CHAT_DELTA_MAX_MESSAGES сообщений (вкладка долго спала), вместо них
+    приходит resync: клиент перечитает сайдбар с начала.
+    """
+    try:
+        since = int(request.GET.get('since') or 0)
+        ts = parse_datetime(request.GET.get('ts') or '')
+    except ValueError:
+        return JsonResponse({'status': 'error'}, status=400)
+    now = timezone.now()
+
+    # Целиком строки не грузим: для сайдбара хватит id лидов, а ограничение
+    # не дает вкладке с давним курсором вычитать всю таблицу
+    limit = settings.CHAT_DELTA_MAX_MESSAGES
+    new_ids = list(
+        ChatMessage.objects.filter(id__gt=since).order_by('id').values_list('id', 'lead_id')[:limit + 1]
+    )
+    if len(new_ids) > limit:
+        return JsonResponse({'delta': True, 'resync': True})
+
+    changed_ids = {lead_id for _, lead_id in new_ids}
+    changed = Q(id__in=changed_ids)
+    if ts:
+        changed |= Q(updated_at__gt=ts)
+
+    changed_leads = []
+    if changed_ids or ts:
+        limit = settings.SIDEBAR_PAGE_SIZE
+        changed_leads = list(Lead.objects.filter(changed)[:limit + 1])
+
+    cursor = new_ids[-1][0] if new_ids else since
+    data = {
+        'delta': True,
+        'cursor': cursor,
+        'ts': now.isoformat(),
+        'leads': [_serialize_lead(l, active_lead) for l in changed_leads],
+    }
+    if len(changed_leads) > settings.SIDEBAR_PAGE_SIZE:
+        data['leads'] = []
+        data['resync'] = True
+    if active_lead:
+        data['messages'] = []
+        if active_lead.id in changed_ids:
+            data['messages'] = [
+                _serialize_message(msg)
+                for msg in active_lead.messages.filter(id__gt=since, id__lte=cursor).order_by('id')
+            ]
+
+        # Медиа, которое бот докачал (или не смог скачать) после того, как сообщение уже показали
+        pending = [int(i) for i in request.GET.get('pending', '').split(',')[:50] if i.isdigit()]
+        if pending:
+            ready = active_lead.messages.filter(id__in=pending).exclude(attachment='', media_error='')
+            data['media'] = [_serialize_message(msg) for msg in ready]
+
+        # Статус доставки ответов менеджера, которые еще были в очереди
+        outbox = [int(i) for i in request.GET.get('outbox', '').split(',')[:50] if i.isdigit()]
+        if outbox:
+            statuses = active_lead.messages.filter(id__in=outbox).values_list('id', 'delivery_status', 'delivery_error')
+            data['delivery'] = [
+                {'id': msg_id, 'delivery': status, 'error': error} for msg_id, status, error in statuses
+            ]
+    return JsonResponse(data)
+
+
+# --- РАЗДАЧА МЕДИА ---
+
+# Файлы с именем-хэшем никогда не меняются: браузер может не перепроверять их год
+MEDIA_CACHE_IMMUTABLE = 'private, max-age=31536000, immutable'
+MEDIA_CACHE_REVALIDATE = 'private, no-cache'
+
+
+@staff_member_required
+@require_safe
+def serve_media(request, path):
+    """
+    Отдает вложения чата: потоком, с Range (перемотка голосовых), ETag/304
+    и долгим кэшем для файлов с именем-хэшем. С MEDIA_SENDFILE сам файл
+    отдает прокси (nginx/Apache), Django только проверяет доступ.
+    """
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404
+    if path.startswith(f'{media.THUMBNAIL_DIR}/') and not os.path.exists(full_path):
+        original = _build_thumbnail(path)
+        if original:
+            return redirect(original)
+    try:
+        st = os.stat(full_path)
+    except OSError:
+        raise Http404
+    if not stat.S_ISREG(st.st_mode):
+        raise Http404
+
+    etag = _media_etag(path, st)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(st.st_mtime),
+        'Cache-Control': MEDIA_CACHE_IMMUTABLE if media.is_hashed(path) else MEDIA_CACHE_REVALIDATE,
+        'Accept-Ranges': 'bytes',
+    }
+
+    response = get_conditional_response(request, etag=etag, last_modified=int(st.st_mtime))
+    if response is None:
+        content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+        sendfile = getattr(settings, 'MEDIA_SENDFILE', None)
+        if sendfile:
+            response = _sendfile_response(sendfile, path, full_path, content_type)
+        else:
+            response = _file_response(request, full_path, st.st_size, content_type, headers)
+
+    for name, value in headers.items():
+        response.headers.setdefault(name, value)
+    return response
+
+
+def _build_thumbnail(path):
+    """
+    Строит превью, которое еще не построено. Если из оригинала превью не
+    выходит - URL оригинала (и лента дальше показывает его), None - такого превью нет.
+    """
+    messages = ChatMessage.objects.filter(thumbnail=path)
+    original = messages.values_list('attachment', flat=True).first()
+    if not original or media.make_thumbnail(original) == path:
+        return None
+    messages.update(thumbnail='')
+    return media.chat_storage.url(original)
+
+
+def _media_etag(path, st):
+    if media.is_hashed(path):
+        return f'"{os.path.splitext(os.path.basename(path))[0]}"'
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+
+def _sendfile_response(mode, path, full_path, content_type):
+    response = HttpResponse(content_type=content_type)
+    if mode == 'x-accel-redirect':
+        # nginx: location {MEDIA_ACCEL_PREFIX} { internal; alias <MEDIA_ROOT>/; }
+        prefix = getattr(settings, 'MEDIA_ACCEL_PREFIX', '/protected-media/')
+        response.headers['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + path.lstrip('/')
+    else:
+        response.headers['X-Sendfile'] = full_path
+    return response
+
+
+def _file_response(request, full_path, size, content_type, headers):
+    byte_range = _requested_range(request, size, headers)
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response.headers['Content-Range'] = f'bytes */{size}'
+        return response
+    if byte_range is None:
+        return FileResponse(open(full_path, 'rb'), content_type=content_type)
+
+    start, end = byte_range
+    response = StreamingHttpResponse(_read_range(full_path, start, end), status=206, content_type=content_type)
+    response.headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response.headers['Content-Length'] = str(end - start + 1)
+    return response
+
+
+def _requested_range(request, size, headers):
+    """
+    (start, end) из заголовка Range, None - отдать файл целиком,
+    False - диапазон за пределами файла (416). Несколько диапазонов
+    сразу браузеры для аудио не просят - на такое отвечаем всем файлом.
+    """
+    value = request.headers.get('Range', '')
+    if not value.startswith('bytes=') or ',' in value:
+        return None
+    # If-Range: диапазон имеет смысл, только если файл не поменялся
+    if_range = request.headers.get('If-Range')
+    if if_range and if_range not in (headers['ETag'], headers['Last-Modified']):
+        return None
+
+    first, _, last = value[len('bytes='):].strip().partition('-')
+    if not (first.isdigit() or last.isdigit()):
+        return None
+    if not first:
+        # bytes=-500: последние 500 байт
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        if last.isdigit() and int(last) < start:
+            # bytes=5-3 - некорректный диапазон: по RFC 9110 заголовок игнорируется
+            return None
+        end = min(int(last), size - 1) if last.isdigit() else size - 1
+    if start >= size:
+        return False
+    return start, end
+
+
+def _read_range(full_path, start, end, chunk_size=64 * 1024):
+    with open(full_path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+# --- WEBHOOK TELEGRAM ---
+
+@csrf_exempt
+@require_POST
+def telegram_webhook(request):
+    """
+    Принимает апдейт от Telegram: проверяет секрет, кладет в очередь и
+    сразу отвечает 200. Обработка - в фоне (см. core/webhook.py).
+    """
+    secret = getattr(settings, 'TELEGRAM_WEBHOOK_SECRET', '')
+    if not secret:
+        raise Http404('Webhook выключен')
+    if not hmac.compare_digest(request.headers.get(webhook.SECRET_HEADER, ''), secret):
+        return HttpResponseForbidden()
+    try:
+        created = webhook.accept(json.loads(request.body))
+    except ValueError:
+        return HttpResponseBadRequest('Это не апдейт Telegram')
+    if created:
+        webhook.notify()
+    return JsonResponse({'ok': True})
@@ -0,0 +1,225 @@
+"""
+Прием апдейтов Telegram через webhook вместо long polling.
+
+Telegram присылает апдейт POST-запросом на /telegram/webhook/ с секретом
+в заголовке X-Telegram-Bot-Api-Secret-Token. Представление только
+сохраняет апдейт в TelegramUpdate и сразу отвечает 200, а обрабатывают
+его те же хендлеры, что и в runbot (core/bot.py), в фоновом потоке
+Dispatcher-а. update_id - первичный ключ таблицы, поэтому повторная
+доставка (Telegram не дождался ответа) ничего не делает второй раз.
+
+Апдейт забирается в работу условным UPDATE с lease, как в core/outbox.py,
+поэтому принимать апдейты могут сколько угодно веб-процессов. Упавший
+хендлер (например, база занята) повторяется с задержкой до
+TELEGRAM_WEBHOOK_MAX_ATTEMPTS раз. Обработанные апдейты хранятся
+TELEGRAM_WEBHOOK_KEEP_DAYS дней - дольше Telegram их не передоставляет.
+
+Очередь ответов менеджеров в этом режиме отправляет send_outbox.
+Зарегистрировать webhook в Telegram: manage.py telegram_webhook --set <URL>.
+"""
+import logging
+import threading
+import time
+from contextlib import nullcontext
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from telebot import types
+
+from . import bot as telegram
+from .ingest import MediaPipeline
+from .metrics import log_event
+from .models import TelegramUpdate
+
+logger = logging.getLogger('core.bot')
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def accept(payload):
+    """
+    Сохраняет апдейт в очередь. False - такой update_id уже принят
+    (повторная доставка). ValueError - это не апдейт Telegram.
+    """
+    update_id = payload.get('update_id') if isinstance(payload, dict) else None
+    if not isinstance(update_id, int) or isinstance(update_id, bool):
+        raise ValueError('В апдейте нет update_id')
+    try:
+        with transaction.atomic():
+            TelegramUpdate.objects.create(update_id=update_id, payload=payload)
+    except IntegrityError:
+        return False
+    return True
+
+
+class Dispatcher:
+    """Разбирает сохраненные апдейты хендлерами бота по порядку update_id."""
+
+    def __init__(self, bot=None, lease=None, max_attempts=None, backoff=None, flush_timeout=None):
+        # Непоточный бот: хендлер отрабатывает внутри process_new_updates
+        self.bot = bot or telegram.make_bot(threaded=False)
+        self.lease = lease or _setting('TELEGRAM_WEBHOOK_LEASE', 60)
+        self.max_attempts = max_attempts or _setting('TELEGRAM_WEBHOOK_MAX_ATTEMPTS', 5)
+        self.backoff = backoff if backoff is not None else _setting('TELEGRAM_WEBHOOK_BACKOFF', 2)
+        self.flush_timeout = flush_timeout or _setting('TELEGRAM_WEBHOOK_FLUSH_TIMEOUT', 30)
+
+    def pending(self, limit=100):
+        """Необработанные апдейты, которые никто не держит и которым не рано повторять."""
+        now = timezone.now()
+        return list(
+            TelegramUpdate.objects.filter(processed_at__isnull=True)
+            .filter(Q(locked_until__isnull=True) | Q(locked_until__lte=now))
+            .order_by('update_id')[:limit]
+        )
+
+    def claim(self, update):
+        """Забирает апдейт себе. False - его уже взял другой процесс."""
+        return bool(
+            TelegramUpdate.objects.filter(
+                pk=update.pk, processed_at__isnull=True, locked_until=update.locked_until,
+            ).update(locked_until=timezone.now() + timedelta(seconds=self.lease), attempts=F('attempts') + 1)
+        )
+
+    def run_once(self, limit=100):
+        """
+        Один проход по очереди. Апдейт отмечается обработанным только после
+        того, как его сообщения записаны в базу (пачкой, если конвейер пишет
+        через MessageWriter). Возвращает число обработанных апдейтов.
+        """
+        handled = []
+        for update in self.pending(limit):
+            if self.claim(update):
+                saved = self.process(update)
+                if saved is not None:
+                    handled.append((update, saved))
+
+        if handled and telegram.pipeline is not None:
+            telegram.pipeline.write_now()
+        # Каждый апдейт ждет только свои сообщения: чужая неудачная пачка
+        # не заставит повторить уже записанное (и не задвоит его)
+        deadline = time.monotonic() + self.flush_timeout
+        done = []
+        for update, saved in handled:
+            try:
+                for pending in saved:
+                    pending.wait(max(deadline - time.monotonic(), 0))
+            except Exception as e:
+                self._failed(update, e)
+            else:
+                done.append(update.pk)
+        if not done:
+            return 0
+        return TelegramUpdate.objects.filter(pk__in=done).update(
+            processed_at=timezone.now(), locked_until=None, error='',
+        )
+
+    def process(self, update):
+        """Прогоняет апдейт через хендлеры. Список ожидающих записи сообщений или None, если упал."""
+        pipeline = telegram.pipeline
+        collect = pipeline.collect() if pipeline is not None else nullcontext([])
+        try:
+            with collect as saved:
+                self.bot.process_new_updates([types.Update.de_json(update.payload)])
+        except Exception as e:
+            self._failed(update, e)
+            return None
+        return saved
+
+    def _failed(self, update, error):
+        attempts = update.attempts + 1
+        now = timezone.now()
+        if attempts >= self.max_attempts:
+            # Дальше не повторяем, но и не теряем: апдейт и ошибка остаются в таблице
+            fields = {'processed_at': now, 'locked_until': None}
+        else:
+            fields = {'locked_until': now + timedelta(seconds=self.backoff * 2 ** (attempts - 1))}
+        TelegramUpdate.objects.filter(pk=update.pk).update(error=str(error)[:255], **fields)
+        log_event(
+            logger, 'update_failed', level='warning',
+            update_id=update.pk, attempts=attempts, gave_up='processed_at' in fields, error=str(error),
+        )
+
+    def prune(self, keep_days=None):
+        """Удаляет обработанные апдейты старше keep_days - их дедупликация уже не нужна."""
+        keep_days = keep_days or _setting('TELEGRAM_WEBHOOK_KEEP_DAYS', 2)
+        cutoff = timezone.now() - timedelta(days=keep_days)
+        return TelegramUpdate.objects.filter(processed_at__lt=cutoff).delete()[0]
+
+
+class DispatcherWorker(threading.Thread):
+    """Разбирает очередь апдейтов в фоне. wake() - не ждать poll_interval."""
+
+    PRUNE_EVERY = 3600
+
+    def __init__(self, dispatcher, poll_interval=None):
+        super().__init__(name='telegram-webhook', daemon=True)
+        self.dispatcher = dispatcher
+        self.poll_interval = poll_interval or _setting('TELEGRAM_WEBHOOK_POLL_INTERVAL', 5)
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+
+    def wake(self):
+        self._wake.set()
+
+    def run(self):
+        next_prune = 0
+        try:
+            while not self._stop_event.is_set():
+                self._wake.clear()
+                try:
+                    done = self.dispatcher.run_once()
+                    if timezone.now().timestamp() >= next_prune:
+                        self.dispatcher.prune()
+                        next_prune = timezone.now().timestamp() + self.PRUNE_EVERY
+                except Exception as e:
+                    log_event(logger, 'dispatcher_error', level='warning', error=str(e))
+                    done = 0
+                if not done:
+                    self._wake.wait(self.poll_interval)
+        finally:
+            connection.close()
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        self._wake.set()
+        self.join(timeout)
+
+
+def make_pipeline(bot, workers=None):
+    """Конвейер медиа для webhook-режима, с пакетной записью сообщений (BOT_WRITE_BATCH_*)."""
+    pipeline = MediaPipeline(
+        bot, workers=workers or _setting('TELEGRAM_WEBHOOK_MEDIA_WORKERS', 2),
+        batch_size=_setting('BOT_WRITE_BATCH_SIZE', 100), batch_delay=_setting('BOT_WRITE_BATCH_MS', 50) / 1000,
+    )
+    pipeline.start()
+    return pipeline
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def notify():
+    """
+    Будит фоновый разбор апдейтов в этом процессе; при первом вызове
+    запускает его вместе с конвейером медиа. TELEGRAM_WEBHOOK_WORKER = False -
+    апдейты разбирает отдельный процесс (manage.py process_updates).
+    """
+    global _worker
+    if not _setting('TELEGRAM_WEBHOOK_WORKER', True):
+        return
+    with _worker_lock:
+        if _worker is None:
+            dispatcher = Dispatcher()
+            if telegram.pipeline is None:
+                telegram.pipeline = make_pipeline(dispatcher.bot)
+            _worker = DispatcherWorker(dispatcher)
+            _worker.start()
+    _worker.wake()